@@ -0,0 +1,275 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+
+from firmware_image import FirmwareImage
+from transfer_plan  import PlanCache
+from unpacker       import DfuPackage, PackageImage
+
+# ------------------------------------------------------------------------------
+#  Content-addressed store of parsed DFU packages on the gateway.
+#
+#  Each package is kept under the SHA-256 of its zip file as the images it
+#  contains, already unpacked (<type>.bin, mapped directly when used, and
+#  <type>.dat), their sizes and CRCs (meta.json) and the transfer plans built
+#  for them (plans/). Downloaded URLs are remembered with their ETag and
+#  Last-Modified, so updating many devices to the same release downloads and
+#  unpacks it once, while a URL whose content changed is downloaded again.
+#
+#  Entries are evicted least recently used first once the store exceeds its
+#  disk budget. Several processes can share one store; changes are made
+#  under a lock file and entries appear by atomic rename.
+# ------------------------------------------------------------------------------
+class ArtifactCache(object):
+
+    default_budget = 256 * 1024 * 1024
+
+    download_timeout = 60
+
+    @staticmethod
+    def default_path():
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(cache_home, 'ota-dfu', 'artifacts')
+
+    def __init__(self, path=None, budget=None):
+        self.path = path or ArtifactCache.default_path()
+        self.budget = ArtifactCache.default_budget if budget is None else budget
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry(self, sha256):
+        return os.path.join(self.path, sha256)
+
+    def _locked(self):
+        return _FileLock(os.path.join(self.path, '.lock'))
+
+    # --------------------------------------------------------------------------
+    #  URL -> {'sha256', 'etag', 'last_modified'} of what was downloaded from it
+    # --------------------------------------------------------------------------
+    def _urls(self):
+        try:
+            with open(os.path.join(self.path, 'urls.json'), 'r') as f:
+                urls = json.load(f)
+        except (OSError, ValueError) as e:
+            return {}
+
+        # Stores written before validators were kept map to the hash only
+        return {url: {'sha256': known} if isinstance(known, str) else known for (url, known) in urls.items()}
+
+    def _save_urls(self, urls):
+        tmp_path = os.path.join(self.path, 'urls.json.tmp')
+
+        with open(tmp_path, 'w') as f:
+            json.dump(urls, f)
+
+        os.replace(tmp_path, os.path.join(self.path, 'urls.json'))
+
+    # --------------------------------------------------------------------------
+    #  Full SHA-256 of a cached artifact from a reference (the hash or a
+    #  unique prefix of at least 8 digits). None if it isn't cached.
+    # --------------------------------------------------------------------------
+    def resolve(self, ref):
+        ref = ref.lower()
+        if len(ref) < 8:
+            return None
+
+        matches = [name for name in os.listdir(self.path) if name.startswith(ref) and
+                   os.path.isfile(os.path.join(self.path, name, 'meta.json'))]
+
+        if len(matches) > 1:
+            raise Exception(f"Artifact reference {ref} is ambiguous")
+
+        return matches[0] if matches else None
+
+    # --------------------------------------------------------------------------
+    #  Add a DFU package zip. Returns its SHA-256.
+    # --------------------------------------------------------------------------
+    def add_file(self, path, source=None):
+        sha256 = _file_sha256(path)
+
+        if os.path.isfile(os.path.join(self._entry(sha256), 'meta.json')):
+            return sha256
+
+        package = DfuPackage(path)
+
+        build_dir = tempfile.mkdtemp(prefix='.build-', dir=self.path)
+
+        try:
+            meta = {'sha256': sha256, 'source': source or os.path.abspath(path),
+                    'default': package.default_type(), 'images': {}}
+
+            for image_type in package.image_types:
+                image = package.load(image_type)
+
+                with open(os.path.join(build_dir, f"{image_type}.bin"), 'wb') as f:
+                    f.write(image.firmware.view)
+                with open(os.path.join(build_dir, f"{image_type}.dat"), 'wb') as f:
+                    f.write(image.init)
+
+                meta['images'][image_type] = {'size': image.firmware.size, 'crc32': image.firmware.crc32, 'sizes': image.sizes}
+                image.firmware.close()
+
+            with open(os.path.join(build_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            with self._locked():
+                if not os.path.isdir(self._entry(sha256)):
+                    os.rename(build_dir, self._entry(sha256))
+                    build_dir = None
+
+                self._evict(keep=sha256)
+        finally:
+            if build_dir is not None:
+                shutil.rmtree(build_dir, ignore_errors=True)
+
+        return sha256
+
+    # --------------------------------------------------------------------------
+    #  Download url into the cache. If sha256 is given the download must match
+    #  it, and a cached package with that hash is used without asking the
+    #  server. Otherwise a URL fetched before is only reused if the server
+    #  confirms (ETag / Last-Modified) it didn't change; refresh downloads it
+    #  again regardless. Returns the SHA-256.
+    # --------------------------------------------------------------------------
+    def fetch(self, url, sha256=None, refresh=False):
+        if sha256 is not None and self.resolve(sha256) is not None:
+            return self.resolve(sha256)
+
+        headers = {}
+
+        known = self._urls().get(url)
+        if known is not None and not refresh and sha256 is None and \
+           os.path.isfile(os.path.join(self._entry(known['sha256']), 'meta.json')):
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+
+        (fd, tmp_path) = tempfile.mkstemp(prefix='.download-', suffix='.zip', dir=self.path)
+
+        try:
+            request = urllib.request.Request(url, headers=headers)
+
+            try:
+                with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(request, timeout=self.download_timeout) as response:
+                    shutil.copyfileobj(response, f, 1 << 16)
+                    validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and headers:
+                    # Not modified since it was downloaded
+                    return known['sha256']
+                raise
+
+            digest = _file_sha256(tmp_path)
+            if sha256 is not None and digest != sha256.lower():
+                raise Exception(f"Download of {url} has SHA-256 {digest}, expected {sha256}")
+
+            self.add_file(tmp_path, source=url)
+        finally:
+            os.unlink(tmp_path)
+
+        with self._locked():
+            urls = self._urls()
+            urls[url] = dict(validators, sha256=digest)
+            self._save_urls(urls)
+
+        return digest
+
+    # --------------------------------------------------------------------------
+    #  The cached image of an artifact, firmware mapped from the store
+    # --------------------------------------------------------------------------
+    def load(self, sha256, image_type=None):
+        entry = self._entry(sha256)
+
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        if image_type is None:
+            image_type = meta['default']
+
+        info = meta['images'].get(image_type)
+        if info is None:
+            raise Exception(f"No {image_type} image in artifact {sha256[:12]}, it has: {', '.join(meta['images'])}")
+
+        firmware = FirmwareImage.from_file(os.path.join(entry, f"{image_type}.bin"))
+
+        # Computed when the artifact was added
+        firmware._crc32 = info['crc32']
+
+        with open(os.path.join(entry, f"{image_type}.dat"), 'rb') as f:
+            init = f.read()
+
+        # Most recently used
+        os.utime(entry)
+
+        return PackageImage(image_type, firmware, init, tuple(info['sizes']))
+
+    # --------------------------------------------------------------------------
+    #  Transfer plans are kept with the artifact they were built for
+    # --------------------------------------------------------------------------
+    def plan_cache(self, sha256):
+        return PlanCache(os.path.join(self._entry(sha256), 'plans'))
+
+    # --------------------------------------------------------------------------
+    #  Remove least recently used entries until the store fits the budget.
+    #  Called with the lock held.
+    # --------------------------------------------------------------------------
+    def _evict(self, keep=None):
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.path):
+            entry = self._entry(name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(root, f)) for (root, _, files) in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), name, size))
+            total += size
+
+        evicted = []
+
+        for (_, name, size) in sorted(entries):
+            if total <= self.budget:
+                break
+
+            if name == keep:
+                continue
+
+            shutil.rmtree(self._entry(name), ignore_errors=True)
+            evicted.append(name)
+            total -= size
+
+        if evicted:
+            urls = self._urls()
+            self._save_urls({url: known for (url, known) in urls.items() if known['sha256'] not in evicted})
+
+        return evicted
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class _FileLock(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
@@ -0,0 +1,80 @@
+"""
+------------------------------------------------------------------------------
+ Asynchronous DFU: firmware updates as asyncio coroutines, so a single loop
+ (and thread) can update many devices at once, e.g.
+
+     package = DfuPackage(path).load()
+     controllers = await asyncio.gather(*(update(mac, package) for mac in macs))
+
+ On the socket transport (the default here) each wait for a response, a
+ receipt or a reboot suspends only the update that is waiting. Synchronous
+ transports (gatttool, the simulator) are given a worker thread each.
+------------------------------------------------------------------------------
+"""
+from async_transport import AsyncTransport, ExecutorTransport
+from transport       import Transport, create_transport
+
+from ble_secure_dfu_controller   import BleDfuControllerSecure
+from ble_legacy_dfu_controller   import BleDfuControllerLegacy
+from ble_ruuvitag_dfu_controller import BleDfuControllerRuuvitag
+
+verbose = False
+
+# ------------------------------------------------------------------------------
+#  The AsyncTransport for address. transport is a name ('socket' unless
+#  given, or 'gatttool'), a synchronous Transport or an AsyncTransport.
+# ------------------------------------------------------------------------------
+def async_transport(address, transport=None, adapter=None):
+    if isinstance(transport, AsyncTransport):
+        return transport
+
+    if isinstance(transport, Transport):
+        return ExecutorTransport(transport)
+
+    if transport is None or transport == 'socket':
+        from att_transport import AsyncAttSocketTransport
+        return AsyncAttSocketTransport(address, adapter)
+
+    return ExecutorTransport(create_transport(transport, address, adapter))
+
+# ------------------------------------------------------------------------------
+#  A controller for the device at address: a RuuviTag if device_id is given,
+#  else a secure (or, with legacy set, a legacy) bootloader. settings are
+#  controller attributes (att_mtu, pkt_receipt_interval, gatt_cache, ...).
+# ------------------------------------------------------------------------------
+def controller(address, transport=None, adapter=None, legacy=False, device_id=None, **settings):
+    link = async_transport(address, transport, adapter)
+
+    if device_id is not None:
+        ble_dfu = BleDfuControllerRuuvitag(address, None, None, device_id, link)
+    elif legacy:
+        ble_dfu = BleDfuControllerLegacy(address, None, None, link)
+    else:
+        ble_dfu = BleDfuControllerSecure(address, None, None, link)
+
+    for (name, value) in settings.items():
+        if not hasattr(ble_dfu, name):
+            raise Exception(f"Unknown controller setting: {name}")
+
+        setattr(ble_dfu, name, value)
+
+    return ble_dfu
+
+# ------------------------------------------------------------------------------
+#  Update the device at address with image (an unpacker.PackageImage).
+#  Returns the controller, for its transfer_report(). Raises on failure,
+#  after closing the connection.
+# ------------------------------------------------------------------------------
+async def update(address, image, transport=None, adapter=None, legacy=False, device_id=None, **settings):
+    ble_dfu = controller(address, transport, adapter, legacy, device_id, **settings)
+    ble_dfu.use_image(image.firmware, image.init, image.type, image.sizes)
+    ble_dfu.input_setup()
+
+    try:
+        await ble_dfu.update_async()
+    except Exception as e:
+        if verbose: print(f"Update of {address} failed: {e}")
+        await ble_dfu.disconnect_async()
+        raise
+
+    return ble_dfu
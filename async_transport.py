@@ -0,0 +1,199 @@
+import asyncio
+import concurrent.futures
+
+from abc       import ABCMeta, abstractmethod
+from transport import ScanUnavailable, ATT_DEFAULT_MTU
+
+# ------------------------------------------------------------------------------
+#  Link to a single BLE peripheral, for controllers driven by an asyncio loop.
+#
+#  The coroutine counterpart of transport.Transport, with the same methods
+#  and return values. Waits suspend the update instead of blocking a thread,
+#  so one loop can run many updates at once.
+# ------------------------------------------------------------------------------
+class AsyncTransport(object):
+    __metaclass__ = ABCMeta
+
+    timeout = 10
+
+    def __init__(self, target_mac, adapter=None):
+        self.target_mac = target_mac
+        self.adapter = adapter
+
+    async def retarget(self, target_mac):
+        await self.disconnect()
+
+        self.target_mac = target_mac
+
+    @abstractmethod
+    async def connect(self):
+        pass
+
+    async def reconnect(self):
+        return await self.connect()
+
+    async def exchange_mtu(self, mtu):
+        return ATT_DEFAULT_MTU
+
+    @abstractmethod
+    async def disconnect(self):
+        pass
+
+    @abstractmethod
+    async def discover_characteristics(self):
+        pass
+
+    @abstractmethod
+    async def read(self, handle):
+        pass
+
+    async def read_by_uuid(self, uuid):
+        return None
+
+    @abstractmethod
+    async def write_request(self, handle, data, wait=True):
+        pass
+
+    @abstractmethod
+    async def write_command(self, handle, data):
+        pass
+
+    @abstractmethod
+    async def wait_for_notification(self, timeout=None):
+        pass
+
+    async def wait_for_advertisement(self, macs, timeout):
+        raise ScanUnavailable(f"{type(self).__name__} can't scan")
+
+    # --------------------------------------------------------------------------
+    #  Call a blocking function (a scan.DeviceIndex wait, a fleet.ConnectGate)
+    #  without stalling the other updates on the loop
+    # --------------------------------------------------------------------------
+    async def blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+# ------------------------------------------------------------------------------
+#  A synchronous Transport called straight from the coroutines, for
+#  controllers run to completion one call at a time (their synchronous
+#  methods). Nothing else runs on the loop, so blocking it costs nothing.
+# ------------------------------------------------------------------------------
+class DirectTransport(AsyncTransport):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    @property
+    def target_mac(self):
+        return self.transport.target_mac
+
+    @property
+    def adapter(self):
+        return self.transport.adapter
+
+    @property
+    def timeout(self):
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.transport.timeout = value
+
+    async def retarget(self, target_mac):
+        self.transport.retarget(target_mac)
+
+    async def connect(self):
+        return self.transport.connect()
+
+    async def reconnect(self):
+        return self.transport.reconnect()
+
+    async def exchange_mtu(self, mtu):
+        return self.transport.exchange_mtu(mtu)
+
+    async def disconnect(self):
+        self.transport.disconnect()
+
+    async def discover_characteristics(self):
+        return self.transport.discover_characteristics()
+
+    async def read(self, handle):
+        return self.transport.read(handle)
+
+    async def read_by_uuid(self, uuid):
+        return self.transport.read_by_uuid(uuid)
+
+    async def write_request(self, handle, data, wait=True):
+        return self.transport.write_request(handle, data, wait)
+
+    async def write_command(self, handle, data):
+        self.transport.write_command(handle, data)
+
+    async def wait_for_notification(self, timeout=None):
+        return self.transport.wait_for_notification(timeout)
+
+    async def wait_for_advertisement(self, macs, timeout):
+        return self.transport.wait_for_advertisement(macs, timeout)
+
+    async def blocking(self, function, *args):
+        return function(*args)
+
+# ------------------------------------------------------------------------------
+#  A synchronous Transport (gatttool, the simulator) run on a worker thread
+#  of its own, so its waits don't hold up other updates on the loop. Calls
+#  are made one at a time and in order, as the blocking transports expect.
+#  The thread is released on disconnect().
+# ------------------------------------------------------------------------------
+class ExecutorTransport(DirectTransport):
+
+    def __init__(self, transport):
+        super().__init__(transport)
+
+        self.executor = None
+
+    async def _call(self, function, *args):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def retarget(self, target_mac):
+        await self._call(self.transport.retarget, target_mac)
+
+    async def connect(self):
+        return await self._call(self.transport.connect)
+
+    async def reconnect(self):
+        return await self._call(self.transport.reconnect)
+
+    async def exchange_mtu(self, mtu):
+        return await self._call(self.transport.exchange_mtu, mtu)
+
+    async def disconnect(self):
+        await self._call(self.transport.disconnect)
+
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+    async def discover_characteristics(self):
+        return await self._call(self.transport.discover_characteristics)
+
+    async def read(self, handle):
+        return await self._call(self.transport.read, handle)
+
+    async def read_by_uuid(self, uuid):
+        return await self._call(self.transport.read_by_uuid, uuid)
+
+    async def write_request(self, handle, data, wait=True):
+        return await self._call(self.transport.write_request, handle, data, wait)
+
+    async def write_command(self, handle, data):
+        await self._call(self.transport.write_command, handle, data)
+
+    async def wait_for_notification(self, timeout=None):
+        return await self._call(self.transport.wait_for_notification, timeout)
+
+    async def wait_for_advertisement(self, macs, timeout):
+        return await self._call(self.transport.wait_for_advertisement, macs, timeout)
+
+    async def blocking(self, function, *args):
+        return await AsyncTransport.blocking(self, function, *args)
@@ -0,0 +1,725 @@
+import asyncio
+import ctypes
+import errno
+import fcntl
+import re
+import select
+import socket
+import struct
+import threading
+import time
+import uuid
+
+from transport       import Transport, Characteristic, ConnectionLost, ScanUnavailable, Advertisement, ATT_DEFAULT_MTU
+from async_transport import AsyncTransport
+from events          import EventQueue, Notification, Disconnected
+from hci_scan        import HciScanner
+
+verbose = False
+
+# Not every Python build exposes the Bluetooth constants
+AF_BLUETOOTH  = getattr(socket, 'AF_BLUETOOTH', 31)
+BTPROTO_L2CAP = getattr(socket, 'BTPROTO_L2CAP', 0)
+
+ATT_CID          = 4
+BDADDR_LE_PUBLIC = 0x01
+BDADDR_LE_RANDOM = 0x02
+
+class Att:
+    ERROR_RSP           = 0x01
+    MTU_REQ             = 0x02
+    MTU_RSP             = 0x03
+    READ_BY_TYPE_REQ    = 0x08
+    READ_BY_TYPE_RSP    = 0x09
+    READ_REQ            = 0x0A
+    READ_RSP            = 0x0B
+    WRITE_REQ           = 0x12
+    WRITE_RSP           = 0x13
+    NOTIFY              = 0x1B
+    INDICATE            = 0x1D
+    CONFIRM             = 0x1E
+    WRITE_CMD           = 0x52
+
+    COMMAND_FLAG        = 0x40
+
+    ERR_REQ_NOT_SUPP    = 0x06
+    ERR_ATTR_NOT_FOUND  = 0x0A
+
+    UUID_CHARACTERISTIC = 0x2803
+
+    DEFAULT_MTU         = ATT_DEFAULT_MTU
+    MAX_PDU             = 517
+
+class sockaddr_l2(ctypes.Structure):
+    _fields_ = [
+        ('l2_family',      ctypes.c_ushort),
+        ('l2_psm',         ctypes.c_ushort),
+        ('l2_bdaddr',      ctypes.c_uint8 * 6),
+        ('l2_cid',         ctypes.c_ushort),
+        ('l2_bdaddr_type', ctypes.c_uint8),
+    ]
+
+_libc = None
+
+# ------------------------------------------------------------------------------
+#  Python's socket module only knows (bdaddr, psm) L2CAP addresses, so the
+#  LE fixed-channel address is passed to bind/connect through libc directly.
+# ------------------------------------------------------------------------------
+def _sockaddr(mac, addr_type):
+    addr = sockaddr_l2()
+    addr.l2_family = AF_BLUETOOTH
+    addr.l2_cid = ATT_CID
+    addr.l2_bdaddr_type = addr_type
+
+    if mac is not None:
+        for i, byte in enumerate(reversed(mac.split(':'))):
+            addr.l2_bdaddr[i] = int(byte, 16)
+
+    return addr
+
+def _libc_call(name, sock, addr):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+
+    if getattr(_libc, name)(sock.fileno(), ctypes.byref(addr), ctypes.sizeof(addr)) != 0:
+        return ctypes.get_errno()
+
+    return 0
+
+BTPROTO_HCI    = 1
+HCIGETDEVINFO  = 0x800448d3
+
+# ------------------------------------------------------------------------------
+#  Sockets bind to a controller by address; map an adapter name (hci0) to
+#  its bdaddr. Addresses are passed through unchanged.
+# ------------------------------------------------------------------------------
+def adapter_address(adapter):
+    if adapter is None:
+        return None
+
+    match = re.match(r'^hci(\d+)$', adapter)
+    if not match:
+        return adapter
+
+    sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+
+    try:
+        # struct hci_dev_info: dev_id, name[8], bdaddr, ...
+        info = bytearray(128)
+        struct.pack_into('<H', info, 0, int(match.group(1)))
+        fcntl.ioctl(sock.fileno(), HCIGETDEVINFO, info)
+    finally:
+        sock.close()
+
+    return ':'.join(f'{byte:02X}' for byte in reversed(info[10:16]))
+
+# ------------------------------------------------------------------------------
+#  Passive scan on the adapter's raw HCI socket until one of macs advertises
+# ------------------------------------------------------------------------------
+def wait_for_advertisement(adapter, macs, timeout):
+    macs = [mac.upper() for mac in macs]
+    started = time.monotonic()
+
+    try:
+        with HciScanner(adapter) as scanner:
+            for report in scanner.reports(timeout):
+                if report.mac in macs:
+                    return Advertisement(report.mac, time.monotonic() - started)
+    except OSError as e:
+        raise ScanUnavailable(f"Can't scan on {adapter or 'hci0'}: {e}")
+
+    return None
+
+BLUETOOTH_BASE_UUID = '-0000-1000-8000-00805f9b34fb'
+
+def uuid_to_bytes(uuid_str):
+    if uuid_str.startswith('0000') and uuid_str.endswith(BLUETOOTH_BASE_UUID):
+        return struct.pack('<H', int(uuid_str[4:8], 16))
+
+    return bytes(reversed(uuid.UUID(uuid_str).bytes))
+
+def uuid_to_string(raw):
+    if len(raw) == 2:
+        return f'0000{struct.unpack("<H", raw)[0]:04x}{BLUETOOTH_BASE_UUID}'
+
+    return str(uuid.UUID(bytes=bytes(reversed(raw))))
+
+# ------------------------------------------------------------------------------
+#  Transport speaking ATT directly over an LE L2CAP socket (CID 4).
+#
+#  PDUs are sent and received as bytes; no helper process is involved.
+#  An already connected socket (e.g. one end of a socketpair) can be passed
+#  in to talk to something other than a real radio.
+#
+#  A reader thread blocks on the socket and dispatches every PDU as it
+#  arrives: notifications and link loss go to the event queue, responses to
+#  the queue the pending request waits on, and requests from the peer are
+#  answered directly.
+# ------------------------------------------------------------------------------
+class AttSocketTransport(Transport):
+
+    def __init__(self, target_mac, adapter=None, sock=None, address_type=BDADDR_LE_RANDOM):
+        super().__init__(target_mac, adapter)
+
+        self.address_type = address_type
+        self.sock = sock
+        self.mtu = Att.DEFAULT_MTU
+
+        self.events = EventQueue()
+        self.responses = EventQueue()
+        self.lost = threading.Event()
+        self._reader = None
+
+    def retarget(self, target_mac):
+        self.disconnect()
+
+        self.target_mac = target_mac
+
+    def connect(self):
+        if self.sock is not None:
+            if self._reader is None:
+                self._start_reader()
+            return True
+
+        try:
+            adapter = adapter_address(self.adapter)
+        except OSError as e:
+            print(f"Unknown adapter {self.adapter}: {e}")
+            return False
+
+        sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+
+        try:
+            if _libc_call('bind', sock, _sockaddr(adapter, BDADDR_LE_PUBLIC)) != 0:
+                sock.close()
+                return False
+
+            sock.setblocking(False)
+
+            err = _libc_call('connect', sock, _sockaddr(self.target_mac, self.address_type))
+            if err not in (0, errno.EINPROGRESS):
+                sock.close()
+                return False
+
+            (_, writable, _) = select.select([], [sock], [], self.timeout)
+            if not writable or sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                sock.close()
+                return False
+
+            sock.setblocking(True)
+
+        except OSError as e:
+            sock.close()
+            return False
+
+        self.sock = sock
+        self.mtu = Att.DEFAULT_MTU
+        self._start_reader()
+
+        return True
+
+    # --------------------------------------------------------------------------
+    #  The socket of a lost link can't be used again, connect a new one
+    # --------------------------------------------------------------------------
+    def reconnect(self):
+        self.disconnect()
+
+        return self.connect()
+
+    def exchange_mtu(self, mtu):
+        rsp = self._request(struct.pack('<BH', Att.MTU_REQ, mtu), Att.MTU_RSP)
+
+        if rsp is None or rsp[0] != Att.MTU_RSP:
+            return self.mtu
+
+        server_mtu = struct.unpack_from('<H', rsp, 1)[0]
+        self.mtu = max(Att.DEFAULT_MTU, min(mtu, server_mtu))
+
+        return self.mtu
+
+    def disconnect(self):
+        if self.sock is not None:
+            # Wakes the reader blocked in recv()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                pass
+
+            self.sock.close()
+            self.sock = None
+            self._reader = None
+
+    def discover_characteristics(self):
+        chars = []
+        start = 0x0001
+
+        while start <= 0xFFFF:
+            rsp = self._request(struct.pack('<BHHH', Att.READ_BY_TYPE_REQ, start, 0xFFFF, Att.UUID_CHARACTERISTIC), Att.READ_BY_TYPE_RSP)
+
+            if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+                break
+
+            length = rsp[1]
+            for i in range(2, len(rsp) - length + 1, length):
+                (handle, properties, value_handle) = struct.unpack_from('<HBH', rsp, i)
+                chars.append(Characteristic(handle, properties, value_handle, uuid_to_string(rsp[i + 5:i + length])))
+
+            start = handle + 1
+
+        return chars
+
+    def read(self, handle):
+        rsp = self._request(struct.pack('<BH', Att.READ_REQ, handle), Att.READ_RSP)
+
+        if rsp is None or rsp[0] != Att.READ_RSP:
+            return None
+
+        return rsp[1:]
+
+    def read_by_uuid(self, uuid_str):
+        rsp = self._request(struct.pack('<BHH', Att.READ_BY_TYPE_REQ, 0x0001, 0xFFFF) + uuid_to_bytes(uuid_str), Att.READ_BY_TYPE_RSP)
+
+        if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+            return None
+
+        # First entry only: handle (2 bytes) followed by the value
+        return rsp[4:2 + rsp[1]]
+
+    def write_request(self, handle, data, wait=True):
+        pdu = struct.pack('<BH', Att.WRITE_REQ, handle) + bytes(data)
+
+        if not wait:
+            self._send(pdu)
+            return True
+
+        rsp = self._request(pdu, Att.WRITE_RSP)
+
+        return rsp is not None and rsp[0] == Att.WRITE_RSP
+
+    def write_command(self, handle, data):
+        # Header and payload are gathered by the kernel, the payload (a view
+        # into the image) is never copied here
+        self._send(struct.pack('<BH', Att.WRITE_CMD, handle), data)
+
+    def wait_for_notification(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        event = self.events.get(timeout)
+
+        if event is None:
+            return None
+
+        if isinstance(event, Disconnected):
+            self.events.put(event)
+            raise ConnectionLost()
+
+        return (event.handle, event.value)
+
+    def wait_for_advertisement(self, macs, timeout):
+        return wait_for_advertisement(self.adapter, macs, timeout)
+
+    # --------------------------------------------------------------------------
+    #  Send a request and wait for its response (or an Error Response).
+    # --------------------------------------------------------------------------
+    def _request(self, pdu, rsp_opcode):
+        # Late responses to unconfirmed writes must not answer this request
+        self.responses.drain()
+        self._send(pdu)
+
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            rsp = self.responses.get(max(deadline - time.monotonic(), 0))
+            if rsp is None:
+                return None
+
+            if isinstance(rsp, Disconnected):
+                self.responses.put(rsp)
+                raise ConnectionLost()
+
+            if rsp[0] == rsp_opcode:
+                return rsp
+
+            if rsp[0] == Att.ERROR_RSP and rsp[1] == pdu[0]:
+                if verbose: print(f"ATT error 0x{rsp[4]:02x} for opcode 0x{pdu[0]:02x}")
+                return rsp
+
+    # --------------------------------------------------------------------------
+    #  Reader thread
+    # --------------------------------------------------------------------------
+    def _start_reader(self):
+        # Fresh queues per socket: a reader still winding down on an old
+        # socket can only ever post to its own
+        self.events = EventQueue()
+        self.responses = EventQueue()
+        self.lost = threading.Event()
+
+        self._reader = threading.Thread(target=self._read_loop, args=(self.sock, self.events, self.responses, self.lost), daemon=True)
+        self._reader.start()
+
+    def _read_loop(self, sock, events, responses, lost):
+        while True:
+            try:
+                pdu = sock.recv(Att.MAX_PDU)
+            except OSError as e:
+                pdu = None
+
+            if not pdu:
+                if verbose: print('Connection lost!')
+                lost.set()
+                events.put(Disconnected('link lost'))
+                responses.put(Disconnected('link lost'))
+                return
+
+            self._dispatch(sock, pdu, events, responses)
+
+    def _dispatch(self, sock, pdu, events, responses):
+        opcode = pdu[0]
+
+        try:
+            if opcode == Att.NOTIFY:
+                events.put(Notification(struct.unpack_from('<H', pdu, 1)[0], bytes(pdu[3:])))
+
+            elif opcode == Att.INDICATE:
+                events.put(Notification(struct.unpack_from('<H', pdu, 1)[0], bytes(pdu[3:])))
+                sock.send(bytes([Att.CONFIRM]))
+
+            elif opcode == Att.MTU_REQ:
+                sock.send(struct.pack('<BH', Att.MTU_RSP, self.mtu))
+
+            elif (opcode & Att.COMMAND_FLAG) == 0 and (opcode & 1) == 0 and opcode != Att.CONFIRM:
+                # Requests from the peer (e.g. its own service discovery)
+                sock.send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, 0x0000, Att.ERR_REQ_NOT_SUPP))
+
+            elif (opcode & Att.COMMAND_FLAG) == 0:
+                responses.put(pdu)
+
+        except OSError as e:
+            # The recv() that follows reports the loss
+            pass
+
+    def _send(self, *buffers):
+        # Writes without response would otherwise go on until the next
+        # receipt is waited for
+        if self.sock is None or self.lost.is_set():
+            raise ConnectionLost()
+
+        try:
+            self.sock.sendmsg(buffers)
+        except OSError as e:
+            self.disconnect()
+            raise ConnectionLost()
+
+# ------------------------------------------------------------------------------
+#  AttSocketTransport for controllers driven by an asyncio loop.
+#
+#  The socket is non-blocking and registered with the loop that connects
+#  it, so no thread waits on it: each PDU is dispatched from the loop's
+#  reader callback as it arrives, a response completing the pending request,
+#  notifications and link loss going onto the queue wait_for_notification()
+#  reads. Requests from the peer are answered directly.
+# ------------------------------------------------------------------------------
+class AsyncAttSocketTransport(AsyncTransport):
+
+    def __init__(self, target_mac, adapter=None, sock=None, address_type=BDADDR_LE_RANDOM):
+        super().__init__(target_mac, adapter)
+
+        self.address_type = address_type
+        self.sock = sock
+        self.mtu = Att.DEFAULT_MTU
+
+        # Set up by _attach() on the loop of the connection
+        self.loop = None
+        self.events = None
+        self.request_lock = None
+
+        # (request opcode, response opcode, future) of the request in flight
+        self.pending = None
+        self.lost = False
+
+    async def connect(self):
+        if self.sock is not None:
+            if self.loop is None:
+                self._attach(self.sock)
+            return True
+
+        try:
+            adapter = adapter_address(self.adapter)
+        except OSError as e:
+            print(f"Unknown adapter {self.adapter}: {e}")
+            return False
+
+        try:
+            sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+        except OSError as e:
+            print(f"Can't open an L2CAP socket: {e}")
+            return False
+
+        try:
+            if _libc_call('bind', sock, _sockaddr(adapter, BDADDR_LE_PUBLIC)) != 0:
+                sock.close()
+                return False
+
+            sock.setblocking(False)
+
+            err = _libc_call('connect', sock, _sockaddr(self.target_mac, self.address_type))
+            if err not in (0, errno.EINPROGRESS):
+                sock.close()
+                return False
+
+            try:
+                await asyncio.wait_for(self._writable(sock), self.timeout)
+            except asyncio.TimeoutError:
+                sock.close()
+                return False
+
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                sock.close()
+                return False
+
+        except OSError as e:
+            sock.close()
+            return False
+
+        self._attach(sock)
+
+        return True
+
+    def _attach(self, sock):
+        sock.setblocking(False)
+
+        self.sock = sock
+        self.mtu = Att.DEFAULT_MTU
+
+        # Fresh per socket, on the loop running this update
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.request_lock = asyncio.Lock()
+        self.pending = None
+        self.lost = False
+
+        self.loop.add_reader(sock.fileno(), self._on_readable, sock)
+
+    # --------------------------------------------------------------------------
+    #  The socket of a lost link can't be used again, connect a new one
+    # --------------------------------------------------------------------------
+    async def reconnect(self):
+        await self.disconnect()
+
+        return await self.connect()
+
+    async def exchange_mtu(self, mtu):
+        rsp = await self._request(struct.pack('<BH', Att.MTU_REQ, mtu), Att.MTU_RSP)
+
+        if rsp is None or rsp[0] != Att.MTU_RSP:
+            return self.mtu
+
+        server_mtu = struct.unpack_from('<H', rsp, 1)[0]
+        self.mtu = max(Att.DEFAULT_MTU, min(mtu, server_mtu))
+
+        return self.mtu
+
+    async def disconnect(self):
+        if self.sock is None:
+            return
+
+        self._link_lost()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            pass
+
+        self.sock.close()
+        self.sock = None
+        self.loop = None
+
+    async def discover_characteristics(self):
+        chars = []
+        start = 0x0001
+
+        while start <= 0xFFFF:
+            rsp = await self._request(struct.pack('<BHHH', Att.READ_BY_TYPE_REQ, start, 0xFFFF, Att.UUID_CHARACTERISTIC), Att.READ_BY_TYPE_RSP)
+
+            if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+                break
+
+            length = rsp[1]
+            for i in range(2, len(rsp) - length + 1, length):
+                (handle, properties, value_handle) = struct.unpack_from('<HBH', rsp, i)
+                chars.append(Characteristic(handle, properties, value_handle, uuid_to_string(rsp[i + 5:i + length])))
+
+            start = handle + 1
+
+        return chars
+
+    async def read(self, handle):
+        rsp = await self._request(struct.pack('<BH', Att.READ_REQ, handle), Att.READ_RSP)
+
+        if rsp is None or rsp[0] != Att.READ_RSP:
+            return None
+
+        return rsp[1:]
+
+    async def read_by_uuid(self, uuid_str):
+        rsp = await self._request(struct.pack('<BHH', Att.READ_BY_TYPE_REQ, 0x0001, 0xFFFF) + uuid_to_bytes(uuid_str), Att.READ_BY_TYPE_RSP)
+
+        if rsp is None or rsp[0] != Att.READ_BY_TYPE_RSP:
+            return None
+
+        # First entry only: handle (2 bytes) followed by the value
+        return rsp[4:2 + rsp[1]]
+
+    async def write_request(self, handle, data, wait=True):
+        pdu = struct.pack('<BH', Att.WRITE_REQ, handle) + bytes(data)
+
+        if not wait:
+            await self._send(pdu)
+            return True
+
+        rsp = await self._request(pdu, Att.WRITE_RSP)
+
+        return rsp is not None and rsp[0] == Att.WRITE_RSP
+
+    async def write_command(self, handle, data):
+        # Gathered by the kernel, the payload is never copied here
+        await self._send(struct.pack('<BH', Att.WRITE_CMD, handle), data)
+
+    async def wait_for_notification(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        if self.events is None:
+            raise ConnectionLost()
+
+        try:
+            event = await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        if event is None:
+            # Keep reporting the loss to later waits
+            self.events.put_nowait(None)
+            raise ConnectionLost()
+
+        return event
+
+    async def wait_for_advertisement(self, macs, timeout):
+        return await self.blocking(wait_for_advertisement, self.adapter, macs, timeout)
+
+    # --------------------------------------------------------------------------
+    #  Send a request and wait for its response (or an Error Response).
+    #  Responses nobody is waiting for are dropped on arrival.
+    # --------------------------------------------------------------------------
+    async def _request(self, pdu, rsp_opcode):
+        if self.request_lock is None:
+            raise ConnectionLost()
+
+        async with self.request_lock:
+            response = self.loop.create_future()
+            self.pending = (pdu[0], rsp_opcode, response)
+
+            try:
+                await self._send(pdu)
+                return await asyncio.wait_for(response, self.timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self.pending = None
+
+    async def _send(self, *buffers):
+        # Writes without response would otherwise go on until the next
+        # receipt is waited for
+        if self.sock is None or self.lost:
+            raise ConnectionLost()
+
+        while True:
+            try:
+                self.sock.sendmsg(buffers)
+                return
+            except BlockingIOError:
+                # Controller buffers are full until the link drains them
+                await self._writable(self.sock)
+            except OSError as e:
+                self._link_lost()
+                raise ConnectionLost()
+
+    async def _writable(self, sock):
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+
+        loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(True))
+        try:
+            await writable
+        finally:
+            loop.remove_writer(sock.fileno())
+
+    # --------------------------------------------------------------------------
+    #  Reader callback
+    # --------------------------------------------------------------------------
+    def _on_readable(self, sock):
+        try:
+            pdu = sock.recv(Att.MAX_PDU)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            pdu = None
+
+        if not pdu:
+            if verbose: print('Connection lost!')
+            self._link_lost()
+            return
+
+        self._dispatch(pdu)
+
+    def _dispatch(self, pdu):
+        opcode = pdu[0]
+
+        if opcode == Att.NOTIFY:
+            self.events.put_nowait((struct.unpack_from('<H', pdu, 1)[0], bytes(pdu[3:])))
+
+        elif opcode == Att.INDICATE:
+            self.events.put_nowait((struct.unpack_from('<H', pdu, 1)[0], bytes(pdu[3:])))
+            self._reply(bytes([Att.CONFIRM]))
+
+        elif opcode == Att.MTU_REQ:
+            self._reply(struct.pack('<BH', Att.MTU_RSP, self.mtu))
+
+        elif (opcode & Att.COMMAND_FLAG) == 0 and (opcode & 1) == 0 and opcode != Att.CONFIRM:
+            # Requests from the peer (e.g. its own service discovery)
+            self._reply(struct.pack('<BBHB', Att.ERROR_RSP, opcode, 0x0000, Att.ERR_REQ_NOT_SUPP))
+
+        elif (opcode & Att.COMMAND_FLAG) == 0 and self.pending is not None:
+            (req_opcode, rsp_opcode, response) = self.pending
+
+            if opcode == Att.ERROR_RSP and pdu[1] == req_opcode:
+                if verbose: print(f"ATT error 0x{pdu[4]:02x} for opcode 0x{req_opcode:02x}")
+            elif opcode != rsp_opcode:
+                return
+
+            if not response.done():
+                response.set_result(pdu)
+
+    def _reply(self, pdu):
+        try:
+            self.sock.send(pdu)
+        except OSError as e:
+            # The recv() that follows reports the loss
+            pass
+
+    def _link_lost(self):
+        if self.lost:
+            return
+
+        self.lost = True
+
+        if self.loop is not None:
+            self.loop.remove_reader(self.sock.fileno())
+
+        if self.pending is not None and not self.pending[2].done():
+            self.pending[2].set_exception(ConnectionLost())
+
+        if self.events is not None:
+            self.events.put_nowait(None)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ End-to-end DFU benchmark against simulated bootloaders.
+
+ Runs complete start() transfers of synthetic images through each
+ controller for every combination of image size, ATT MTU (payload size),
+ PRN interval, packet loss and link latency, and writes the results as
+ JSON. Throughput is measured in simulated link time so results are
+ comparable across machines and commits; wall and CPU time describe the
+ host side cost.
+
+ With --baseline the run fails if any case lost more than --threshold
+ percent of its throughput compared to the baseline file.
+------------------------------------------------------------------------------
+"""
+
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from dfu_simulator import SimulatedRadio, SimulatedTransport, LinkModel, secure_device, legacy_device
+
+from ble_secure_dfu_controller   import BleDfuControllerSecure
+from ble_legacy_dfu_controller   import BleDfuControllerLegacy
+from ble_ruuvitag_dfu_controller import BleDfuControllerRuuvitag
+
+CONTROLLERS = ['secure', 'legacy', 'ruuvitag']
+
+TARGET_MAC = 'C0:FF:EE:00:00:01'
+RUUVITAG_ID = '00:00:00:00:00:00:00:01'
+
+INIT_PACKET_SIZE = 141
+
+# ------------------------------------------------------------------------------
+#  Deterministic image contents for a given size
+# ------------------------------------------------------------------------------
+def synthetic_image(size, seed=0):
+    image = bytearray()
+    block = seed.to_bytes(4, 'little')
+
+    while len(image) < size:
+        block = zlib.crc32(block).to_bytes(4, 'little') * 64
+        image += block
+
+    return bytes(image[:size])
+
+def case_key(case):
+    return '{controller}/{size}/{mtu}/{prn}/{loss:g}/{latency:g}'.format(**case)
+
+# ------------------------------------------------------------------------------
+#  Run one case. Called in a fresh worker process so peak RSS is per case.
+# ------------------------------------------------------------------------------
+def run_case(case):
+    workdir = tempfile.mkdtemp(prefix='dfu-bench-')
+    firmware_path = os.path.join(workdir, 'application.bin')
+    datfile_path = os.path.join(workdir, 'application.dat')
+
+    firmware = synthetic_image(case['size'])
+    with open(firmware_path, 'wb') as f:
+        f.write(firmware)
+    with open(datfile_path, 'wb') as f:
+        f.write(synthetic_image(INIT_PACKET_SIZE, seed=1))
+
+    link = LinkModel(latency=case['latency'] / 1000.0, loss=case['loss'], max_mtu=case['mtu'], seed=case['seed'])
+    radio = SimulatedRadio()
+
+    if case['controller'] == 'legacy':
+        (_, bootloader) = legacy_device(radio, TARGET_MAC, zlib.crc32(firmware), link, in_dfu_mode=True)
+        dfu_mac = bootloader.mac
+    else:
+        (_, bootloader) = secure_device(radio, TARGET_MAC, len(firmware), link, in_dfu_mode=True)
+        dfu_mac = bootloader.mac
+
+    transport = SimulatedTransport(dfu_mac, radio)
+
+    if case['controller'] == 'secure':
+        ble_dfu = BleDfuControllerSecure(dfu_mac, firmware_path, datfile_path, transport)
+    elif case['controller'] == 'legacy':
+        ble_dfu = BleDfuControllerLegacy(dfu_mac, firmware_path, datfile_path, transport)
+    else:
+        ble_dfu = BleDfuControllerRuuvitag(dfu_mac, firmware_path, datfile_path, RUUVITAG_ID, transport)
+
+    ble_dfu.att_mtu = case['mtu']
+    ble_dfu.pkt_receipt_interval = case['prn']
+
+    result = dict(case)
+    result['error'] = None
+
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        ble_dfu.input_setup()
+
+        if not ble_dfu.scan_and_connect():
+            raise Exception("Can't connect to simulated target")
+
+        link_start = radio.clock.now
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+
+        try:
+            ble_dfu.start()
+        except Exception as e:
+            result['error'] = str(e)
+
+        cpu_time = time.process_time() - cpu_start
+        wall_time = time.monotonic() - wall_start
+        link_time = radio.clock.now - link_start
+
+        ble_dfu.disconnect()
+
+    if case['controller'] == 'legacy':
+        received = bytes(bootloader.firmware)
+        retransmitted = 0
+    else:
+        received = bytes(bootloader.data)
+        retransmitted = bootloader.objects_created - bootloader.objects_executed
+
+    result['success'] = result['error'] is None and bootloader.complete and received == firmware
+    result['link_time'] = link_time
+    result['bytes_per_sec'] = len(firmware) / link_time if result['success'] and link_time > 0 else 0.0
+    result['wall_time'] = wall_time
+    result['packets_sent'] = transport.packets_sent
+    result['packets_lost'] = transport.packets_lost
+    result['retransmitted_objects'] = retransmitted
+    result['reconnects'] = ble_dfu.reconnects
+    result['cpu_time_per_kb'] = cpu_time / (len(firmware) / 1024.0)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for path in (firmware_path, datfile_path):
+        os.remove(path)
+    os.rmdir(workdir)
+
+    return result
+
+def build_matrix(options):
+    cases = []
+
+    for (controller, size, mtu, prn, loss, latency) in itertools.product(
+            options.controllers, options.sizes, options.mtus, options.prns, options.losses, options.latencies):
+        cases.append({
+            'controller' : controller,
+            'size'       : size * 1024,
+            'mtu'        : mtu,
+            'prn'        : prn,
+            'loss'       : loss,
+            'latency'    : latency,
+            'seed'       : options.seed,
+        })
+
+    return cases
+
+def run_matrix(cases):
+    results = []
+
+    # One task per worker process keeps ru_maxrss specific to each case
+    with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+        for case in cases:
+            result = pool.apply(run_case, (case,))
+            results.append(result)
+
+            status = 'ok' if result['success'] else f"FAILED ({result['error']})"
+            print(f"{case_key(case):36} {result['bytes_per_sec'] / 1024.0:8.1f} KB/s  "
+                  f"{result['wall_time']:6.2f} s wall  {result['cpu_time_per_kb'] * 1000.0:6.2f} ms CPU/KB  "
+                  f"{result['retransmitted_objects']:3} retx  {status}")
+
+    return results
+
+# ------------------------------------------------------------------------------
+#  Compare against a previous run. Returns the list of regressed case keys.
+# ------------------------------------------------------------------------------
+def check_regressions(results, baseline, threshold):
+    previous = {case_key(result): result for result in baseline['results']}
+    regressions = []
+
+    for result in results:
+        base = previous.get(case_key(result))
+        if base is None or not base['success']:
+            continue
+
+        if result['bytes_per_sec'] < base['bytes_per_sec'] * (1.0 - threshold / 100.0):
+            change = (result['bytes_per_sec'] / base['bytes_per_sec'] - 1.0) * 100.0
+            print(f"Regression in {case_key(result)}: {base['bytes_per_sec']:.0f} -> {result['bytes_per_sec']:.0f} B/s ({change:+.1f}%)")
+            regressions.append(case_key(result))
+
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        return None
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(',') if item]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+
+    parser.add_option('--controllers', dest='controllers', default=','.join(CONTROLLERS),
+                      help='controllers to run (default: %default)')
+    parser.add_option('--sizes', dest='sizes', default='64,256,1024',
+                      help='image sizes in KB (default: %default)')
+    parser.add_option('--mtu', dest='mtus', default='23,247',
+                      help='ATT MTUs; payload is MTU - 3 (default: %default)')
+    parser.add_option('--prn', dest='prns', default='10',
+                      help='PRN intervals, 0 disables receipts (default: %default)')
+    parser.add_option('--loss', dest='losses', default='0,0.005',
+                      help='packet loss rates (default: %default)')
+    parser.add_option('--latency', dest='latencies', default='7.5,30',
+                      help='one-way link latencies in ms (default: %default)')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='random seed for packet loss (default: %default)')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='write JSON results to this file')
+    parser.add_option('--baseline', dest='baseline', default=None,
+                      help='JSON results of a previous run to compare against')
+    parser.add_option('--threshold', dest='threshold', type='float', default=10.0,
+                      help='allowed throughput drop in percent (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    try:
+        options.controllers = parse_list(options.controllers, str)
+        options.sizes = parse_list(options.sizes, int)
+        options.mtus = parse_list(options.mtus, int)
+        options.prns = parse_list(options.prns, int)
+        options.losses = parse_list(options.losses, float)
+        options.latencies = parse_list(options.latencies, float)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if any(prn < 0 for prn in options.prns):
+        parser.error("PRN intervals must be 0 (receipts disabled) or more")
+
+    for controller in options.controllers:
+        if controller not in CONTROLLERS:
+            parser.error(f"Unknown controller: {controller}")
+
+    results = run_matrix(build_matrix(options))
+
+    report = {
+        'revision' : git_revision(),
+        'time'     : int(time.time()),
+        'results'  : results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if check_regressions(results, baseline, options.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
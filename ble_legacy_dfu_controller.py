@@ -1,11 +1,13 @@
+import asyncio
 import math
-import pexpect
+import struct
 import time
 
-from array import array
 from util  import *
 
 from nrf_ble_dfu_controller import NrfBleDfuController
+from notify_decoder         import decode_legacy, PacketReceipt
+from transport              import ConnectionLost
 
 verbose = False
 
@@ -74,16 +76,43 @@ class BleDfuControllerLegacy(NrfBleDfuController):
     UUID_PACKET          = "00001532-1212-efde-1523-785feabcd123"
     UUID_VERSION         = "00001534-1212-efde-1523-785feabcd123"
 
+    kind                 = 'legacy'
+    procedures           = Procedures
+
+    pkt_receipt_interval = 5
+
+    # START_DFU parameter per package image type
+    IMAGE_MODES = {
+        'softdevice'            : 0x01,
+        'bootloader'            : 0x02,
+        'softdevice_bootloader' : 0x03,
+        'application'           : 0x04,
+    }
+
     # Constructor inherited from abstract base class
 
     # --------------------------------------------------------------------------
-    #  Start the firmware update process
+    #  Start the firmware update process.
+    #  The legacy bootloader can't resume a transfer: after link loss it is
+    #  reconnected and the update starts over from START_DFU.
     # --------------------------------------------------------------------------
-    def start(self, verbose=False):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+    async def start_async(self, verbose=False):
+        while True:
+            try:
+                await self._dfu_transfer(verbose)
+                break
+            except ConnectionLost:
+                await self._recover_link()
 
-        self.pkt_receipt_interval = 5
+        self._print_reconnects()
+
+    async def _dfu_transfer(self, verbose):
+        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = await self._get_handles(self.UUID_CONTROL_POINT)
+        (_, self.data_handle, _) = await self._get_handles(self.UUID_PACKET)
+
+        if self.adaptive_prn is not None:
+            self.pkt_receipt_interval = self.adaptive_prn.interval
+            self.adaptive_prn.applied()
 
         if verbose:
             print(f'Control Point Handle: 0x{self.ctrlpt_handle:04x}, CCCD: 0x{self.ctrlpt_cccd_handle:04x}')
@@ -91,139 +120,172 @@ class BleDfuControllerLegacy(NrfBleDfuController):
 
         # Subscribe to notifications from Control Point characteristic
         if verbose: print("Enabling notifications")
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+        await self._enable_notifications(self.ctrlpt_cccd_handle)
+
+        if self.image_type not in self.IMAGE_MODES:
+            raise Exception(f"Unsupported image type: {self.image_type}")
+
+        (sd_size, bl_size, app_size) = self.image_sizes or (0, 0, self.image_size)
+        if sd_size is None or bl_size is None:
+            raise Exception("Softdevice and bootloader sizes missing from the package")
 
-        # Send 'START DFU' + Application Command
-        if verbose: print("Sending START_DFU")
-        self._dfu_send_command(Procedures.START_DFU, [0x04])
+        with self.instrumentation.phase('init', bytes=len(self.init_data)):
+            # Send 'START DFU' + image type
+            if verbose: print("Sending START_DFU")
+            await self._dfu_send_command(Procedures.START_DFU, [self.IMAGE_MODES[self.image_type]])
 
-        # Transmit binary image size
-        # Need to pad the byte array with eight zero bytes 
-        # (because that's what the bootloader is expecting...)
-        hex_size_array_lsb = uint32_to_bytes_le(len(self.bin_array))
-        zero_pad_array_le(hex_size_array_lsb, 8)
-        self._dfu_send_data(hex_size_array_lsb)
+            # Transmit softdevice, bootloader and application sizes
+            await self._dfu_send_data(struct.pack('<III', sd_size, bl_size, app_size))
 
-        # Wait for response to Image Size
-        print("Waiting for Image Size notification")
-        self._wait_and_parse_notify()
+            # Wait for response to Image Size
+            print("Waiting for Image Size notification")
+            await self._wait_and_parse_notify()
 
-        # Send 'INIT DFU' + Init Packet Command
-        self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x00])
+            # Send 'INIT DFU' + Init Packet Command
+            await self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x00])
 
-        # Transmit the Init image (DAT).
-        self._dfu_send_init()
+            # Transmit the Init image (DAT).
+            await self._dfu_send_init()
 
-        # Send 'INIT DFU' + Init Packet Complete Command
-        self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x01])
+            # Send 'INIT DFU' + Init Packet Complete Command
+            await self._dfu_send_command(Procedures.INITIALIZE_DFU, [0x01])
 
-        print("Waiting for INIT DFU notification")
-        # Wait for INIT DFU notification (indicates flash erase completed)
-        self._wait_and_parse_notify()
+            print("Waiting for INIT DFU notification")
+            # Wait for INIT DFU notification (indicates flash erase completed)
+            await self._wait_and_parse_notify()
 
         # Set the Packet Receipt Notification interval
         if verbose: print("Setting pkt receipt notification interval")
         prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.PRN_REQUEST, prn)
+        await self._dfu_send_command(Procedures.PRN_REQUEST, prn)
 
         # Send 'RECEIVE FIRMWARE IMAGE' command to set DFU in firmware receive state. 
-        self._dfu_send_command(Procedures.RECEIVE_FIRMWARE_IMAGE)
+        await self._dfu_send_command(Procedures.RECEIVE_FIRMWARE_IMAGE)
+
+        with self.instrumentation.phase('stream') as stream:
+            # Send the image contents as as series of packets (burst mode).
+            # Each segment is pkt_payload_size bytes long.
+            # For every pkt_receipt_interval sends, wait for notification.
+            segment_count = 0
+            segments_since_receipt = 0
+            segment_total = int(math.ceil(self.image_size/float(self.pkt_payload_size)))
+            time_start = time.time()
+
+            # Start of the current PRN batch and its first byte, when tracing
+            burst = (time.monotonic(), 0) if self.tracer is not None else None
+
+            # Once per packet: straight to the link
+            write_command = self.link.write_command
+
+            print("Begin DFU")
+            for i in range(0, self.image_size, self.pkt_payload_size):
+                segment = self.image.segment(i, i + self.pkt_payload_size)
+                await write_command(self.data_handle, segment)
+                segment_count += 1
+                segments_since_receipt += 1
+                stream.bytes = i + len(segment)
+
+                if burst is not None and (segment_count == segment_total or segments_since_receipt == self.pkt_receipt_interval):
+                    self.tracer.complete(self.trace_track, 'burst', burst[0], None, 'data', offset=burst[1], bytes=stream.bytes - burst[1])
+
+                if (segment_count == segment_total):
+                    print_progress(self.image_size, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+
+                    duration = time.time() - time_start
+                    print(f"\nUpload complete in {duration // 60} minutes and {int(duration) % 60} seconds")
+                    if verbose: print(f"segments sent: {segment_count}")
 
-        # Send bin_array contents as as series of packets (burst mode).
-        # Each segment is pkt_payload_size bytes long.
-        # For every pkt_receipt_interval sends, wait for notification.
-        segment_count = 0
-        segment_total = int(math.ceil(self.image_size/float(self.pkt_payload_size)))
-        time_start = time.time()
-        last_send_time = time.time()
-        print("Begin DFU")
-        for i in range(0, self.image_size, self.pkt_payload_size):
-            segment = self.bin_array[i:i + self.pkt_payload_size]
-            self._dfu_send_data(segment)
-            segment_count += 1
+                    if self.adaptive_prn is not None:
+                        self.prn_report = self.adaptive_prn.report()
+                        print(f"PRN intervals used: {self.prn_report['intervals']}, final: {self.prn_report['final']}")
 
-            print(f"segment #{segment_count} of {segment_total}, dt = {time.time() - last_send_time}")
-            # last_send_time = time.time()
+                    print("Waiting for DFU complete notification")
+                    # Wait for DFU complete notification
+                    await self._wait_and_parse_notify()
 
-            if (segment_count == segment_total):
-                print_progress(self.image_size, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+                elif segments_since_receipt == self.pkt_receipt_interval:
+                    batch_sent = time.monotonic()
 
-                duration = time.time() - time_start
-                print(f"\nUpload complete in {duration // 60} minutes and {int(duration) % 60} seconds")
-                if verbose: print(f"segments sent: {segment_count}")
+                    receipt = await self._wait_and_parse_notify()
+                    if not isinstance(receipt, PacketReceipt):
+                        procedure = Procedures.string_map.get(receipt.procedure, f'0x{receipt.procedure:02x}')
+                        raise Exception(f"Expected packet receipt, got a {procedure} response")
 
-                print("Waiting for DFU complete notification")
-                # Wait for DFU complete notification
-                self._wait_and_parse_notify()
+                    pkts = receipt.bytes_received
+                    segments_since_receipt = 0
 
-            elif (segment_count % self.pkt_receipt_interval) == 0:
-                (proc, res, pkts) = self._wait_and_parse_notify()
+                    # The receipt reports the number of image bytes received so far
+                    if pkts != segment_count * self.pkt_payload_size:
+                        raise Exception(f"bad packet receipt: {pkts} bytes received, {segment_count * self.pkt_payload_size} sent")
 
-                # TODO: Check pkts == segment_count * pkt_payload_size
+                    round_trip = time.monotonic() - batch_sent
+                    self.instrumentation.receipt(round_trip)
 
-                if res != Responses.SUCCESS:
-                    raise Exception(f"bad notification status: {Responses.to_string(res)}")
+                    # The legacy bootloader accepts a new interval at any time, the
+                    # receipt count restarts from the request
+                    if self.adaptive_prn is not None:
+                        self.adaptive_prn.on_receipt(round_trip)
 
-                print_progress(pkts, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+                        if self.adaptive_prn.interval != self.pkt_receipt_interval:
+                            self.pkt_receipt_interval = self.adaptive_prn.interval
+                            self.adaptive_prn.applied()
+                            await self._dfu_send_command(Procedures.PRN_REQUEST, uint16_to_bytes_le(self.pkt_receipt_interval))
+
+                    print_progress(pkts, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+
+                    if burst is not None:
+                        burst = (time.monotonic(), stream.bytes)
 
         # Send Validate Command
-        self._dfu_send_command(Procedures.VALIDATE_FIRMWARE)
+        with self.instrumentation.phase('validate'):
+            await self._dfu_send_command(Procedures.VALIDATE_FIRMWARE)
 
-        print("Waiting for Firmware Validation notification")
-        # Wait for Firmware Validation notification
-        self._wait_and_parse_notify()
+            print("Waiting for Firmware Validation notification")
+            # Wait for Firmware Validation notification
+            await self._wait_and_parse_notify()
 
         # Wait a bit for copy on the peer to be finished
-        time.sleep(1)
+        with self._trace('sleep', 'dfu'):
+            await asyncio.sleep(1)
 
         # Send Activate and Reset Command
         print("Activate and reset")
-        self._dfu_send_command(Procedures.ACTIVATE_IMAGE_AND_RESET)
+        with self.instrumentation.phase('activate'):
+            await self._dfu_send_command(Procedures.ACTIVATE_IMAGE_AND_RESET)
 
     # --------------------------------------------------------------------------
     #  Check if the peripheral is running in bootloader (DFU) or application mode
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
-    def check_DFU_mode(self):
+    async def check_DFU_mode_async(self):
         if verbose: print("Checking DFU State...")
 
-        cmd = 'char-read-uuid %s' % self.UUID_VERSION
-
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
+        version = await self._find_characteristic(self.UUID_VERSION)
+        if version is None:
+            return False
 
-        # Skip two rows
-        try:
-            res = self.ble_conn.expect('handle:.*', timeout=self.timeout)
-            # res = self.ble_conn.expect('handle:', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
+        value = await self.link.read(version.value_handle)
+        if value is None:
             print("State timeout")
-        except:
-            pass
+            return False
 
-        return self.ble_conn.after.find("value: 08 00")!=-1
+        # Bootloader reports DFU version 0.8
+        return value[0:2] == b'\x08\x00'
 
-    def switch_to_dfu_mode(self):
-        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
+    async def switch_to_dfu_mode_async(self):
+        (_, bl_value_handle, bl_cccd_handle) = await self._get_handles(self.UUID_CONTROL_POINT)
 
         # Enable notifications
-        cmd = 'char-write-req 0x{bl_cccd_handle:02x} 0x01'
-        if verbose: print(cmd)
-        self.ble_conn.sendline(cmd)
+        await self.link.write_request(bl_cccd_handle, b'\x01\x00', wait=False)
 
         # Reset the board in DFU mode. After reset the board will be disconnected
-        cmd = f'char-write-req 0x{bl_value_handle:02x} 0104'
-        if verbose: print(cmd)
-        self.ble_conn.sendline(cmd)
-
-        time.sleep(0.5)
+        await self.link.write_request(bl_value_handle, bytes([Procedures.START_DFU, 0x04]), wait=False)
 
         #print( "Send 'START DFU' + Application Command")
         #self._dfu_state_set(0x0104)
 
-        # Reconnect the board.
-        ret = self.scan_and_connect()
+        # Reconnect the board once the bootloader advertises at the same address
+        ret = await self._reconnect_after_reboot([self.target_mac], 0.5)
         if verbose: print(f"Connected {ret}")
 
         return ret
@@ -233,56 +295,43 @@ class BleDfuControllerLegacy(NrfBleDfuController):
     #  Parse notification status results
     # --------------------------------------------------------------------------
     def _dfu_parse_notify(self, notify):
-        if len(notify) < 3:
-            print("notify data length error")
-            return None
-
-        if verbose: print(notify)
-
-        dfu_notify_opcode = Procedures.from_string(notify[0])
+        result = decode_legacy(notify)
 
-        if dfu_notify_opcode == Procedures.RESPONSE:
-
-            dfu_procedure = Procedures.from_string(notify[1])
-            dfu_response  = Responses.from_string(notify[2])
-
-            procedure_str = Procedures.to_string(dfu_procedure)
-            response_str  = Responses.to_string(dfu_response)
-
-            if verbose: print(f"opcode: 0x{dfu_notify_opcode:02x}, proc: {procedure_str}, res: {response_str}")
+        if result is None:
+            if verbose: print(f"Ignoring notification {notify.hex()}")
+            return None
 
-            return (dfu_procedure, dfu_response)
+        if verbose: print(f"proc: {Procedures.to_string(result.procedure)}, res: {Responses.to_string(result.result)}")
 
-        if dfu_notify_opcode == Procedures.PACKET_RECEIPT_NOTIFICATION:
-            receipt = bytes_to_uint32_le(notify[1:5])
-            return (dfu_notify_opcode, Responses.SUCCESS, receipt)
+        return result
 
     # --------------------------------------------------------------------------
     #  Wait for a notification and parse the response
     # --------------------------------------------------------------------------
-    def _wait_and_parse_notify(self):
-        if verbose: print("Waiting for notification")
-        notify = self._dfu_wait_for_notify()
+    async def _wait_and_parse_notify(self):
+        while True:
+            if verbose: print("Waiting for notification")
+            notify = await self._dfu_wait_for_notify()
+
+            if notify is None:
+                raise Exception("No notification received")
 
-        if notify is None:
-            raise Exception("No notification received")
+            if verbose: print("Parsing notification")
 
-        if verbose: print("Parsing notification")
+            result = self._dfu_parse_notify(notify)
+            if result is not None:
+                break
 
-        result = self._dfu_parse_notify(notify)
-        if result[1] != Responses.SUCCESS:
-            raise Exception(f"Error in {Procedures.to_string(result[0])} procedure, reason: {Responses.to_string(result[1])}")
+        if result.result != Responses.SUCCESS:
+            raise Exception(f"Error in {Procedures.to_string(result.procedure)} procedure, reason: {Responses.to_string(result.result)}")
 
         return result
 
     #--------------------------------------------------------------------------
     # Send the Init info (*.dat file contents) to peripheral device.
     #--------------------------------------------------------------------------
-    def _dfu_send_init(self):
+    async def _dfu_send_init(self):
         if verbose: print("dfu_send_init")
 
-        # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
-
         # Transmit Init info
-        self._dfu_send_data(init_bin_array)
+        await self._dfu_send_data(self.init_data)
@@ -1,11 +1,14 @@
-import math
-import pexpect
+import hashlib
 import time
 
-from array import array
+from collections import deque
 from util  import *
 
+from crc_tracker            import CrcTracker
 from nrf_ble_dfu_controller import NrfBleDfuController
+from notify_decoder         import decode_secure
+from transfer_plan          import TransferPlan
+from transport              import ConnectionLost
 
 verbose = False
 
@@ -75,187 +78,241 @@ class BleDfuControllerSecure(NrfBleDfuController):
     UUID_CONTROL_POINT   = '8ec90001-f315-4f60-9fb8-838830daea50'
     UUID_PACKET          = '8ec90002-f315-4f60-9fb8-838830daea50'
 
+    kind                 = 'secure'
+    procedures           = Procedures
+
     # Constructor inherited from abstract base class
 
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
-    def start(self):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+    async def start_async(self):
+        self.image_hash = self._image_hash()
+
+        await self._dfu_open_session()
+
+        while True:
+            try:
+                with self.instrumentation.phase('init', bytes=len(self.init_data)):
+                    await self._dfu_send_init()
+                break
+            except ConnectionLost:
+                await self._dfu_reopen_session()
+
+        await self._dfu_send_image()
+
+    # --------------------------------------------------------------------------
+    #  Set up a connection for the transfer: handles, notifications and the
+    #  Packet Receipt Notification interval
+    # --------------------------------------------------------------------------
+    async def _dfu_open_session(self):
+        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = await self._get_handles(self.UUID_CONTROL_POINT)
+        (_, self.data_handle, _) = await self._get_handles(self.UUID_PACKET)
 
         if verbose:
             print(f'Control Point Handle: 0x{self.ctrlpt_handle:04x}, CCCD: 0x{self.ctrlpt_cccd_handle:04x}')
             print(f'Packet handle: 0x{self.data_handle:04x}')
 
         # Subscribe to notifications from Control Point characteristic
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+        await self._enable_notifications(self.ctrlpt_cccd_handle)
 
         # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
+        await self._dfu_set_prn()
 
-        self._dfu_send_init()
+    # --------------------------------------------------------------------------
+    #  Reconnect after link loss and set the new connection up
+    # --------------------------------------------------------------------------
+    async def _dfu_reopen_session(self):
+        while True:
+            await self._recover_link()
 
-        self._dfu_send_image()
+            try:
+                await self._dfu_open_session()
+                return
+            except ConnectionLost:
+                # Dropped again before the session was set up
+                pass
 
     # --------------------------------------------------------------------------
     #  Check if the peripheral is running in bootloader (DFU) or application mode
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
-    def check_DFU_mode(self):
+    async def check_DFU_mode_async(self):
         print("Checking DFU State...")
 
-        self.ble_conn.sendline('characteristics')
+        return await self._find_characteristic(self.UUID_BUTTONLESS) is None
 
-        dfu_mode = False
+    async def switch_to_dfu_mode_async(self):
+        (_, bl_value_handle, bl_cccd_handle) = await self._get_handles(self.UUID_BUTTONLESS)
 
-        try:
-            self.ble_conn.expect([self.UUID_BUTTONLESS], timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
-            dfu_mode = True
-
-        return dfu_mode
-
-    def switch_to_dfu_mode(self):
-        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_BUTTONLESS)
-
-        self._enable_notifications(bl_cccd_handle)
+        await self._enable_notifications(bl_cccd_handle)
 
         # Reset the board in DFU mode. After reset the board will be disconnected
-        cmd = f'char-write-req 0x{bl_value_handle:04x} 01'
-        self.ble_conn.sendline(cmd)
+        await self.link.write_request(bl_value_handle, b'\x01', wait=False)
 
-        # Wait some time for board to reboot
-        time.sleep(0.5)
-
-        # Increase the mac address by one and reconnect
-        self.target_mac_increase(1)
-        return self.scan_and_connect()
+        # The bootloader advertises at the mac address increased by one (or,
+        # depending on its configuration, at the same address)
+        dfu_mac = uint_to_mac_string(mac_string_to_uint(self.target_mac) + 1)
+        return await self._reconnect_after_reboot([dfu_mac, self.target_mac], 0.5)
 
     # --------------------------------------------------------------------------
     #  Parse notification status results
     # --------------------------------------------------------------------------
     def _dfu_parse_notify(self, notify):
-        if len(notify) < 3:
-            print("notify data length error")
+        result = decode_secure(notify)
+
+        if result is None:
+            if verbose: print(f"Ignoring notification {notify.hex()}")
             return None
 
-        if verbose: print(notify)
+        if verbose: print(f"proc: {Procedures.to_string(result.procedure)}, res: {Results.to_string(result.result)}")
 
-        dfu_notify_opcode = Procedures.from_string(notify[0])
-        if dfu_notify_opcode == Procedures.RESPONSE:
+        return result
 
-            dfu_procedure = Procedures.from_string(notify[1])
-            dfu_result  = Results.from_string(notify[2])
+    # --------------------------------------------------------------------------
+    #  Wait for a notification and parse the response.
+    #  If procedure is given, responses to other procedures (e.g. receipts
+    #  left over from an aborted object) are skipped.
+    # --------------------------------------------------------------------------
+    async def _wait_and_parse_notify(self, procedure=None):
+        while True:
+            if verbose: print("Waiting for notification")
+            notify = await self._dfu_wait_for_notify()
 
-            procedure_str = Procedures.to_string(dfu_procedure)
-            result_str  = Results.to_string(dfu_result)
+            if notify is None:
+                raise Exception("No notification received")
 
-            if verbose: print(f"opcode: 0x{dfu_notify_opcode:02x}, proc: {procedure_str}, res: {result_str}")
+            if verbose: print("Parsing notification")
 
-            # Packet Receipt notifications are sent in the exact same format
-            # as responses to the CALC_CHECKSUM procedure.
-            if(dfu_procedure == Procedures.CALC_CHECKSUM and dfu_result == Results.SUCCESS):
-                offset = bytes_to_uint32_le(notify[3:7])
-                crc32 = bytes_to_uint32_le(notify[7:11])
+            result = self._dfu_parse_notify(notify)
+            if result is None:
+                continue
 
-                return (dfu_procedure, dfu_result, offset, crc32)
+            if procedure is None or result.procedure == procedure:
+                break
 
-            elif(dfu_procedure == Procedures.SELECT and dfu_result == Results.SUCCESS):
-                max_size = bytes_to_uint32_le(notify[3:7])
-                offset = bytes_to_uint32_le(notify[7:11])
-                crc32 = bytes_to_uint32_le(notify[11:15])
+            if verbose: print(f"Skipping stale {Procedures.to_string(result.procedure)} response")
 
-                return (dfu_procedure, dfu_result, max_size, offset, crc32)
+        if result.result != Results.SUCCESS:
+            raise Exception(f"Error in {Procedures.to_string(result.procedure)} procedure, reason: {Results.to_string(result.result)}")
 
-            else:
-                return (dfu_procedure, dfu_result)
+        return result
 
     # --------------------------------------------------------------------------
-    #  Wait for a notification and parse the response
+    #  Identifies the image (init packet + firmware) in the resume journal
     # --------------------------------------------------------------------------
-    def _wait_and_parse_notify(self):
-        if verbose: print("Waiting for notification")
-        notify = self._dfu_wait_for_notify()
+    def _image_hash(self):
+        image_hash = hashlib.sha256(self.init_data)
+        image_hash.update(self.image.view)
 
-        if notify is None:
-            raise Exception("No notification received")
+        return image_hash.hexdigest()
 
-        if verbose: print("Parsing notification")
-
-        result = self._dfu_parse_notify(notify)
-        if result[1] != Results.SUCCESS:
-            raise Exception(f"Error in {Procedures.to_string(result[0])} procedure, reason: {Results.to_string(result[1])}")
+    # --------------------------------------------------------------------------
+    #  Send the Packet Receipt Notification interval, taking it from the
+    #  adaptive controller when one is configured.
+    # --------------------------------------------------------------------------
+    async def _dfu_set_prn(self):
+        if self.adaptive_prn is not None:
+            self.pkt_receipt_interval = self.adaptive_prn.interval
+            self.adaptive_prn.applied()
 
-        return result
+        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
+        await self._dfu_send_command(Procedures.SET_PRN, prn)
+        await self._wait_and_parse_notify(Procedures.SET_PRN)
 
     # --------------------------------------------------------------------------
     #  Send the Init info (*.dat file contents) to peripheral device.
+    #  An init packet the device already holds is executed without re-sending,
+    #  a partially sent one is completed if its CRC checks out.
     # --------------------------------------------------------------------------
-    def _dfu_send_init(self):
+    async def _dfu_send_init(self):
         if verbose: print("dfu_send_init")
 
-        # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
-        init_size = len(init_bin_array)
-        init_crc = 0
+        init_data = memoryview(self.init_data)
+        init_size = len(init_data)
+        init_crc = CrcTracker(init_data)
 
         # Select command
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND])
-        (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
+        await self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND])
+        select = await self._wait_and_parse_notify(Procedures.SELECT)
+        (offset, crc32) = (select.offset, select.crc32)
 
-        if offset != init_size or crc32 != init_crc:
-            if offset == 0 or offset > init_size:
+        if offset == init_size and init_crc.verify(offset, crc32):
+            print("Init packet already on the device")
+
+        else:
+            if offset == 0 or offset > init_size or not init_crc.verify(offset, crc32):
                 # Create command
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_COMMAND] + uint32_to_bytes_le(init_size))
-                res = self._wait_and_parse_notify()
+                await self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_COMMAND] + uint32_to_bytes_le(init_size))
+                await self._wait_and_parse_notify(Procedures.CREATE)
+                offset = 0
 
             segment_count = 0
-            segment_total = int(math.ceil(init_size/float(self.pkt_payload_size)))
 
-            for i in range(0, init_size, self.pkt_payload_size):
-                segment = init_bin_array[i:i + self.pkt_payload_size]
-                self._dfu_send_data(segment)
+            for i in range(offset, init_size, self.pkt_payload_size):
+                segment = init_data[i:i + self.pkt_payload_size]
+                await self._dfu_send_data(segment)
                 segment_count += 1
 
-                if (segment_count % self.pkt_receipt_interval) == 0:
-                    (proc, res, offset, crc32) = self._wait_and_parse_notify()
+                if self.pkt_receipt_interval and (segment_count % self.pkt_receipt_interval) == 0:
+                    receipt = await self._wait_and_parse_notify(Procedures.CALC_CHECKSUM)
 
-                    if res != Results.SUCCESS:
-                        raise Exception(f"bad notification status: {Results.to_string(res)}")
+                    if not init_crc.verify(receipt.offset, receipt.crc32):
+                        raise Exception("Init packet CRC mismatch")
 
             # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            self._wait_and_parse_notify()
+            await self._dfu_send_command(Procedures.CALC_CHECKSUM)
+            checksum = await self._wait_and_parse_notify(Procedures.CALC_CHECKSUM)
+
+            if checksum.offset != init_size or not init_crc.verify(checksum.offset, checksum.crc32):
+                raise Exception("Init packet CRC mismatch")
 
         # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
-        self._wait_and_parse_notify()
+        await self._dfu_send_command(Procedures.EXECUTE)
+        await self._wait_and_parse_notify(Procedures.EXECUTE)
 
         print("Init packet successfully transfered")
 
     # --------------------------------------------------------------------------
     #  Send the Firmware image to peripheral device.
     # --------------------------------------------------------------------------
-    def _dfu_send_image(self):
+    async def _dfu_send_image(self):
         if verbose: print("dfu_send_image")
 
-        # Select Data Object
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_DATA])
-        (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
+        (max_size, offset, crc32) = await self._dfu_select_image()
 
         # Split the firmware into multiple objects
-        num_objects = int(math.ceil(self.image_size / float(max_size)))
-        print(f"Max object size: {max_size}, num objects: {num_objects}, offset: {offset}, total size: {self.image_size}")
+        self.plan = self._transfer_plan(max_size)
+        print(f"Max object size: {max_size}, num objects: {len(self.plan.objects)}, offset: {offset}, total size: {self.image_size}")
 
         time_start = time.time()
         last_send_time = time.time()
 
-        obj_offset = (offset // max_size) * max_size
+        self.image_crc = CrcTracker(self.image.view, self.plan.checkpoints())
+
+        obj_offset = await self._dfu_recover_image(max_size, offset, crc32)
+
         while(obj_offset < self.image_size):
-            # print("\nSending object {} of {}".format(obj_offset/max_size+1, num_objects))
-            obj_offset += self._dfu_send_object(obj_offset, max_size)
+            # print("\nSending object {} of {}".format(obj_offset/max_size+1, len(self.plan.objects)))
+            try:
+                if self.adaptive_prn is not None and self.adaptive_prn.interval != self.pkt_receipt_interval:
+                    await self._dfu_set_prn()
+
+                sent = await self._dfu_send_object(obj_offset)
+
+            except ConnectionLost:
+                obj_offset = await self._dfu_resume_image()
+                continue
+
+            if sent == 0:
+                # Object failed verification, restart from the last executed object
+                self.instrumentation.retransmit()
+                obj_offset = self.image_crc.rollback()
+            else:
+                obj_offset += sent
+
+        if self.resume_journal is not None:
+            self.resume_journal.clear(self.target_mac, self.image_hash)
 
         # Image uploaded successfully, update the progress bar
         print_progress(self.image_size, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
@@ -263,57 +320,214 @@ class BleDfuControllerSecure(NrfBleDfuController):
         duration = time.time() - time_start
         print(f"\nUpload complete in {duration // 60} minutes and {int(duration) % 60} seconds")
 
+        self._print_reconnects()
+
+        if self.adaptive_prn is not None:
+            self.prn_report = self.adaptive_prn.report()
+            print(f"PRN intervals used: {self.prn_report['intervals']}, final: {self.prn_report['final']}")
+
+    # --------------------------------------------------------------------------
+    #  Select the data object. Returns (max object size, offset, crc32) of
+    #  what the device holds.
+    # --------------------------------------------------------------------------
+    async def _dfu_select_image(self):
+        await self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_DATA])
+        select = await self._wait_and_parse_notify(Procedures.SELECT)
+
+        return (select.max_size, select.offset, select.crc32)
+
+    # --------------------------------------------------------------------------
+    #  Continue the transfer on a new connection after link loss: select the
+    #  data object again and resume from what the device verifiably holds.
+    #  Returns the offset to continue from.
+    # --------------------------------------------------------------------------
+    async def _dfu_resume_image(self):
+        while True:
+            await self._dfu_reopen_session()
+
+            try:
+                (max_size, offset, crc32) = await self._dfu_select_image()
+
+                # The new link may have come up with a different MTU
+                if (self.plan.max_size, self.plan.payload_size) != (max_size, self.pkt_payload_size):
+                    self.plan = self._transfer_plan(max_size)
+
+                return await self._dfu_recover_image(max_size, offset, crc32)
+
+            except ConnectionLost:
+                pass
+
     # --------------------------------------------------------------------------
-    #  Send a single data object of given size and offset.
+    #  Work out where to continue from the data object SELECT response.
+    #
+    #  Data the device holds is only kept if its CRC matches the image. A
+    #  complete object at an object boundary is executed unless it already
+    #  was in this session or, per the resume journal, in an earlier one.
+    #  Returns the offset to continue from; a CREATE on the device always
+    #  restarts at its last executed object.
     # --------------------------------------------------------------------------
-    def _dfu_send_object(self, offset, obj_max_size):
-        if offset != self.image_size:
-            if offset == 0 or offset >= obj_max_size or crc32 != crc32_unsigned(self.bin_array[0:offset]):
-                # Create Data Object
-                size = min(obj_max_size, self.image_size - offset)
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_DATA] + uint32_to_bytes_le(size))
-                self._wait_and_parse_notify()
+    async def _dfu_recover_image(self, max_size, offset, crc32):
+        if offset == 0 or offset > self.image_size:
+            return 0
+
+        remainder = offset % max_size
+
+        if not self.image_crc.verify(offset, crc32):
+            # The object in progress doesn't belong to this image, send it again
+            offset -= remainder or max_size
+            self.image_crc.commit(offset)
 
+            print(f"Device CRC mismatch, resuming from offset {offset}")
+            return offset
+
+        if remainder != 0 and offset != self.image_size:
+            # Finish the partially sent object without re-creating it
+            self.image_crc.commit(offset - remainder)
+
+            print(f"Resuming inside object at offset {offset}")
+            return offset
+
+        entry = None
+        if self.resume_journal is not None:
+            entry = self.resume_journal.lookup(self.target_mac, self.image_hash)
+
+        executed = offset == self.image_crc.verified_offset or \
+                   (entry is not None and entry['offset'] == offset and entry['crc'] == crc32)
+
+        if not executed:
+            # Complete object that may not have been executed yet
+            await self._dfu_send_command(Procedures.EXECUTE)
+            await self._wait_and_parse_notify(Procedures.EXECUTE)
+
+            self._dfu_journal_object(offset)
+
+        self.image_crc.commit(offset)
+
+        print(f"Resuming from offset {offset}")
+        return offset
+
+    # --------------------------------------------------------------------------
+    #  Record an executed object boundary in the resume journal
+    # --------------------------------------------------------------------------
+    def _dfu_journal_object(self, offset):
+        if self.resume_journal is not None:
+            self.resume_journal.record_object(self.target_mac, self.image_hash, offset, self.image_crc.crc_at(offset))
+
+    # --------------------------------------------------------------------------
+    #  The transfer plan for this image and the object size the device
+    #  reported, shared through plan_cache when one is configured.
+    # --------------------------------------------------------------------------
+    def _transfer_plan(self, max_size):
+        with self._trace('plan', 'crc', max_size=max_size):
+            if self.plan_cache is not None:
+                return self.plan_cache.get(self.image, max_size, self.pkt_payload_size, self.pkt_receipt_interval)
+
+            return TransferPlan.build(self.image, max_size, self.pkt_payload_size, self.pkt_receipt_interval)
+
+    # --------------------------------------------------------------------------
+    #  Send the data object containing offset, from offset on.
+    #
+    #  Packets are streamed without stopping for each receipt: up to
+    #  max_pending_receipts PRN batches may be on the air before the oldest
+    #  receipt has to be checked, which bounds how far the sender can get
+    #  ahead of the bootloader's buffers. Any mismatch rolls back to the last
+    #  executed object. With a PRN interval of 0 the device sends no receipts
+    #  and the object is only checked by CALC_CHECKSUM at its end.
+    # --------------------------------------------------------------------------
+    async def _dfu_send_object(self, offset):
+        obj = self.plan.object_at(offset)
+        timing = self.instrumentation
+
+        if offset == obj.begin:
+            # Create Data Object
+            with timing.phase('create', offset=obj.begin):
+                await self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_DATA] + uint32_to_bytes_le(obj.size))
+                await self._wait_and_parse_notify(Procedures.CREATE)
+
+        with timing.phase('stream', offset=obj.begin) as stream:
             segment_count = 0
-            segment_total = int(math.ceil(min(obj_max_size, self.image_size-offset)/float(self.pkt_payload_size)))
 
-            segment_begin = offset
-            segment_end = min(offset+obj_max_size, self.image_size)
+            # Send time of each PRN batch whose receipt hasn't been checked yet
+            pending_receipts = deque()
 
-            for i in range(segment_begin, segment_end, self.pkt_payload_size):
-                num_bytes = min(self.pkt_payload_size, segment_end - i)
-                segment = self.bin_array[i:i + num_bytes]
-                self._dfu_send_data(segment)
+            # Start of the current PRN batch and its first byte, when tracing
+            burst = (time.monotonic(), offset) if self.tracer is not None else None
+
+            # Once per packet: straight to the link
+            write_command = self.link.write_command
+
+            for (begin, end) in obj.segments(offset):
+                await write_command(self.data_handle, self.image.segment(begin, end))
                 segment_count += 1
+                stream.bytes = end - offset
 
-                # print(f"j: {offset} i: {i}, end: {segment_end}, bytes: {num_bytes}, size: {self.image_size} segment #{segment_count} of {segment_total}")
+                if self.pkt_receipt_interval and (segment_count % self.pkt_receipt_interval) == 0:
+                    pending_receipts.append(time.monotonic())
 
-                if (segment_count % self.pkt_receipt_interval) == 0:
-                    try:
-                        (proc, res, offset, crc32) = self._wait_and_parse_notify()
-                    except e:
-                        # Likely no notification received, need to re-transmit object
-                        return 0
+                    if burst is not None:
+                        self.tracer.complete(self.trace_track, 'burst', burst[0], pending_receipts[-1], 'data', offset=burst[1], bytes=end - burst[1])
 
-                    if res != Results.SUCCESS:
-                        raise Exception(f"bad notification status: {Results.to_string(res)}")
+                    while len(pending_receipts) >= self.max_pending_receipts:
+                        if not await self._dfu_check_receipt(pending_receipts.popleft()):
+                            # Something went wrong, need to re-transmit this object
+                            return 0
 
-                    if crc32 != crc32_unsigned(self.bin_array[0:offset]):
-                        # Something went wrong, need to re-transmit this object
-                        return 0
+                    if burst is not None:
+                        burst = (time.monotonic(), end)
 
-                    print_progress(offset, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+            if burst is not None and burst[1] < obj.end:
+                self.tracer.complete(self.trace_track, 'burst', burst[0], None, 'data', offset=burst[1], bytes=obj.end - burst[1])
 
-            # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            (proc, res, offset, crc32) = self._wait_and_parse_notify()
-            if(crc32 != crc32_unsigned(self.bin_array[0:offset])):
-                # Need to re-transmit object
-                return 0
+            # All receipts have to be in before the checksum response
+            while pending_receipts:
+                if not await self._dfu_check_receipt(pending_receipts.popleft()):
+                    return 0
+
+        # Calculate CRC
+        with timing.phase('checksum', offset=obj.begin):
+            await self._dfu_send_command(Procedures.CALC_CHECKSUM)
+            checksum = await self._wait_and_parse_notify(Procedures.CALC_CHECKSUM)
+
+        if checksum.offset != obj.end or checksum.crc32 != obj.crc:
+            # Need to re-transmit object
+            return 0
 
         # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
-        self._wait_and_parse_notify()
+        with timing.phase('execute', offset=obj.begin):
+            await self._dfu_send_command(Procedures.EXECUTE)
+            await self._wait_and_parse_notify(Procedures.EXECUTE)
+
+        self.image_crc.commit(obj.end)
+        self._dfu_journal_object(obj.end)
 
         # If everything executed correctly, return amount of bytes transfered
-        return obj_max_size
+        return obj.end - offset
+
+    # --------------------------------------------------------------------------
+    #  Wait for the oldest outstanding Packet Receipt Notification and check
+    #  it against the image CRC. Returns False if the object must be re-sent.
+    # --------------------------------------------------------------------------
+    async def _dfu_check_receipt(self, batch_sent):
+        with self._trace('receipt', 'receipt'):
+            try:
+                receipt = await self._wait_and_parse_notify(Procedures.CALC_CHECKSUM)
+            except ConnectionLost:
+                raise
+            except Exception as e:
+                # Likely no notification received (or INSUFFICIENT_RESOURCES)
+                if verbose: print(e)
+                if self.adaptive_prn is not None: self.adaptive_prn.on_error()
+                return False
+
+            if not self.image_crc.verify(receipt.offset, receipt.crc32):
+                if self.adaptive_prn is not None: self.adaptive_prn.on_error()
+                return False
+
+            round_trip = time.monotonic() - batch_sent
+
+            self.instrumentation.receipt(round_trip)
+            if self.adaptive_prn is not None: self.adaptive_prn.on_receipt(round_trip)
+
+            print_progress(receipt.offset, self.image_size, prefix = 'Progress:', suffix = 'Complete', barLength = 50)
+
+            return True
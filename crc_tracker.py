@@ -0,0 +1,75 @@
+import binascii
+
+from bisect import bisect_right
+
+# ------------------------------------------------------------------------------
+#  Running CRC32 over a firmware (or init) image.
+#
+#  Every offset that has been hashed is kept as a checkpoint, so checking a
+#  device-reported (offset, crc) pair only hashes the bytes between the
+#  nearest known checkpoint and the requested offset instead of the whole
+#  prefix. The last offset confirmed by the peer (CALC_CHECKSUM + EXECUTE)
+#  is remembered so a failed object can be rolled back to it.
+#
+#  Known (offset, crc) pairs, e.g. precomputed object boundaries, can be
+#  passed in as initial checkpoints.
+# ------------------------------------------------------------------------------
+class CrcTracker(object):
+
+    def __init__(self, data, checkpoints=()):
+        self.data = memoryview(data)
+        self.size = len(self.data)
+
+        self._offsets = [0]
+        self._crcs    = [0]
+
+        for (offset, crc) in sorted(checkpoints):
+            if 0 < offset <= self.size and offset > self._offsets[-1]:
+                self._offsets.append(offset)
+                self._crcs.append(crc)
+
+        self.verified_offset = 0
+        self.verified_crc    = 0
+
+    # --------------------------------------------------------------------------
+    #  Unsigned CRC32 of data[0:offset]
+    # --------------------------------------------------------------------------
+    def crc_at(self, offset):
+        if offset < 0 or offset > self.size:
+            raise ValueError(f"offset {offset} outside image of {self.size} bytes")
+
+        index = bisect_right(self._offsets, offset) - 1
+        start = self._offsets[index]
+        crc   = self._crcs[index]
+
+        if start == offset:
+            return crc
+
+        crc = binascii.crc32(self.data[start:offset], crc) & 0xFFFFFFFF
+
+        self._offsets.insert(index + 1, offset)
+        self._crcs.insert(index + 1, crc)
+
+        return crc
+
+    # --------------------------------------------------------------------------
+    #  Check a (offset, crc) pair reported by the peer against the image
+    # --------------------------------------------------------------------------
+    def verify(self, offset, crc):
+        if offset > self.size:
+            return False
+
+        return self.crc_at(offset) == crc
+
+    # --------------------------------------------------------------------------
+    #  Mark offset as verified (object executed by the peer)
+    # --------------------------------------------------------------------------
+    def commit(self, offset):
+        self.verified_crc    = self.crc_at(offset)
+        self.verified_offset = offset
+
+    # --------------------------------------------------------------------------
+    #  Return the last verified offset, to re-transmit everything after it
+    # --------------------------------------------------------------------------
+    def rollback(self):
+        return self.verified_offset
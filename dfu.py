@@ -12,7 +12,19 @@ import time
 import math
 import traceback
 
-from unpacker import Unpacker
+from unpacker  import DfuPackage
+from transport import TRANSPORT_NAMES, create_transport
+
+from prn_controller import AdaptivePrn
+from gatt_cache     import GattCache
+from resume_journal import ResumeJournal
+from transfer_plan  import PlanCache
+from intel_hex      import HexCache
+from artifact_cache import ArtifactCache
+from scan           import LiveScanner
+from instrumentation import save_report, report_path
+from metrics        import record_to_textfile
+from tracing        import Tracer
 
 from ble_secure_dfu_controller import BleDfuControllerSecure
 from ble_legacy_dfu_controller import BleDfuControllerLegacy
@@ -67,6 +79,54 @@ def main():
                   help='zip file to be used.'
                   )
 
+        parser.add_option('--url',
+                  action='store',
+                  dest='url',
+                  type='string',
+                  default=None,
+                  help='URL of a zip file, downloaded into the artifact cache unless the server reports it unchanged since it was fetched'
+                  )
+
+        parser.add_option('--refresh',
+                  action='store_true',
+                  dest='refresh',
+                  default=False,
+                  help='download --url again even if it was fetched before'
+                  )
+
+        parser.add_option('--artifact',
+                  action='store',
+                  dest='artifact',
+                  type='string',
+                  default=None,
+                  help='SHA-256 (or a unique prefix) of a zip file in the artifact cache; with --url, the hash the download must have'
+                  )
+
+        parser.add_option('--artifact-cache',
+                  action='store',
+                  dest='artifact_cache',
+                  type='string',
+                  default=ArtifactCache.default_path(),
+                  help='directory keeping unpacked zip files and their transfer plans, by file hash'
+                  )
+
+        parser.add_option('--cache-budget',
+                  action='store',
+                  dest='cache_budget',
+                  type='int',
+                  default=ArtifactCache.default_budget // (1024 * 1024),
+                  help='MiB the artifact cache may use before least recently used entries are removed'
+                  )
+
+        parser.add_option('--image-type',
+                  action='store',
+                  dest='image_type',
+                  type='choice',
+                  choices=DfuPackage.IMAGE_TYPES,
+                  default=None,
+                  help='image of the zip file to send: ' + ', '.join(DfuPackage.IMAGE_TYPES) + ' (default: the application)'
+                  )
+
         parser.add_option('--ruuvitag',
                   action='store',
                   dest='ruuvitag',
@@ -87,6 +147,177 @@ def main():
                   help='Use secure bootloader (Nordic SDK < 12)'
                   )
 
+        parser.add_option('--transport',
+                  action='store',
+                  dest='transport',
+                  type='choice',
+                  choices=TRANSPORT_NAMES,
+                  default='gatttool',
+                  help='BLE transport: gatttool (default) or socket (native L2CAP ATT socket)'
+                  )
+
+        parser.add_option('-i', '--adapter',
+                  action='store',
+                  dest='adapter',
+                  type='string',
+                  default=None,
+                  help='Bluetooth adapter to use, e.g. hci1 (default: system default); with --daemon, a comma separated list'
+                  )
+
+        parser.add_option('--scan',
+                  action='store_true',
+                  dest='scan',
+                  default=False,
+                  help='scan continuously and only connect to devices seen advertising, in the mode they advertise'
+                  )
+
+        parser.add_option('--mtu',
+                  action='store',
+                  dest='mtu',
+                  type='int',
+                  default=247,
+                  help='ATT MTU to request at connect time (23 disables negotiation)'
+                  )
+
+        parser.add_option('--prn',
+                  action='store',
+                  dest='prn',
+                  type='int',
+                  default=None,
+                  help='Packet Receipt Notification interval (packets per receipt, 0 disables receipts)'
+                  )
+
+        parser.add_option('--adaptive-prn',
+                  action='store_true',
+                  dest='adaptive_prn',
+                  default=False,
+                  help='Adapt the PRN interval to link quality, starting from --prn (default 4)'
+                  )
+
+        parser.add_option('--window',
+                  action='store',
+                  dest='window',
+                  type='int',
+                  default=None,
+                  help='PRN batches in flight before waiting for a receipt (1 = stop-and-wait)'
+                  )
+
+        parser.add_option('--gatt-cache',
+                  action='store',
+                  dest='gatt_cache',
+                  type='string',
+                  default=GattCache.default_path(),
+                  help='file caching discovered GATT handles per device and firmware version'
+                  )
+
+        parser.add_option('--no-gatt-cache',
+                  action='store_const',
+                  dest='gatt_cache',
+                  const=None,
+                  help='always run GATT discovery'
+                  )
+
+        parser.add_option('--journal',
+                  action='store',
+                  dest='journal',
+                  type='string',
+                  default=ResumeJournal.default_path(),
+                  help='file recording verified progress, used to resume interrupted secure DFU'
+                  )
+
+        parser.add_option('--no-journal',
+                  action='store_const',
+                  dest='journal',
+                  const=None,
+                  help='do not keep a resume journal'
+                  )
+
+        parser.add_option('--hex-cache',
+                  action='store',
+                  dest='hex_cache',
+                  type='string',
+                  default=HexCache.default_path(),
+                  help='directory keeping .hex files converted to binary, by file hash'
+                  )
+
+        parser.add_option('--no-hex-cache',
+                  action='store_const',
+                  dest='hex_cache',
+                  const=None,
+                  help='convert .hex files on every run'
+                  )
+
+        parser.add_option('--plan-dir',
+                  action='store',
+                  dest='plan_dir',
+                  type='string',
+                  default=None,
+                  help='directory keeping secure DFU transfer plans for reuse with the same image'
+                  )
+
+        parser.add_option('--report',
+                  action='store',
+                  dest='report',
+                  type='string',
+                  default=None,
+                  help='write a JSON report of the update (phase timings, receipt round trips, retransmits) to this file'
+                  )
+
+        parser.add_option('--report-dir',
+                  action='store',
+                  dest='report_dir',
+                  type='string',
+                  default=None,
+                  help='write the JSON report of each update to <dir>/<MAC>-<time>.json, also with --daemon'
+                  )
+
+        parser.add_option('--trace',
+                  action='store',
+                  dest='trace',
+                  type='string',
+                  default=None,
+                  help='write a timeline of the update (commands, notifications, data bursts, waits) to this file as Chrome trace JSON, for ui.perfetto.dev'
+                  )
+
+        parser.add_option('--metrics-textfile',
+                  action='store',
+                  dest='metrics_textfile',
+                  type='string',
+                  default=None,
+                  help='add the update to Prometheus metrics in this node-exporter textfile (*.prom), also with --daemon'
+                  )
+
+        parser.add_option('--metrics-port',
+                  action='store',
+                  dest='metrics_port',
+                  type='int',
+                  default=None,
+                  help='with --daemon, serve Prometheus metrics at http://localhost:<port>/metrics'
+                  )
+
+        parser.add_option('--daemon',
+                  action='store_true',
+                  dest='daemon',
+                  default=False,
+                  help='run jobs submitted with dfu_client.py until stopped'
+                  )
+
+        parser.add_option('--socket',
+                  action='store',
+                  dest='socket',
+                  type='string',
+                  default=None,
+                  help='Unix socket the daemon listens on (default: $XDG_RUNTIME_DIR/ota-dfu.sock, /run/ota-dfu.sock for root)'
+                  )
+
+        parser.add_option('--per-adapter',
+                  action='store',
+                  dest='per_adapter',
+                  type='int',
+                  default=1,
+                  help='jobs the daemon runs at once on each adapter'
+                  )
+
         options, args = parser.parse_args()
 
     except Exception as e:
@@ -94,31 +325,63 @@ def main():
         print("For help use --help")
         sys.exit(2)
 
+    if options.prn is not None and options.prn < 0:
+        print("PRN interval must be 0 (receipts disabled) or more")
+        sys.exit(2)
+
     try:
 
+        if options.daemon:
+            # Imported here, the daemon builds on fleet, which imports this module
+            import dfu_daemon
+            dfu_daemon.serve(options)
+            return
+
         ''' Validate input parameters '''
 
         if not options.address:
             parser.print_help()
             sys.exit(2)
 
-        unpacker = None
+        package  = None
         hexfile  = None
         datfile  = None
+        artifact = None
+
+        if (options.url != None) or (options.artifact != None):
+
+            if (options.zipfile != None) or (options.hexfile != None) or (options.datfile != None):
+                print("Conflicting input directives")
+                sys.exit(2)
+
+            cache = ArtifactCache(options.artifact_cache, options.cache_budget * 1024 * 1024)
 
-        if options.zipfile != None:
+            try:
+                if options.url != None:
+                    artifact = cache.fetch(options.url, options.artifact, options.refresh)
+                else:
+                    artifact = cache.resolve(options.artifact)
+                    if artifact is None:
+                        raise Exception(f"{options.artifact} is not in {cache.path}")
+
+                package = cache.load(artifact, options.image_type)
+            except Exception as e:
+                print(f"Failed to get artifact: {e}")
+                sys.exit(2)
+
+            print(f"Artifact {artifact}")
+
+        elif options.zipfile != None:
 
             if (options.hexfile != None) or (options.datfile != None):
                 print("Conflicting input directives")
                 sys.exit(2)
 
             try:
-                unpacker = Unpacker()
-                hexfile, datfile = unpacker.unpack_zipfile(options.zipfile)	
+                package = DfuPackage(options.zipfile).load(options.image_type)
             except Exception as e:
                 print(f"Failed to unpack zip: {e}")
                 sys.exit(2)
-                pass
 
         else:
             if (not options.hexfile) or (not options.datfile):
@@ -139,45 +402,95 @@ def main():
 
         ''' Start of Device Firmware Update processing '''
 
+        transport = create_transport(options.transport, options.address.upper(), options.adapter)
+
         if options.ruuvitag is not None:
-            ble_dfu = BleDfuControllerRuuvitag(options.address.upper(), hexfile, datfile, options.ruuvitag)
+            ble_dfu = BleDfuControllerRuuvitag(options.address.upper(), hexfile, datfile, options.ruuvitag, transport)
         elif options.secure_dfu:
-            ble_dfu = BleDfuControllerSecure(options.address.upper(), hexfile, datfile)
+            ble_dfu = BleDfuControllerSecure(options.address.upper(), hexfile, datfile, transport)
         else:
-            ble_dfu = BleDfuControllerLegacy(options.address.upper(), hexfile, datfile)
+            ble_dfu = BleDfuControllerLegacy(options.address.upper(), hexfile, datfile, transport)
+
+        if package is not None:
+            ble_dfu.use_image(package.firmware, package.init, package.type, package.sizes)
+
+        ble_dfu.att_mtu = options.mtu
+
+        if options.gatt_cache is not None:
+            ble_dfu.gatt_cache = GattCache(options.gatt_cache)
+
+        if options.journal is not None:
+            ble_dfu.resume_journal = ResumeJournal(options.journal)
+
+        if options.plan_dir is not None:
+            ble_dfu.plan_cache = PlanCache(options.plan_dir)
+        elif artifact is not None:
+            ble_dfu.plan_cache = cache.plan_cache(artifact)
+
+        if options.hex_cache is not None:
+            ble_dfu.hex_cache = HexCache(options.hex_cache)
+
+        # A PRN of 0 disables receipts, and with them adapting the interval
+        if options.adaptive_prn and options.prn != 0:
+            ble_dfu.adaptive_prn = AdaptivePrn(initial=options.prn or 4)
+        elif options.prn is not None:
+            ble_dfu.pkt_receipt_interval = options.prn
+
+        if options.window is not None:
+            ble_dfu.max_pending_receipts = max(options.window, 1)
+
+        tracer = None
+        if options.trace is not None:
+            tracer = Tracer()
+            ble_dfu.use_tracer(tracer)
 
         # Initialize inputs
         ble_dfu.input_setup()
 
-        # Connect to peer device. Assume application mode.
-        if ble_dfu.scan_and_connect():
-            if not ble_dfu.check_DFU_mode():
-                print("Need to switch to DFU mode")
-                if not ble_dfu.switch_to_dfu_mode():
-                    raise Exception("Failed to switch to DFU mode")
-        else:
-            # The device might already be in DFU mode (MAC + 1)
-            ble_dfu.target_mac_increase(1)
+        scanner = None
+        if options.scan:
+            scanner = LiveScanner(adapter=options.adapter).start()
+            ble_dfu.device_index = scanner.index
 
-            # Try connection with new address
-            print("Couldn't connect, will try DFU MAC")
-            if not ble_dfu.scan_and_connect():
-                raise Exception("Can't connect to device")
+        error = None
 
-        ble_dfu.start()
+        try:
+            ble_dfu.update()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if scanner is not None:
+                scanner.stop()
 
-        # Disconnect from peer device if not done already and clean up.
-        ble_dfu.disconnect()
+            # Failing to write these must not fail the update itself
+            report = ble_dfu.transfer_report(error)
+
+            try:
+                if options.report is not None:
+                    save_report(report, options.report)
+                if options.report_dir is not None:
+                    save_report(report, report_path(options.report_dir, report))
+            except OSError as e:
+                print(f"Can't write report: {e}")
+
+            try:
+                if options.metrics_textfile is not None:
+                    record_to_textfile(options.metrics_textfile, ble_dfu, error, options.adapter)
+            except OSError as e:
+                print(f"Can't write metrics: {e}")
+
+            try:
+                if tracer is not None:
+                    tracer.save(options.trace)
+            except OSError as e:
+                print(f"Can't write trace: {e}")
 
     except Exception as e:
         # print(traceback.format_exc())
         print(f"Exception at line {sys.exc_info()[2].tb_lineno}: {e}")
         sys.exit(2)
 
-    # If Unpacker for zipfile used then delete Unpacker
-    if unpacker != None:
-       unpacker.delete()
-
     print("DFU Server done")
 
 """
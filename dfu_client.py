@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Client of the DFU daemon (dfu.py --daemon).
+
+ Submits a job and follows its progress until it finishes, or lists the
+ daemon's jobs. Only uses the standard library, so it starts quickly.
+------------------------------------------------------------------------------
+"""
+import json
+import optparse
+import os
+import socket
+import sys
+
+# Exit codes besides 0 (done) and 1 (failed)
+EXIT_USAGE       = 2
+EXIT_UNREACHABLE = 3
+
+# The connection dropped once made; a job may be running without us, so
+# callers must not fall back to updating directly
+EXIT_LOST        = 4
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'ota-dfu.sock')
+
+    if os.geteuid() == 0:
+        return '/run/ota-dfu.sock'
+
+    return f"/tmp/ota-dfu-{os.geteuid()}.sock"
+
+# ------------------------------------------------------------------------------
+#  One connection to the daemon. Requests and events are JSON objects, one
+#  per line.
+# ------------------------------------------------------------------------------
+class DfuClient(object):
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or default_socket_path())
+
+        self.reader = self.sock.makefile('r')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def request(self, cmd, **params):
+        params['cmd'] = cmd
+        self.sock.sendall((json.dumps(params) + '\n').encode())
+
+    def events(self):
+        for line in self.reader:
+            yield json.loads(line)
+
+    # --------------------------------------------------------------------------
+    #  Submit a job. Yields the events of the job until its result when wait
+    #  is set, just the queued event otherwise.
+    # --------------------------------------------------------------------------
+    def submit(self, address, image, device_id=None, legacy=False, adapter=None, priority=0, wait=True):
+        self.request('submit', address=address, image=image, device_id=device_id, legacy=legacy,
+                     adapter=adapter, priority=priority, wait=wait)
+
+        for event in self.events():
+            yield event
+
+            if event['event'] in ('result', 'error') or not wait:
+                return
+
+    def status(self):
+        self.request('status')
+
+        for event in self.events():
+            return event
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] -a <address> (-f <image> | --url <url> | --artifact <sha256>)\n'
+                                         '       %prog [options] status')
+
+    parser.add_option('-s', '--socket', dest='socket', default=default_socket_path(),
+                      help='daemon socket (default: %default)')
+    parser.add_option('-a', '--address', dest='address', default=None,
+                      help='DFU target address')
+    parser.add_option('-f', '--file', dest='image', default=None,
+                      help='image to send: .zip, or .bin/.hex next to its .dat, as seen by the daemon')
+    parser.add_option('--url', dest='url', default=None,
+                      help='URL of a zip file, fetched through the daemon\'s artifact cache')
+    parser.add_option('--artifact', dest='artifact', default=None,
+                      help='SHA-256 (or a unique prefix) of a zip file in the daemon\'s artifact cache')
+    parser.add_option('--ruuvitag', dest='device_id', default=None,
+                      help='ruuvitag device ID')
+    parser.add_option('--legacy', dest='legacy', action='store_true', default=False,
+                      help='use the legacy bootloader (Nordic SDK < 12)')
+    parser.add_option('-i', '--adapter', dest='adapter', default=None,
+                      help='run on this adapter (default: the first one free)')
+    parser.add_option('--priority', dest='priority', type='int', default=0,
+                      help='jobs with a higher priority run first (default: %default)')
+    parser.add_option('--no-wait', dest='wait', action='store_false', default=True,
+                      help='return once the job is queued')
+
+    (options, args) = parser.parse_args()
+
+    if args == ['status']:
+        image = None
+    elif args or not options.address or [options.image, options.url, options.artifact].count(None) != 2:
+        parser.print_help()
+        sys.exit(EXIT_USAGE)
+    else:
+        image = options.image or options.url or f"sha256:{options.artifact}"
+
+        # Paths are opened by the daemon
+        if options.image is not None:
+            image = os.path.abspath(image)
+
+    try:
+        client = DfuClient(options.socket)
+    except OSError as e:
+        print(f"Can't reach the DFU daemon at {options.socket}: {e}")
+        sys.exit(EXIT_UNREACHABLE)
+
+    try:
+        if image is None:
+            for job in client.status()['jobs']:
+                print(f"{job['id']:4} {job['address']} {job['adapter'] or '-':6} {job['status']:8} {job['progress']:5.1f}%  {job['error'] or ''}")
+            sys.exit(0)
+
+        result = None
+
+        for event in client.submit(options.address, image, options.device_id, options.legacy,
+                                   options.adapter, options.priority, options.wait):
+            if event['event'] == 'queued':
+                print(f"Job {event['id']} queued, {event['ahead']} ahead")
+            elif event['event'] == 'progress':
+                print(f"Job {event['id']} {event['status']} {event['progress']:5.1f}%")
+            elif event['event'] == 'error':
+                print(f"Error: {event['error']}")
+                sys.exit(EXIT_USAGE)
+            elif event['event'] == 'result':
+                result = event['job']
+
+        if not options.wait:
+            sys.exit(0)
+
+        if result is None:
+            print("Lost connection to the DFU daemon")
+            sys.exit(EXIT_LOST)
+
+        if result['status'] != 'done':
+            print(f"Job {result['id']} {result['status']}: {result['error']}")
+            sys.exit(1)
+
+        print(f"Job {result['id']} done in {result['duration']:.1f} s" +
+              (f", {result['reconnects']} reconnect(s), {result['time_lost']:.1f} s lost" if result.get('reconnects') else ""))
+
+    except OSError as e:
+        print(f"Lost connection to the DFU daemon: {e}")
+        sys.exit(EXIT_LOST)
+
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+------------------------------------------------------------------------------
+ Resident DFU service (dfu.py --daemon).
+
+ Runs fleet jobs submitted over a Unix socket, so updates don't pay for
+ Python startup, imports and cache loading each time. Images, transfer
+ plans, discovered GATT handles and adaptive PRN intervals stay in memory
+ between jobs. Each adapter runs a bounded number of jobs at once; queued
+ jobs run highest priority first, then in the order submitted.
+
+ Protocol: one JSON object per line, both ways.
+     {"cmd": "submit", "address", "image", "device_id", "legacy",
+      "adapter", "priority", "wait"}
+         -> {"event": "queued", "id", "ahead"}, and with wait (default)
+            {"event": "progress", "id", "status", "progress"} ...
+            {"event": "result", "job": {...}}
+     {"cmd": "wait", "id"}  -> progress and result events of that job
+     {"cmd": "status"}      -> {"event": "status", "jobs": [{...}, ...]}
+ Invalid requests get {"event": "error", "error"}.
+------------------------------------------------------------------------------
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+
+from fleet      import Fleet, Job, _ThreadOutput
+from dfu_client import default_socket_path
+
+from gatt_cache     import GattCache
+from resume_journal import ResumeJournal
+from transfer_plan  import PlanCache
+from artifact_cache import ArtifactCache
+from metrics        import Metrics, MetricsServer
+
+class DfuDaemon(Fleet):
+
+    # Finished jobs kept for status requests
+    keep_finished = 100
+
+    # Seconds between progress events of a running job at most
+    progress_interval = 1.0
+
+    def __init__(self, socket_path, adapters, per_adapter=1, connect_spacing=2.0):
+        Fleet.__init__(self, adapters, per_adapter, connect_spacing)
+
+        self.socket_path = socket_path
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.serving = True
+
+    # --------------------------------------------------------------------------
+    #  Queue a job. Returns the number of jobs that will run before it.
+    # --------------------------------------------------------------------------
+    def add(self, job):
+        if job.adapter is not None and job.adapter not in self.pinned:
+            raise ValueError(f"Job for {job.address} asks for unknown adapter {job.adapter}")
+
+        with self.condition:
+            job.id = self.jobs[-1].id + 1 if self.jobs else 1
+
+            finished = [j for j in self.jobs if j.finished is not None]
+            for old in finished[:max(len(finished) - self.keep_finished, 0)]:
+                self.jobs.remove(old)
+
+            self.jobs.append(job)
+            self.pending.append(job)
+
+            self.condition.notify_all()
+
+            return sum(1 for j in self.pending if (-j.priority, j.id) < (-job.priority, job.id))
+
+    def _next_job(self, adapter):
+        with self.condition:
+            while self.serving:
+                jobs = [job for job in self.pending if job.adapter in (None, adapter)]
+
+                if jobs:
+                    job = min(jobs, key=lambda job: (-job.priority, job.id))
+                    self.pending.remove(job)
+                    return job
+
+                self.condition.wait()
+
+        return None
+
+    def _find(self, job_id):
+        with self.condition:
+            for job in self.jobs:
+                if job.id == job_id:
+                    return job
+
+        raise ValueError(f"No job {job_id}")
+
+    # --------------------------------------------------------------------------
+    #  Accept clients until SIGTERM / SIGINT, then let running jobs finish
+    # --------------------------------------------------------------------------
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        server.listen(8)
+
+        output = _ThreadOutput(sys.stdout)
+        sys.stdout = output
+
+        self._start_scanners()
+        workers = self._start_workers(output)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        print(f"DFU daemon listening on {self.socket_path}")
+
+        try:
+            while True:
+                (conn, _) = server.accept()
+                threading.Thread(target=self._client, args=(conn,), daemon=True).start()
+
+        except (KeyboardInterrupt, SystemExit) as e:
+            print("DFU daemon stopping")
+
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+            with self.condition:
+                self.serving = False
+                self.condition.notify_all()
+
+            for worker in workers:
+                worker.join()
+
+            sys.stdout = output.stream
+            self._stop_scanners()
+            self.images.delete()
+
+    # --------------------------------------------------------------------------
+    #  Requests of one client connection
+    # --------------------------------------------------------------------------
+    def _client(self, conn):
+        with conn, conn.makefile('r') as reader:
+            try:
+                for line in reader:
+                    try:
+                        self._handle(conn, json.loads(line))
+                    except (ValueError, KeyError, TypeError) as e:
+                        self._send(conn, {'event': 'error', 'error': str(e)})
+
+            except OSError as e:
+                # Client went away; its jobs carry on
+                pass
+
+    def _handle(self, conn, request):
+        cmd = request['cmd']
+
+        if cmd == 'submit':
+            job = Job(request['address'], request['image'], request.get('device_id'), request.get('legacy', False),
+                      request.get('adapter'), int(request.get('priority', 0)))
+            ahead = self.add(job)
+
+            self._send(conn, {'event': 'queued', 'id': job.id, 'ahead': ahead})
+
+            if request.get('wait', True):
+                self._follow(conn, job)
+
+        elif cmd == 'wait':
+            self._follow(conn, self._find(request['id']))
+
+        elif cmd == 'status':
+            with self.condition:
+                jobs = [job.to_json() for job in self.jobs]
+
+            self._send(conn, {'event': 'status', 'jobs': jobs})
+
+        else:
+            raise ValueError(f"Unknown command {cmd}")
+
+    # --------------------------------------------------------------------------
+    #  Send progress events of job until it finishes, then its result
+    # --------------------------------------------------------------------------
+    def _follow(self, conn, job):
+        last = None
+
+        while True:
+            with job.changed:
+                if job.finished is None and (job.status, int(job.progress())) == last:
+                    job.changed.wait(self.progress_interval)
+
+            if job.finished is not None:
+                self._send(conn, {'event': 'result', 'job': job.to_json()})
+                return
+
+            state = (job.status, int(job.progress()))
+            if state != last:
+                self._send(conn, {'event': 'progress', 'id': job.id, 'status': job.status, 'progress': round(job.progress(), 1)})
+                last = state
+
+    def _send(self, conn, event):
+        conn.sendall((json.dumps(event) + '\n').encode())
+
+# ------------------------------------------------------------------------------
+#  Run the daemon configured by dfu.py's command line options
+# ------------------------------------------------------------------------------
+def serve(options):
+    adapters = [adapter.strip() for adapter in options.adapter.split(',') if adapter.strip()] if options.adapter else [None]
+
+    daemon = DfuDaemon(options.socket or default_socket_path(), adapters, max(options.per_adapter, 1))
+
+    daemon.transport = options.transport
+    daemon.att_mtu = options.mtu
+    daemon.pkt_receipt_interval = options.prn
+    daemon.adaptive_prn = options.adaptive_prn
+    daemon.scan = options.scan
+    daemon.report_dir = options.report_dir
+    daemon.max_pending_receipts = max(options.window, 1) if options.window is not None else None
+
+    if options.gatt_cache is not None:
+        daemon.gatt_cache = GattCache(options.gatt_cache)
+    if options.journal is not None:
+        daemon.resume_journal = ResumeJournal(options.journal)
+    if options.plan_dir is not None:
+        daemon.plan_cache = PlanCache(options.plan_dir)
+
+    daemon.images.artifacts = ArtifactCache(options.artifact_cache, options.cache_budget * 1024 * 1024)
+
+    server = None
+
+    if options.metrics_textfile is not None or options.metrics_port is not None:
+        daemon.metrics = Metrics()
+
+    if options.metrics_textfile is not None:
+        daemon.metrics.load_textfile(options.metrics_textfile)
+        daemon.metrics_textfile = options.metrics_textfile
+
+    if options.metrics_port is not None:
+        server = MetricsServer(daemon.metrics, options.metrics_port, 'localhost').start()
+        print(f"Metrics at http://localhost:{options.metrics_port}/metrics")
+
+    try:
+        daemon.serve()
+    finally:
+        if server is not None:
+            server.stop()
@@ -0,0 +1,883 @@
+#!/usr/bin/env python3
+
+#------------------------------------------------------------------------------
+# In-process simulation of Nordic DFU peripherals.
+#
+# Peripherals implement the application side (buttonless switch), the legacy
+# (SDK <= 11) and the secure (SDK >= 12) bootloader state machines on top of a
+# small GATT table. SimulatedTransport plugs in underneath the controllers in
+# place of gatttool, so complete updates run without a radio.
+#
+# Time is virtual: every write, round trip and timeout advances a
+# SimulatedClock according to the LinkModel of the connected device, which
+# makes throughput figures deterministic and independent of host load.
+#------------------------------------------------------------------------------
+
+import random
+import struct
+import time
+import zlib
+
+from collections import deque
+
+from transport import Transport, Characteristic, ConnectionLost, Advertisement, ATT_DEFAULT_MTU
+from util      import mac_string_to_uint, uint_to_mac_string
+
+class Props:
+    READ            = 0x02
+    WRITE_NO_RSP    = 0x04
+    WRITE           = 0x08
+    NOTIFY          = 0x10
+    INDICATE        = 0x20
+
+UUID_FIRMWARE_REVISION = '00002a26-0000-1000-8000-00805f9b34fb'
+
+#------------------------------------------------------------------------------
+# Virtual time shared by everything attached to a SimulatedRadio.
+# With realtime set, advancing the clock also sleeps for the same duration.
+#------------------------------------------------------------------------------
+class SimulatedClock(object):
+
+    def __init__(self, realtime=False):
+        self.now = 0.0
+        self.realtime = realtime
+
+    def advance(self, seconds):
+        if seconds <= 0:
+            return
+
+        self.now += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def advance_to(self, when):
+        self.advance(when - self.now)
+
+#------------------------------------------------------------------------------
+# Link characteristics of one simulated device.
+#   latency         - one-way delay between host and peripheral (s)
+#   packet_overhead - air time of a packet excluding its payload (s)
+#   byte_time       - air time per payload byte (s), 8 us on 1M PHY
+#   process_time    - peripheral time to handle one write (s)
+#   buffer_limit    - writes the peripheral can queue, more are dropped
+#   loss            - probability that a data packet is lost
+#   disconnect_after- drop the link after this many data packets
+#   max_mtu         - largest ATT MTU the peripheral accepts
+#------------------------------------------------------------------------------
+class LinkModel(object):
+
+    def __init__(self, latency=0.0075, packet_overhead=0.0004, byte_time=0.000008, process_time=0.0001,
+                 buffer_limit=None, loss=0.0, disconnect_after=None, max_mtu=247, seed=0):
+        self.latency = latency
+        self.packet_overhead = packet_overhead
+        self.byte_time = byte_time
+        self.process_time = process_time
+        self.buffer_limit = buffer_limit
+        self.loss = loss
+        self.disconnect_after = disconnect_after
+        self.max_mtu = max_mtu
+
+        self.random = random.Random(seed)
+
+    def packet_time(self, size):
+        # ATT (3) + L2CAP (4) headers travel with every payload
+        return self.packet_overhead + (size + 7) * self.byte_time
+
+#------------------------------------------------------------------------------
+# Devices currently advertising, by MAC
+#------------------------------------------------------------------------------
+class SimulatedRadio(object):
+
+    def __init__(self, clock=None):
+        self.clock = clock or SimulatedClock()
+        self.devices = {}
+
+    def add(self, peripheral, delay=0.0):
+        peripheral.radio = self
+        peripheral.available_at = self.clock.now + delay
+        self.devices[peripheral.mac] = peripheral
+
+    def remove(self, peripheral):
+        if self.devices.get(peripheral.mac) is peripheral:
+            del self.devices[peripheral.mac]
+
+    def lookup(self, mac):
+        device = self.devices.get(mac.upper())
+        if device is None or device.available_at > self.clock.now:
+            return None
+
+        return device
+
+    # --------------------------------------------------------------------------
+    #  Time at which a device will be advertising at mac, or None
+    # --------------------------------------------------------------------------
+    def available_at(self, mac):
+        device = self.devices.get(mac.upper())
+        if device is None:
+            return None
+
+        return device.available_at
+
+#------------------------------------------------------------------------------
+# A peripheral with a GATT table. Each characteristic takes a declaration,
+# value and (if it can notify) CCCD handle.
+#------------------------------------------------------------------------------
+class SimulatedPeripheral(object):
+
+    name = 'Simulated'
+
+    def __init__(self, mac, link=None):
+        self.mac = mac.upper()
+        self.link = link or LinkModel()
+
+        self.radio = None
+        self.available_at = 0.0
+        self.connection = None
+
+        self.chars = []
+        self.values = {}
+        self.cccds = {}
+
+        self.next_handle = 0x0010
+
+    def add_characteristic(self, uuid, properties, value=b''):
+        handle = self.next_handle
+        char = Characteristic(handle, properties, handle + 1, uuid)
+
+        self.chars.append(char)
+        self.values[char.value_handle] = bytes(value)
+        self.next_handle += 2
+
+        if properties & (Props.NOTIFY | Props.INDICATE):
+            self.cccds[char.value_handle + 1] = 0
+            self.next_handle += 1
+
+        return char
+
+    def value_handle(self, uuid):
+        for char in self.chars:
+            if char.uuid == uuid:
+                return char.value_handle
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  ATT server side. Returns True if the write was accepted.
+    # --------------------------------------------------------------------------
+    def on_write(self, handle, data):
+        if handle in self.cccds:
+            self.cccds[handle] = struct.unpack('<H', bytes(data[0:2]).ljust(2, b'\x00'))[0]
+            return True
+
+        if handle in self.values:
+            self.values[handle] = bytes(data)
+            return True
+
+        return False
+
+    def on_read(self, handle):
+        if handle in self.cccds:
+            return struct.pack('<H', self.cccds[handle])
+
+        return self.values.get(handle)
+
+    def on_connect(self):
+        pass
+
+    def notify(self, value_handle, value):
+        if self.connection is None or not self.cccds.get(value_handle + 1, 0):
+            return
+
+        self.connection.queue_notification(value_handle, bytes(value))
+
+    # --------------------------------------------------------------------------
+    #  Drop the link and come back as another peripheral (e.g. the bootloader
+    #  at MAC+1) after delay seconds.
+    # --------------------------------------------------------------------------
+    def reboot_into(self, peripheral, delay=0.0):
+        self.radio.remove(self)
+
+        if peripheral is not None:
+            self.radio.add(peripheral, delay)
+
+        if self.connection is not None:
+            self.connection.link_lost()
+
+#------------------------------------------------------------------------------
+# Secure DFU bootloader (nRF5 SDK >= 12)
+#------------------------------------------------------------------------------
+class SecureDfuTarget(SimulatedPeripheral):
+
+    name = 'DfuTarg'
+
+    UUID_CONTROL_POINT = '8ec90001-f315-4f60-9fb8-838830daea50'
+    UUID_PACKET        = '8ec90002-f315-4f60-9fb8-838830daea50'
+
+    CREATE          = 0x01
+    SET_PRN         = 0x02
+    CALC_CHECKSUM   = 0x03
+    EXECUTE         = 0x04
+    SELECT          = 0x06
+    RESPONSE        = 0x60
+
+    OBJ_COMMAND     = 0x01
+    OBJ_DATA        = 0x02
+
+    SUCCESS                 = 0x01
+    OPCODE_NOT_SUPPORTED    = 0x02
+    INVALID_PARAMETER       = 0x03
+    INSUFF_RESOURCES        = 0x04
+    OPERATION_NOT_PERMITTED = 0x08
+
+    max_command_size = 512
+    max_data_size    = 4096
+
+    def __init__(self, mac, link=None, firmware_size=None, reboot_delay=0.5):
+        super().__init__(mac, link)
+
+        self.control_point = self.add_characteristic(self.UUID_CONTROL_POINT, Props.WRITE | Props.NOTIFY).value_handle
+        self.packet = self.add_characteristic(self.UUID_PACKET, Props.WRITE_NO_RSP).value_handle
+
+        self.firmware_size = firmware_size
+        self.reboot_delay = reboot_delay
+
+        self.command = bytearray()
+        self.command_size = 0
+        self.command_executed = False
+
+        self.data = bytearray()
+        self.data_crc = 0
+        self.executed = 0
+        self.executed_crc = 0
+        self.object_start = 0
+        self.object_size = 0
+
+        self.current = None
+        self.prn = 0
+        self.prn_count = 0
+
+        self.objects_created = 0
+        self.objects_executed = 0
+        self.complete = False
+        self.next_peripheral = None
+
+    def on_connect(self):
+        self.prn_count = 0
+
+    def on_write(self, handle, data):
+        if handle == self.packet:
+            self._on_packet(bytes(data))
+            return True
+
+        if handle == self.control_point:
+            self._on_command(bytes(data))
+            return True
+
+        return super().on_write(handle, data)
+
+    def _respond(self, opcode, result, payload=b''):
+        self.notify(self.control_point, bytes([self.RESPONSE, opcode, result]) + payload)
+
+    def _checksum(self):
+        if self.current == self.OBJ_COMMAND:
+            return struct.pack('<II', len(self.command), zlib.crc32(self.command))
+
+        return struct.pack('<II', len(self.data), self.data_crc)
+
+    def _on_packet(self, data):
+        if self.current == self.OBJ_COMMAND:
+            if len(self.command) + len(data) > self.command_size:
+                return
+            self.command += data
+
+        elif self.current == self.OBJ_DATA:
+            if len(self.data) + len(data) > self.object_start + self.object_size:
+                return
+            self.data += data
+            self.data_crc = zlib.crc32(data, self.data_crc)
+
+        else:
+            return
+
+        self.prn_count += 1
+        if self.prn and self.prn_count >= self.prn:
+            self.prn_count = 0
+            self._respond(self.CALC_CHECKSUM, self.SUCCESS, self._checksum())
+
+    def _on_command(self, data):
+        opcode = data[0]
+
+        if opcode == self.SET_PRN:
+            self.prn = struct.unpack_from('<H', data, 1)[0]
+            self.prn_count = 0
+            self._respond(opcode, self.SUCCESS)
+
+        elif opcode == self.SELECT:
+            self.current = data[1]
+            if self.current == self.OBJ_COMMAND:
+                self._respond(opcode, self.SUCCESS, struct.pack('<I', self.max_command_size) + self._checksum())
+            else:
+                self._respond(opcode, self.SUCCESS, struct.pack('<I', self.max_data_size) + self._checksum())
+
+        elif opcode == self.CREATE:
+            (obj_type, size) = struct.unpack_from('<BI', data, 1)
+            self._create(obj_type, size)
+
+        elif opcode == self.CALC_CHECKSUM:
+            self._respond(opcode, self.SUCCESS, self._checksum())
+
+        elif opcode == self.EXECUTE:
+            self._execute()
+
+        else:
+            self._respond(opcode, self.OPCODE_NOT_SUPPORTED)
+
+    def _create(self, obj_type, size):
+        self.prn_count = 0
+
+        if obj_type == self.OBJ_COMMAND:
+            if size > self.max_command_size:
+                self._respond(self.CREATE, self.INSUFF_RESOURCES)
+                return
+
+            # A new init packet starts the whole transfer over
+            self.command = bytearray()
+            self.command_size = size
+            self.command_executed = False
+
+            self.data = bytearray()
+            self.data_crc = self.executed = self.executed_crc = 0
+
+        elif obj_type == self.OBJ_DATA:
+            if not self.command_executed:
+                self._respond(self.CREATE, self.OPERATION_NOT_PERMITTED)
+                return
+
+            if size > self.max_data_size:
+                self._respond(self.CREATE, self.INSUFF_RESOURCES)
+                return
+
+            # Whatever wasn't executed is discarded
+            del self.data[self.executed:]
+            self.data_crc = self.executed_crc
+            self.object_start = self.executed
+            self.object_size = size
+            self.objects_created += 1
+
+        else:
+            self._respond(self.CREATE, self.INVALID_PARAMETER)
+            return
+
+        self.current = obj_type
+        self._respond(self.CREATE, self.SUCCESS)
+
+    def _execute(self):
+        if self.current == self.OBJ_COMMAND:
+            if len(self.command) != self.command_size:
+                self._respond(self.EXECUTE, self.OPERATION_NOT_PERMITTED)
+                return
+
+            self.command_executed = True
+            self._respond(self.EXECUTE, self.SUCCESS)
+            return
+
+        if len(self.data) == self.executed:
+            # Nothing new, e.g. re-executing after a resume
+            self._respond(self.EXECUTE, self.SUCCESS)
+            return
+
+        if len(self.data) != self.object_start + self.object_size:
+            self._respond(self.EXECUTE, self.OPERATION_NOT_PERMITTED)
+            return
+
+        self.executed = len(self.data)
+        self.executed_crc = self.data_crc
+        self.objects_executed += 1
+
+        self._respond(self.EXECUTE, self.SUCCESS)
+
+        if self.firmware_size is not None and self.executed >= self.firmware_size:
+            # Image complete: the bootloader activates it and resets
+            self.complete = True
+            self.reboot_into(self.next_peripheral, self.reboot_delay)
+
+#------------------------------------------------------------------------------
+# Legacy DFU bootloader (nRF5 SDK <= 11)
+#------------------------------------------------------------------------------
+class LegacyDfuTarget(SimulatedPeripheral):
+
+    name = 'DfuTarg'
+
+    UUID_CONTROL_POINT = '00001531-1212-efde-1523-785feabcd123'
+    UUID_PACKET        = '00001532-1212-efde-1523-785feabcd123'
+    UUID_VERSION       = '00001534-1212-efde-1523-785feabcd123'
+
+    START_DFU                   = 1
+    INITIALIZE_DFU              = 2
+    RECEIVE_FIRMWARE_IMAGE      = 3
+    VALIDATE_FIRMWARE           = 4
+    ACTIVATE_IMAGE_AND_RESET    = 5
+    PRN_REQUEST                 = 8
+    RESPONSE                    = 16
+    PACKET_RECEIPT_NOTIFICATION = 17
+
+    SUCCESS                     = 1
+    INVALID_STATE               = 2
+    NOT_SUPPORTED               = 3
+    CRC_ERROR                   = 5
+
+    def __init__(self, mac, link=None, firmware_crc=None, reboot_delay=0.5):
+        super().__init__(mac, link)
+
+        self.control_point = self.add_characteristic(self.UUID_CONTROL_POINT, Props.WRITE | Props.NOTIFY).value_handle
+        self.packet = self.add_characteristic(self.UUID_PACKET, Props.WRITE_NO_RSP).value_handle
+        self.add_characteristic(self.UUID_VERSION, Props.READ, b'\x08\x00')
+
+        self.firmware_crc = firmware_crc
+        self.reboot_delay = reboot_delay
+
+        self.state = 'idle'
+        self.image_size = 0
+        self.init_packet = bytearray()
+        self.firmware = bytearray()
+
+        self.prn = 0
+        self.prn_count = 0
+
+        self.complete = False
+        self.next_peripheral = None
+
+    def on_write(self, handle, data):
+        if handle == self.packet:
+            self._on_packet(bytes(data))
+            return True
+
+        if handle == self.control_point:
+            self._on_command(bytes(data))
+            return True
+
+        return super().on_write(handle, data)
+
+    def _respond(self, procedure, result):
+        self.notify(self.control_point, bytes([self.RESPONSE, procedure, result]))
+
+    def _on_packet(self, data):
+        if self.state == 'image_size':
+            (sd_size, bl_size, app_size) = struct.unpack('<III', data[0:12])
+            self.image_size = app_size
+            self.state = 'started'
+            self._respond(self.START_DFU, self.SUCCESS)
+
+        elif self.state == 'init':
+            self.init_packet += data
+
+        elif self.state == 'receiving':
+            self.firmware += data
+
+            self.prn_count += 1
+            if self.prn and self.prn_count >= self.prn and len(self.firmware) < self.image_size:
+                self.prn_count = 0
+                self.notify(self.control_point, bytes([self.PACKET_RECEIPT_NOTIFICATION]) + struct.pack('<I', len(self.firmware)))
+
+            if len(self.firmware) >= self.image_size:
+                self.state = 'received'
+                self._respond(self.RECEIVE_FIRMWARE_IMAGE, self.SUCCESS)
+
+    def _on_command(self, data):
+        procedure = data[0]
+
+        if procedure == self.START_DFU:
+            self.state = 'image_size'
+
+        elif procedure == self.INITIALIZE_DFU:
+            if data[1:2] == b'\x00':
+                self.init_packet = bytearray()
+                self.state = 'init'
+            else:
+                self.state = 'initialized'
+                self._respond(self.INITIALIZE_DFU, self.SUCCESS)
+
+        elif procedure == self.PRN_REQUEST:
+            self.prn = struct.unpack_from('<H', data, 1)[0]
+            self.prn_count = 0
+
+        elif procedure == self.RECEIVE_FIRMWARE_IMAGE:
+            self.firmware = bytearray()
+            self.state = 'receiving'
+
+        elif procedure == self.VALIDATE_FIRMWARE:
+            if self.state != 'received':
+                self._respond(procedure, self.INVALID_STATE)
+            elif self.firmware_crc is not None and zlib.crc32(self.firmware) != self.firmware_crc:
+                self._respond(procedure, self.CRC_ERROR)
+            else:
+                self.state = 'validated'
+                self._respond(procedure, self.SUCCESS)
+
+        elif procedure == self.ACTIVATE_IMAGE_AND_RESET:
+            self.complete = self.state == 'validated'
+            self.reboot_into(self.next_peripheral, self.reboot_delay)
+
+        else:
+            self._respond(procedure, self.NOT_SUPPORTED)
+
+#------------------------------------------------------------------------------
+# Application with the secure buttonless DFU service. Writing 0x01 to the
+# buttonless characteristic reboots into the bootloader at MAC+1.
+#------------------------------------------------------------------------------
+class SecureApplication(SimulatedPeripheral):
+
+    name = 'App'
+
+    UUID_BUTTONLESS = '8e400001-f315-4f60-9fb8-838830daea50'
+
+    def __init__(self, mac, bootloader, link=None, version=b'1.0.0', reboot_delay=0.5):
+        super().__init__(mac, link)
+
+        self.add_characteristic(UUID_FIRMWARE_REVISION, Props.READ, version)
+        self.buttonless = self.add_characteristic(self.UUID_BUTTONLESS, Props.WRITE | Props.INDICATE).value_handle
+
+        self.bootloader = bootloader
+        self.reboot_delay = reboot_delay
+
+    def on_write(self, handle, data):
+        if handle == self.buttonless and bytes(data[0:1]) == b'\x01':
+            self.notify(self.buttonless, b'\x20\x01\x01')
+            self.reboot_into(self.bootloader, self.reboot_delay)
+            return True
+
+        return super().on_write(handle, data)
+
+#------------------------------------------------------------------------------
+# Application side of the legacy DFU service. START_DFU reboots into the
+# bootloader at the same address.
+#------------------------------------------------------------------------------
+class LegacyApplication(SimulatedPeripheral):
+
+    name = 'App'
+
+    def __init__(self, mac, bootloader, link=None, reboot_delay=0.5):
+        super().__init__(mac, link)
+
+        self.control_point = self.add_characteristic(LegacyDfuTarget.UUID_CONTROL_POINT, Props.WRITE | Props.NOTIFY).value_handle
+        self.add_characteristic(LegacyDfuTarget.UUID_VERSION, Props.READ, b'\x01\x00')
+
+        self.bootloader = bootloader
+        self.reboot_delay = reboot_delay
+
+    def on_write(self, handle, data):
+        if handle == self.control_point and bytes(data[0:1]) == bytes([LegacyDfuTarget.START_DFU]):
+            self.reboot_into(self.bootloader, self.reboot_delay)
+            return True
+
+        return super().on_write(handle, data)
+
+#------------------------------------------------------------------------------
+# RuuviTag application. Writing 2a2a09<device id> to the Nordic UART RX
+# characteristic unlocks the buttonless service at the same address; writing
+# 0x01 to that reboots into the bootloader at MAC+1.
+#------------------------------------------------------------------------------
+class RuuviApplication(SimulatedPeripheral):
+
+    name = 'Ruuvi'
+
+    UUID_RUUVI_RX         = '6e400002-b5a3-f393-e0a9-e50e24dcca9e'
+    UUID_RUUVI_TX         = '6e400003-b5a3-f393-e0a9-e50e24dcca9e'
+    UUID_RUUVI_BUTTONLESS = '8ec90003-f315-4f60-9fb8-838830daea50'
+
+    def __init__(self, mac, device_id, bootloader, link=None, version=b'3.31.0', unlocked=False, reboot_delay=2.0):
+        super().__init__(mac, link)
+
+        self.add_characteristic(UUID_FIRMWARE_REVISION, Props.READ, version)
+
+        self.device_id = bytes.fromhex(device_id.replace(':', ''))
+        self.bootloader = bootloader
+        self.version = version
+        self.reboot_delay = reboot_delay
+
+        self.rx = self.add_characteristic(self.UUID_RUUVI_RX, Props.WRITE | Props.WRITE_NO_RSP).value_handle
+        self.add_characteristic(self.UUID_RUUVI_TX, Props.NOTIFY)
+
+        self.buttonless = None
+        if unlocked:
+            self.buttonless = self.add_characteristic(self.UUID_RUUVI_BUTTONLESS, Props.WRITE | Props.INDICATE).value_handle
+
+    def on_write(self, handle, data):
+        data = bytes(data)
+
+        if handle == self.rx and data == b'\x2a\x2a\x09' + self.device_id:
+            unlocked = RuuviApplication(self.mac, self.device_id.hex(), self.bootloader, self.link, self.version, unlocked=True)
+            self.reboot_into(unlocked, self.reboot_delay)
+            return True
+
+        if handle == self.buttonless and data[0:1] == b'\x01':
+            if not self.cccds.get(self.buttonless + 1, 0):
+                return False
+
+            self.notify(self.buttonless, b'\x20\x01\x01')
+            self.reboot_into(self.bootloader, self.reboot_delay)
+            return True
+
+        return super().on_write(handle, data)
+
+#------------------------------------------------------------------------------
+# Transport connecting a controller to a peripheral on a SimulatedRadio
+#------------------------------------------------------------------------------
+class SimulatedTransport(Transport):
+
+    def __init__(self, target_mac, radio, adapter=None):
+        super().__init__(target_mac, adapter)
+
+        self.radio = radio
+        self.clock = radio.clock
+
+        self.peripheral = None
+        self.notifications = deque()
+        self.mtu = ATT_DEFAULT_MTU
+
+        self.closed_at = None
+        self.busy_until = 0.0
+        self._processed_at = 0.0
+        self.pending_writes = deque()
+
+        self.packets_sent = 0
+        self.packets_lost = 0
+        self.bytes_sent = 0
+        self.disconnects = 0
+
+    # --------------------------------------------------------------------------
+    #  Called by the peripheral
+    # --------------------------------------------------------------------------
+    def queue_notification(self, handle, value):
+        self.notifications.append((self._processed_at + self.peripheral.link.latency, handle, value))
+
+    # Responses queued before the link went down still reach the host
+    def link_lost(self):
+        if self.closed_at is None:
+            self.closed_at = self._processed_at + self.peripheral.link.latency
+
+        self.peripheral.connection = None
+
+    # --------------------------------------------------------------------------
+    #  Transport interface
+    # --------------------------------------------------------------------------
+    def retarget(self, target_mac):
+        self.disconnect()
+
+        self.target_mac = target_mac
+
+    def connect(self):
+        self.disconnect()
+
+        peripheral = self.radio.lookup(self.target_mac)
+
+        if peripheral is None:
+            available_at = self.radio.available_at(self.target_mac)
+            if available_at is None or available_at > self.clock.now + self.timeout:
+                self.clock.advance(self.timeout)
+                return False
+
+            self.clock.advance_to(available_at)
+            peripheral = self.radio.lookup(self.target_mac)
+
+        # Connection setup takes a couple of connection events
+        self.clock.advance(peripheral.link.latency * 4)
+
+        self.peripheral = peripheral
+        self.peripheral.connection = self
+        self.peripheral.on_connect()
+
+        self.notifications.clear()
+        self.pending_writes.clear()
+        self.closed_at = None
+        self.busy_until = self.clock.now
+        self._processed_at = self.clock.now
+        self.mtu = ATT_DEFAULT_MTU
+
+        return True
+
+    def disconnect(self):
+        if self.peripheral is not None and self.peripheral.connection is self:
+            self.peripheral.connection = None
+
+        self.peripheral = None
+
+    # --------------------------------------------------------------------------
+    #  The first of macs to be advertising, in virtual time
+    # --------------------------------------------------------------------------
+    def wait_for_advertisement(self, macs, timeout):
+        started = self.clock.now
+
+        times = [(max(self.radio.available_at(mac), started), mac.upper()) for mac in macs if self.radio.available_at(mac) is not None]
+        times = [(when, mac) for (when, mac) in times if when <= started + timeout]
+
+        if not times:
+            self.clock.advance(timeout)
+            return None
+
+        (when, mac) = min(times)
+        self.clock.advance_to(when)
+
+        return Advertisement(mac, self.clock.now - started)
+
+    def exchange_mtu(self, mtu):
+        self._round_trip()
+
+        self.mtu = max(ATT_DEFAULT_MTU, min(mtu, self.peripheral.link.max_mtu))
+        return self.mtu
+
+    def discover_characteristics(self):
+        # Roughly one round trip per four characteristics
+        for i in range(0, len(self.peripheral.chars) // 4 + 1):
+            self._round_trip()
+
+        return list(self.peripheral.chars)
+
+    def read(self, handle):
+        self._round_trip()
+
+        return self.peripheral.on_read(handle)
+
+    def read_by_uuid(self, uuid):
+        self._round_trip()
+
+        handle = self.peripheral.value_handle(uuid)
+        if handle is None:
+            return None
+
+        return self.peripheral.on_read(handle)
+
+    def write_request(self, handle, data, wait=True):
+        self._check_link()
+
+        peripheral = self.peripheral
+        done = self._deliver(len(data))
+        accepted = peripheral.on_write(handle, data)
+
+        if wait:
+            self.clock.advance_to(done + peripheral.link.latency)
+            if self.closed_at is not None and self.closed_at < self.clock.now and not accepted:
+                raise ConnectionLost()
+
+        return accepted
+
+    def write_command(self, handle, data):
+        self._check_link()
+
+        link = self.peripheral.link
+
+        self.clock.advance(link.packet_time(len(data)))
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+
+        if link.disconnect_after is not None and self.packets_sent >= link.disconnect_after:
+            link.disconnect_after = None
+            self._processed_at = self.clock.now
+            self.disconnects += 1
+            self.link_lost()
+            return
+
+        # Nothing gets through a link that already went down
+        if self.closed_at is not None:
+            self.packets_lost += 1
+            return
+
+        if link.random.random() < link.loss:
+            self.packets_lost += 1
+            return
+
+        arrival = self.clock.now + link.latency
+
+        # Writes still waiting to be processed when this one arrives
+        while self.pending_writes and self.pending_writes[0] <= arrival:
+            self.pending_writes.popleft()
+
+        if link.buffer_limit is not None and len(self.pending_writes) >= link.buffer_limit:
+            self.packets_lost += 1
+            return
+
+        done = self._deliver(len(data), arrival)
+        self.pending_writes.append(done)
+
+        self.peripheral.on_write(handle, data)
+
+    def wait_for_notification(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = self.clock.now + timeout
+
+        if self.notifications and self.notifications[0][0] <= deadline:
+            (ready, handle, value) = self.notifications.popleft()
+            self.clock.advance_to(ready)
+            return (handle, value)
+
+        if self.closed_at is not None:
+            self.clock.advance_to(max(self.closed_at, self.clock.now))
+            raise ConnectionLost()
+
+        self.clock.advance_to(deadline)
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Internal timing helpers
+    # --------------------------------------------------------------------------
+    def _check_link(self):
+        if self.peripheral is None or (self.closed_at is not None and self.closed_at <= self.clock.now):
+            raise ConnectionLost()
+
+    # Time at which the peripheral finished processing a write sent now
+    def _deliver(self, size, arrival=None):
+        link = self.peripheral.link
+
+        if arrival is None:
+            self.clock.advance(link.packet_time(size))
+            arrival = self.clock.now + link.latency
+
+        self._processed_at = max(arrival, self.busy_until) + link.process_time
+        self.busy_until = self._processed_at
+
+        return self._processed_at
+
+    def _round_trip(self):
+        self._check_link()
+
+        done = self._deliver(0)
+        self.clock.advance_to(done + self.peripheral.link.latency)
+
+#------------------------------------------------------------------------------
+# Convenience constructors for complete devices.
+# Returns (application, bootloader); the bootloader reboots back into the
+# application once an image has been activated.
+#------------------------------------------------------------------------------
+def secure_device(radio, mac, firmware_size, link=None, in_dfu_mode=False):
+    link = link or LinkModel()
+    dfu_mac = uint_to_mac_string(mac_string_to_uint(mac) + 1)
+
+    bootloader = SecureDfuTarget(dfu_mac, link, firmware_size)
+    application = SecureApplication(mac, bootloader, link)
+    bootloader.next_peripheral = application
+
+    radio.add(bootloader if in_dfu_mode else application)
+    return (application, bootloader)
+
+def legacy_device(radio, mac, firmware_crc=None, link=None, in_dfu_mode=False):
+    link = link or LinkModel()
+
+    bootloader = LegacyDfuTarget(mac, link, firmware_crc)
+    application = LegacyApplication(mac, bootloader, link)
+    bootloader.next_peripheral = application
+
+    radio.add(bootloader if in_dfu_mode else application)
+    return (application, bootloader)
+
+def ruuvitag_device(radio, mac, device_id, firmware_size, link=None):
+    link = link or LinkModel()
+    dfu_mac = uint_to_mac_string(mac_string_to_uint(mac) + 1)
+
+    bootloader = SecureDfuTarget(dfu_mac, link, firmware_size)
+    application = RuuviApplication(mac, device_id, bootloader, link)
+    bootloader.next_peripheral = application
+
+    radio.add(application)
+    return (application, bootloader)
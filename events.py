@@ -0,0 +1,62 @@
+import queue
+
+from collections import namedtuple
+
+# ------------------------------------------------------------------------------
+#  Typed events produced by a transport's reader thread.
+#
+#  The reader drains the link continuously and decodes every line of tool
+#  output (or ATT PDU) exactly once into one of these. Notifications and link
+#  loss go to the queue the controller consumes; replies to requests go to a
+#  separate queue the transport's request methods wait on.
+# ------------------------------------------------------------------------------
+Notification  = namedtuple('Notification', ['handle', 'value'])
+WriteAck      = namedtuple('WriteAck', ['handle'])
+Disconnected  = namedtuple('Disconnected', ['reason'])
+Error         = namedtuple('Error', ['message'])
+
+# Replies to gatttool commands
+Connected     = namedtuple('Connected', ['address'])
+MtuExchanged  = namedtuple('MtuExchanged', ['mtu'])
+Value         = namedtuple('Value', ['handle', 'value'])
+
+class EventQueue(object):
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    # --------------------------------------------------------------------------
+    #  Next event, or None if nothing arrived within timeout seconds
+    # --------------------------------------------------------------------------
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def clear(self):
+        while self.get(0) is not None:
+            pass
+
+    # --------------------------------------------------------------------------
+    #  Drop whatever is queued, keeping link loss. Returns the dropped events.
+    # --------------------------------------------------------------------------
+    def drain(self):
+        dropped = []
+
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if isinstance(event, Disconnected):
+                self.queue.put(event)
+                break
+
+            dropped.append(event)
+
+        return dropped
@@ -0,0 +1,91 @@
+import binascii
+import mmap
+
+from crc_tracker import CrcTracker
+
+# ------------------------------------------------------------------------------
+#  Firmware image held in a single buffer.
+#
+#  Files are mapped read-only, so the image costs page cache rather than heap
+#  and can be shared between any number of transfers. Packet segments and
+#  objects are handed out as memoryview slices of that buffer; nothing is
+#  copied until the bytes reach the transport. Cumulative CRCs at object
+#  boundaries are computed once per object size and kept with the image.
+# ------------------------------------------------------------------------------
+class FirmwareImage(object):
+
+    def __init__(self, data):
+        self._mmap = None
+
+        if isinstance(data, mmap.mmap):
+            self._mmap = data
+
+        self.view = memoryview(data).cast('B')
+        self.size = len(self.view)
+
+        self._crc32 = None
+        self._object_crcs = {}
+
+    @staticmethod
+    def from_file(path):
+        with open(path, 'rb') as f:
+            # Empty files can't be mapped
+            if f.seek(0, 2) == 0:
+                return FirmwareImage(b'')
+
+            return FirmwareImage(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.size
+
+    # --------------------------------------------------------------------------
+    #  Bytes [begin, end) of the image, without copying
+    # --------------------------------------------------------------------------
+    def segment(self, begin, end):
+        return self.view[begin:min(end, self.size)]
+
+    # --------------------------------------------------------------------------
+    #  Unsigned CRC32 of the whole image
+    # --------------------------------------------------------------------------
+    @property
+    def crc32(self):
+        if self._crc32 is None:
+            self._crc32 = binascii.crc32(self.view) & 0xFFFFFFFF
+
+        return self._crc32
+
+    # --------------------------------------------------------------------------
+    #  (offset, cumulative CRC32) at the end of every object of max_size bytes
+    # --------------------------------------------------------------------------
+    def object_crcs(self, max_size):
+        crcs = self._object_crcs.get(max_size)
+
+        if crcs is None:
+            crcs = []
+            crc = 0
+
+            for begin in range(0, self.size, max_size):
+                end = min(begin + max_size, self.size)
+                crc = binascii.crc32(self.view[begin:end], crc) & 0xFFFFFFFF
+                crcs.append((end, crc))
+
+            self._object_crcs[max_size] = crcs
+
+        return crcs
+
+    # --------------------------------------------------------------------------
+    #  A CrcTracker for one transfer, seeded with the object boundary CRCs so
+    #  verifying an object only hashes bytes inside it
+    # --------------------------------------------------------------------------
+    def crc_tracker(self, max_size=None):
+        if max_size is None:
+            return CrcTracker(self.view)
+
+        return CrcTracker(self.view, self.object_crcs(max_size))
+
+    def close(self):
+        self.view.release()
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Fleet DFU: update many devices in parallel.
+
+ Jobs are (MAC, device-id, image) entries. Each adapter (hci0, hci1, ...)
+ runs a bounded number of controller sessions at once, connection attempts
+ on an adapter are spaced out so scanning and transfers don't starve each
+ other, and every distinct image is unpacked and loaded only once.
+------------------------------------------------------------------------------
+"""
+import json
+import optparse
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from unpacker  import DfuPackage, PackageImage
+from transport import TRANSPORT_NAMES, create_transport
+
+from firmware_image import FirmwareImage
+from intel_hex      import load_image as load_hex_image
+from gatt_cache     import GattCache
+from resume_journal import ResumeJournal
+from transfer_plan  import PlanCache
+from prn_controller import AdaptivePrn
+from artifact_cache import ArtifactCache
+from scan           import LiveScanner
+from instrumentation import save_report, report_path
+from metrics        import Metrics
+from tracing        import Tracer
+
+from ble_secure_dfu_controller   import BleDfuControllerSecure
+from ble_legacy_dfu_controller   import BleDfuControllerLegacy
+from ble_ruuvitag_dfu_controller import BleDfuControllerRuuvitag
+
+
+# ------------------------------------------------------------------------------
+#  Keeps connection attempts through one adapter at least spacing seconds
+#  apart. Controllers call wait() before every connect.
+# ------------------------------------------------------------------------------
+class ConnectGate(object):
+
+    def __init__(self, spacing):
+        self.spacing = spacing
+
+        self.lock = threading.Lock()
+        self.last = None
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+
+            if self.last is not None and now < self.last + self.spacing:
+                time.sleep(self.last + self.spacing - now)
+
+            self.last = time.monotonic()
+
+# ------------------------------------------------------------------------------
+#  Images (unpacker.PackageImage) by path, each loaded once and shared
+#  read-only between the jobs using it.
+#
+#  With an artifact_cache.ArtifactCache, an image can also be the URL of a
+#  zip file or sha256:<hash> of one already in the artifact cache.
+# ------------------------------------------------------------------------------
+class ImageCache(object):
+
+    def __init__(self, artifacts=None):
+        self.artifacts = artifacts
+
+        self.lock = threading.Lock()
+        self.images = {}
+
+    def get(self, path):
+        if '://' in path or path.startswith('sha256:'):
+            return self._get_artifact(path)
+
+        path = os.path.abspath(path)
+
+        with self.lock:
+            image = self.images.get(path)
+            if image is not None:
+                return image
+
+            (name, extent) = os.path.splitext(path)
+
+            if extent == '.zip':
+                image = DfuPackage(path).load()
+
+            elif extent in ('.bin', '.hex'):
+                if extent == '.hex':
+                    (firmware, _, _) = load_hex_image(path)
+                else:
+                    firmware = FirmwareImage.from_file(path)
+
+                with open(f"{name}.dat", 'rb') as f:
+                    init = f.read()
+
+                image = PackageImage('application', firmware, init, None)
+
+            else:
+                raise Exception(f"Unsupported image: {path}")
+
+            self.images[path] = image
+
+            return image
+
+    def _get_artifact(self, ref):
+        if self.artifacts is None:
+            raise Exception(f"No artifact cache to get {ref}")
+
+        if ref.startswith('sha256:'):
+            sha256 = self.artifacts.resolve(ref[len('sha256:'):])
+            if sha256 is None:
+                raise Exception(f"{ref} is not in the artifact cache")
+        else:
+            sha256 = self.artifacts.fetch(ref)
+
+        with self.lock:
+            image = self.images.get(f"sha256:{sha256}")
+            if image is None:
+                image = self.artifacts.load(sha256)
+                self.images[f"sha256:{sha256}"] = image
+
+            return image
+
+    def delete(self):
+        for image in self.images.values():
+            image.firmware.close()
+
+        self.images = {}
+
+class Job(object):
+
+    PROGRESS_PATTERN = re.compile(r'\((\d+) of (\d+) bytes\)')
+
+    def __init__(self, address, image, device_id=None, legacy=False, adapter=None, priority=0):
+        self.address = address.upper()
+        self.image = image
+        self.device_id = device_id or None
+        self.legacy = legacy
+        self.adapter = adapter
+        self.priority = priority
+
+        # Assigned by Fleet.add()
+        self.id = None
+
+        self.status = 'pending'
+        self.error = None
+        self.ran_on = None
+        self.started = None
+        self.finished = None
+
+        self.sent = 0
+        self.total = 0
+
+        # Link drops the controller recovered from, and seconds lost to them
+        self.reconnects = 0
+        self.time_lost = 0.0
+
+        self.log = None
+
+        # Notified on every progress or status change
+        self.changed = threading.Condition()
+
+    # --------------------------------------------------------------------------
+    #  Console output of the controller running this job
+    # --------------------------------------------------------------------------
+    def output(self, text):
+        progressed = False
+
+        for match in Job.PROGRESS_PATTERN.finditer(text):
+            self.sent = int(match.group(1))
+            self.total = int(match.group(2))
+            progressed = True
+
+        if progressed:
+            self.notify()
+
+        if self.log is not None:
+            self.log.write(text)
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def progress(self):
+        if self.status == 'done':
+            return 100.0
+
+        if self.total == 0:
+            return 0.0
+
+        return 100.0 * self.sent / self.total
+
+    def to_json(self):
+        return {
+            'id'        : self.id,
+            'address'   : self.address,
+            'device_id' : self.device_id,
+            'image'     : self.image,
+            'adapter'   : self.ran_on,
+            'status'    : self.status,
+            'progress'  : round(self.progress(), 1),
+            'error'     : self.error,
+            'duration'  : (self.finished - self.started) if self.finished and self.started else None,
+            'reconnects': self.reconnects,
+            'time_lost' : round(self.time_lost, 2),
+        }
+
+# ------------------------------------------------------------------------------
+#  Routes print() output of worker threads to their job, everything else to
+#  the real stdout.
+# ------------------------------------------------------------------------------
+class _ThreadOutput(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        job = getattr(self.local, 'job', None)
+
+        if job is None:
+            return self.stream.write(text)
+
+        job.output(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class Fleet(object):
+
+    transport = 'gatttool'
+    att_mtu = 247
+    pkt_receipt_interval = None
+    max_pending_receipts = None
+    gatt_cache = None
+    resume_journal = None
+
+    # Adapt the PRN interval of each transfer, starting from the interval
+    # the device ended its previous transfer with (see tuning)
+    adaptive_prn = False
+
+    # Scan continuously on every adapter; jobs only connect to devices seen
+    # advertising (see NrfBleDfuController.device_index)
+    scan = False
+
+    log_dir = None
+    status_interval = 5.0
+
+    # Directory getting the transfer report (instrumentation.py) of each job
+    report_dir = None
+
+    # Optional metrics.Metrics accounting for every job, and the
+    # node-exporter textfile rewritten after each
+    metrics = None
+    metrics_textfile = None
+
+    # Optional tracing.Tracer getting a track per job
+    tracer = None
+
+    def __init__(self, adapters, per_adapter=2, connect_spacing=2.0):
+        self.adapters = adapters
+        self.per_adapter = per_adapter
+
+        self.gates = {adapter: ConnectGate(connect_spacing) for adapter in adapters}
+        self.images = ImageCache()
+        self.plan_cache = PlanCache()
+
+        # Last adaptive PRN interval by device address
+        self.tuning = {}
+
+        # scan.LiveScanner by adapter, while running with scan set
+        self.scanners = {}
+
+        # (-priority, id, job): higher priority first, then in order added
+        self.shared = queue.PriorityQueue()
+        self.pinned = {adapter: queue.PriorityQueue() for adapter in adapters}
+
+        self.jobs = []
+
+    def add(self, job):
+        if job.adapter is not None and job.adapter not in self.pinned:
+            raise ValueError(f"Job for {job.address} asks for unknown adapter {job.adapter}")
+
+        self.jobs.append(job)
+        job.id = len(self.jobs)
+
+        if job.adapter is None:
+            self.shared.put((-job.priority, job.id, job))
+        else:
+            self.pinned[job.adapter].put((-job.priority, job.id, job))
+
+    def run(self):
+        output = _ThreadOutput(sys.stdout)
+        sys.stdout = output
+
+        self._start_scanners()
+        workers = self._start_workers(output)
+
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(self.status_interval / len(workers))
+
+                self.print_status()
+        finally:
+            sys.stdout = output.stream
+            self._stop_scanners()
+            self.images.delete()
+
+        return all(job.status == 'done' for job in self.jobs)
+
+    def _start_scanners(self):
+        if self.scan:
+            for adapter in self.adapters:
+                self.scanners[adapter] = LiveScanner(adapter=adapter).start()
+
+    def _stop_scanners(self):
+        for scanner in self.scanners.values():
+            scanner.stop()
+
+        self.scanners = {}
+
+    def _start_workers(self, output):
+        workers = []
+        for adapter in self.adapters:
+            for i in range(0, self.per_adapter):
+                worker = threading.Thread(target=self._worker, args=(adapter, output), daemon=True)
+                worker.start()
+                workers.append(worker)
+
+        return workers
+
+    def print_status(self):
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+
+        print(f"\n{time.strftime('%H:%M:%S')} " + ', '.join(f"{count} {status}" for (status, count) in sorted(counts.items())))
+
+        for job in self.jobs:
+            line = f"  {job.address} {job.ran_on or '-':6} {job.status:8} {job.progress():5.1f}%"
+            if job.reconnects:
+                line += f"  {job.reconnects} reconnect(s), {job.time_lost:.1f} s lost"
+            if job.error:
+                line += f"  {job.error}"
+            print(line)
+
+    def _next_job(self, adapter):
+        for jobs in (self.pinned[adapter], self.shared):
+            try:
+                return jobs.get_nowait()[2]
+            except queue.Empty:
+                pass
+
+        return None
+
+    def _worker(self, adapter, output):
+        while True:
+            job = self._next_job(adapter)
+            if job is None:
+                return
+
+            output.local.job = job
+            try:
+                self._run_job(job, adapter)
+            finally:
+                output.local.job = None
+
+    def _run_job(self, job, adapter):
+        job.ran_on = adapter
+        job.status = 'running'
+        job.started = time.time()
+        job.notify()
+
+        if self.log_dir is not None:
+            job.log = open(os.path.join(self.log_dir, f"{job.address.replace(':', '')}.log"), 'w')
+
+        ble_dfu = None
+        error = None
+
+        try:
+            image = self.images.get(job.image)
+
+            transport = create_transport(self.transport, job.address, adapter)
+
+            if job.device_id is not None:
+                ble_dfu = BleDfuControllerRuuvitag(job.address, None, None, job.device_id, transport)
+            elif job.legacy:
+                ble_dfu = BleDfuControllerLegacy(job.address, None, None, transport)
+            else:
+                ble_dfu = BleDfuControllerSecure(job.address, None, None, transport)
+
+            ble_dfu.att_mtu = self.att_mtu
+            ble_dfu.connect_gate = self.gates[adapter]
+            if adapter in self.scanners:
+                ble_dfu.device_index = self.scanners[adapter].index
+            ble_dfu.gatt_cache = self.gatt_cache
+            ble_dfu.resume_journal = self.resume_journal
+            ble_dfu.plan_cache = self.plan_cache
+
+            if self.tracer is not None:
+                ble_dfu.use_tracer(self.tracer)
+
+            # A PRN of 0 disables receipts, and with them adapting the interval
+            if self.adaptive_prn and self.pkt_receipt_interval != 0:
+                ble_dfu.adaptive_prn = AdaptivePrn(initial=self.tuning.get(job.address, self.pkt_receipt_interval or 4))
+            elif self.pkt_receipt_interval is not None:
+                ble_dfu.pkt_receipt_interval = self.pkt_receipt_interval
+            if self.max_pending_receipts is not None:
+                ble_dfu.max_pending_receipts = self.max_pending_receipts
+
+            # Shared with every other job using this image
+            ble_dfu.use_image(image.firmware, image.init, image.type, image.sizes)
+
+            ble_dfu.update()
+
+            job.status = 'done'
+
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            error = e
+
+            if ble_dfu is not None:
+                ble_dfu.disconnect()
+
+        if ble_dfu is not None:
+            (job.reconnects, job.time_lost) = (ble_dfu.reconnects, ble_dfu.time_lost)
+
+        if ble_dfu is not None and self.report_dir is not None:
+            report = ble_dfu.transfer_report(error)
+            report['job'] = job.id
+
+            try:
+                save_report(report, report_path(self.report_dir, report))
+            except OSError as e:
+                print(f"Can't write report for {job.address}: {e}")
+
+        if ble_dfu is not None and self.metrics is not None:
+            self.metrics.record(ble_dfu, error, adapter)
+
+            if self.metrics_textfile is not None:
+                try:
+                    self.metrics.write_textfile(self.metrics_textfile)
+                except OSError as e:
+                    print(f"Can't write metrics: {e}")
+
+        if ble_dfu is not None and ble_dfu.adaptive_prn is not None:
+            self.tuning[job.address] = ble_dfu.adaptive_prn.interval
+
+        job.finished = time.time()
+
+        if job.log is not None:
+            job.log.close()
+            job.log = None
+
+        job.notify()
+
+# ------------------------------------------------------------------------------
+#  Jobs file: a JSON list of {"address", "image", "device_id", "legacy",
+#  "adapter", "priority"} objects, or one job per line as
+#      MAC,device-id,image[,adapter]
+#  with an empty device-id for non-RuuviTag devices and # starting comments.
+# ------------------------------------------------------------------------------
+def load_jobs(path, legacy=False):
+    with open(path, 'r') as f:
+        text = f.read()
+
+    if text.lstrip().startswith('['):
+        return [Job(entry['address'], entry['image'], entry.get('device_id'), entry.get('legacy', legacy), entry.get('adapter'), entry.get('priority', 0))
+                for entry in json.loads(text)]
+
+    jobs = []
+
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) < 3:
+            raise ValueError(f"Invalid job line: {line}")
+
+        jobs.append(Job(fields[0], fields[2], fields[1], legacy, fields[3] if len(fields) > 3 and fields[3] else None))
+
+    return jobs
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <jobs file>\n\nJobs file lines: MAC,device-id,image[,adapter]')
+
+    parser.add_option('-i', '--adapters', dest='adapters', default='hci0',
+                      help='comma separated adapters to use (default: %default)')
+    parser.add_option('-n', '--per-adapter', dest='per_adapter', type='int', default=2,
+                      help='concurrent sessions per adapter (default: %default)')
+    parser.add_option('--connect-spacing', dest='connect_spacing', type='float', default=2.0,
+                      help='minimum seconds between connection attempts on one adapter (default: %default)')
+    parser.add_option('--scan', dest='scan', action='store_true', default=False,
+                      help='scan continuously and only connect to devices seen advertising')
+    parser.add_option('--legacy', dest='legacy', action='store_true', default=False,
+                      help='jobs without a device id use the legacy bootloader')
+    parser.add_option('--transport', dest='transport', type='choice', choices=TRANSPORT_NAMES, default='gatttool',
+                      help='BLE transport: gatttool (default) or socket')
+    parser.add_option('--mtu', dest='mtu', type='int', default=247,
+                      help='ATT MTU to request at connect time')
+    parser.add_option('--prn', dest='prn', type='int', default=None,
+                      help='Packet Receipt Notification interval (0 disables receipts)')
+    parser.add_option('--adaptive-prn', dest='adaptive_prn', action='store_true', default=False,
+                      help='adapt the PRN interval to link quality, starting from --prn (default 4)')
+    parser.add_option('--window', dest='window', type='int', default=None,
+                      help='PRN batches in flight before waiting for a receipt')
+    parser.add_option('--gatt-cache', dest='gatt_cache', default=GattCache.default_path(),
+                      help='file caching discovered GATT handles')
+    parser.add_option('--no-gatt-cache', dest='gatt_cache', action='store_const', const=None,
+                      help='always run GATT discovery')
+    parser.add_option('--journal', dest='journal', default=ResumeJournal.default_path(),
+                      help='resume journal file')
+    parser.add_option('--no-journal', dest='journal', action='store_const', const=None,
+                      help='do not keep a resume journal')
+    parser.add_option('--plan-dir', dest='plan_dir', default=None,
+                      help='directory keeping transfer plans for reuse across runs')
+    parser.add_option('--artifact-cache', dest='artifact_cache', default=ArtifactCache.default_path(),
+                      help='directory keeping zip files given by URL or sha256:<hash> (default: %default)')
+    parser.add_option('--log-dir', dest='log_dir', default=None,
+                      help='write each job\'s output to <log-dir>/<MAC>.log')
+    parser.add_option('--report', dest='report', default=None,
+                      help='write per-job results as JSON to this file')
+    parser.add_option('--report-dir', dest='report_dir', default=None,
+                      help='write each job\'s transfer report (phase timings, receipt round trips) to <dir>/<MAC>-<time>.json')
+    parser.add_option('--metrics-textfile', dest='metrics_textfile', default=None,
+                      help='keep Prometheus metrics of the jobs in this node-exporter textfile (*.prom)')
+    parser.add_option('--trace', dest='trace', default=None,
+                      help='write a timeline of all jobs, one track per device, to this file as Chrome trace JSON')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(2)
+
+    if options.prn is not None and options.prn < 0:
+        print("PRN interval must be 0 (receipts disabled) or more")
+        sys.exit(2)
+
+    try:
+        jobs = load_jobs(args[0], options.legacy)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Failed to load jobs: {e}")
+        sys.exit(2)
+
+    fleet = Fleet([adapter.strip() for adapter in options.adapters.split(',') if adapter.strip()],
+                  max(options.per_adapter, 1), options.connect_spacing)
+
+    fleet.transport = options.transport
+    fleet.att_mtu = options.mtu
+    fleet.pkt_receipt_interval = options.prn
+    fleet.adaptive_prn = options.adaptive_prn
+    fleet.scan = options.scan
+    fleet.max_pending_receipts = max(options.window, 1) if options.window is not None else None
+    fleet.log_dir = options.log_dir
+    fleet.report_dir = options.report_dir
+
+    if options.metrics_textfile is not None:
+        fleet.metrics = Metrics()
+        fleet.metrics.load_textfile(options.metrics_textfile)
+        fleet.metrics_textfile = options.metrics_textfile
+
+    if options.trace is not None:
+        fleet.tracer = Tracer()
+
+    if options.gatt_cache is not None:
+        fleet.gatt_cache = GattCache(options.gatt_cache)
+    if options.journal is not None:
+        fleet.resume_journal = ResumeJournal(options.journal)
+    if options.plan_dir is not None:
+        fleet.plan_cache = PlanCache(options.plan_dir)
+    if options.artifact_cache is not None:
+        fleet.images.artifacts = ArtifactCache(options.artifact_cache)
+    if options.log_dir is not None:
+        os.makedirs(options.log_dir, exist_ok=True)
+
+    try:
+        for job in jobs:
+            fleet.add(job)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+
+    success = fleet.run()
+
+    if fleet.tracer is not None:
+        fleet.tracer.save(options.trace)
+
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump([job.to_json() for job in fleet.jobs], f, indent=2)
+
+    sys.exit(0 if success else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+
+from transport import Characteristic
+
+UUID_SERVICE_CHANGED     = '00002a05-0000-1000-8000-00805f9b34fb'
+UUID_FIRMWARE_REVISION   = '00002a26-0000-1000-8000-00805f9b34fb'
+
+# ------------------------------------------------------------------------------
+#  Characteristics of one peripheral, indexed by UUID.
+#  Built from a single discovery pass and shared by every handle lookup.
+# ------------------------------------------------------------------------------
+class GattDatabase(object):
+
+    def __init__(self, chars, from_cache=False):
+        self.chars = list(chars)
+        self.from_cache = from_cache
+
+        self.by_uuid = {}
+        for char in self.chars:
+            self.by_uuid.setdefault(char.uuid, char)
+
+        service_changed = self.by_uuid.get(UUID_SERVICE_CHANGED)
+        self.service_changed_handle = service_changed.value_handle if service_changed else None
+
+    def find(self, uuid):
+        return self.by_uuid.get(uuid)
+
+    # --------------------------------------------------------------------------
+    #  Returns (char handle, value handle, CCCD handle) or None.
+    #  The CCCD is assumed to directly follow the value, as on Nordic stacks.
+    # --------------------------------------------------------------------------
+    def handles(self, uuid):
+        char = self.by_uuid.get(uuid)
+        if char is None:
+            return None
+
+        return (char.handle, char.value_handle, char.value_handle+1)
+
+    def to_json(self):
+        return [list(char) for char in self.chars]
+
+    @staticmethod
+    def from_json(data):
+        return GattDatabase([Characteristic(*char) for char in data], from_cache=True)
+
+# ------------------------------------------------------------------------------
+#  On-disk store of GattDatabase entries keyed by MAC and firmware version,
+#  so repeat updates of the same device model skip discovery.
+#
+#  Peripherals without a readable Firmware Revision are never cached: a
+#  legacy application and its bootloader share one address, and nothing
+#  else tells their handle tables apart.
+# ------------------------------------------------------------------------------
+class GattCache(object):
+
+    # Controllers running in parallel share one cache file
+    _lock = threading.Lock()
+
+    @staticmethod
+    def default_path():
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(cache_home, 'ota-dfu', 'gatt.json')
+
+    def __init__(self, path=None):
+        self.path = path or GattCache.default_path()
+        self.entries = None
+
+    def _key(self, mac, version):
+        return f"{mac.upper()}|{version}"
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                self.entries = {}
+
+        return self.entries
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self, mac, version):
+        if version is None:
+            return None
+
+        with GattCache._lock:
+            entry = self._load().get(self._key(mac, version))
+        if entry is None:
+            return None
+
+        return GattDatabase.from_json(entry['chars'])
+
+    def store(self, mac, version, database):
+        if version is None:
+            return
+
+        with GattCache._lock:
+            # Pick up entries other processes stored in the meantime
+            self.entries = None
+            entries = self._load()
+
+            # A new firmware version replaces whatever was known for the device
+            for key in [key for key in entries if key.split('|')[0] == mac.upper()]:
+                del entries[key]
+
+            entries[self._key(mac, version)] = {'chars': database.to_json(), 'time': int(time.time())}
+            self._save()
+
+    def invalidate(self, mac):
+        with GattCache._lock:
+            self.entries = None
+            entries = self._load()
+
+            stale = [key for key in entries if key.split('|')[0] == mac.upper()]
+            if not stale:
+                return
+
+            for key in stale:
+                del entries[key]
+            self._save()
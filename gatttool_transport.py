@@ -0,0 +1,358 @@
+import re
+import threading
+import time
+
+import pexpect
+
+from transport import Transport, Characteristic, ConnectionLost, ScanUnavailable, Advertisement, ATT_DEFAULT_MTU
+from events    import EventQueue, Notification, WriteAck, Disconnected, Error, Connected, MtuExchanged, Value
+
+verbose = False
+
+# ------------------------------------------------------------------------------
+#  State of one gatttool process, owned by its reader thread
+# ------------------------------------------------------------------------------
+class _Session(object):
+
+    def __init__(self, child):
+        self.child = child
+
+        self.events = EventQueue()
+        self.responses = EventQueue()
+        self.prompt = threading.Event()
+
+        self.connected = False
+
+        # Set once the link of the current connection went down
+        self.lost = threading.Event()
+
+# ------------------------------------------------------------------------------
+#  Transport driving an interactive gatttool session through pexpect.
+#
+#  A reader thread drains the pty as output arrives and decodes each line
+#  once into an event (see events.py). Notifications and link loss are queued
+#  for wait_for_notification(); everything else answers the command that is
+#  currently waiting on the response queue. The pty never backs up and
+#  nothing is re-scanned.
+# ------------------------------------------------------------------------------
+class GatttoolTransport(Transport):
+
+    # gatttool prints the whole characteristic list in one burst, so once the
+    # first line arrived a short quiet period marks the end of the listing
+    discovery_idle_timeout = 0.5
+
+    # After a notification timeout, how long to wait for the refreshed
+    # prompt to tell whether the link is still up
+    link_check_timeout = 0.5
+
+    # While waiting for a notification, seconds between prompt refreshes
+    # that show whether the link went down
+    link_check_interval = 1.0
+
+    # gatttool colours the address in the prompt while connected
+    PROMPT_PATTERN = re.compile(r'(\x1b\[0;34m)?\[[0-9A-Fa-f: ]*\](?:\x1b\[0m)?\[LE\]> ')
+
+    LINE_PATTERNS = [
+        (re.compile(r'(?:Notification|Indication) +handle = (0x[0-9a-f]+) value: ([0-9a-f ]*)'),
+            lambda m: Notification(int(m.group(1), 16), bytes.fromhex(m.group(2)))),
+        (re.compile(r'Characteristic value was written successfully'),
+            lambda m: WriteAck(None)),
+        (re.compile(r'handle: (0x[0-9a-f]+), char properties: (0x[0-9a-f]+), char value handle: (0x[0-9a-f]+), uuid: ([0-9a-f-]+)'),
+            lambda m: Characteristic(int(m.group(1), 16), int(m.group(2), 16), int(m.group(3), 16), m.group(4))),
+        (re.compile(r'Characteristic value/descriptor: ([0-9a-f ]*)'),
+            lambda m: Value(None, bytes.fromhex(m.group(1)))),
+        (re.compile(r'handle: (0x[0-9a-f]+)\s+value: ([0-9a-f ]*)'),
+            lambda m: Value(int(m.group(1), 16), bytes.fromhex(m.group(2)))),
+        (re.compile(r'MTU was exchanged successfully: (\d+)'),
+            lambda m: MtuExchanged(int(m.group(1)))),
+        (re.compile(r'Connection successful'),
+            lambda m: Connected(None)),
+        (re.compile(r'(?:Error: |Command Failed: |connect error: )(.*)'),
+            lambda m: Error(m.group(1).strip())),
+        (re.compile(r'(.*(?:failed|Failed).*)'),
+            lambda m: Error(m.group(1).strip())),
+    ]
+
+    def __init__(self, target_mac, adapter=None):
+        super().__init__(target_mac, adapter)
+
+        self._spawn()
+
+    def _spawn(self):
+        adapter = f"-i {self.adapter} " if self.adapter else ""
+
+        self.ble_conn = pexpect.spawn(f"gatttool {adapter}-b '{self.target_mac}' -t random --interactive")
+        self.ble_conn.delaybeforesend = 0
+
+        # Fresh queues per process: a reader still draining an old session
+        # can only ever post to its own
+        self.session = _Session(self.ble_conn)
+        self.events = self.session.events
+        self.responses = self.session.responses
+
+        threading.Thread(target=self._read_loop, args=(self.session,), daemon=True).start()
+
+    # --------------------------------------------------------------------------
+    #  Reader thread
+    # --------------------------------------------------------------------------
+    def _read_loop(self, session):
+        pending = ''
+
+        while True:
+            try:
+                data = session.child.read_nonblocking(4096, timeout=None)
+            except (pexpect.EOF, OSError, ValueError) as e:
+                session.lost.set()
+                session.events.put(Disconnected('gatttool exited'))
+                session.responses.put(Disconnected('gatttool exited'))
+                return
+
+            pending += data.decode(errors='replace')
+
+            # Prompts are never newline terminated; handle and remove them
+            for match in self.PROMPT_PATTERN.finditer(pending):
+                session.prompt.set()
+                self._on_prompt(session, match.group(1) is not None)
+
+            pending = self.PROMPT_PATTERN.sub('', pending)
+
+            lines = pending.split('\n')
+            pending = lines.pop()
+
+            for line in lines:
+                self._on_line(session, line)
+
+    def _on_prompt(self, session, connected):
+        if session.connected and not connected:
+            if verbose: print('Connection lost!')
+            session.lost.set()
+            session.events.put(Disconnected('link lost'))
+            session.responses.put(Disconnected('link lost'))
+
+        session.connected = connected
+
+    def _on_line(self, session, line):
+        for (pattern, decode) in self.LINE_PATTERNS:
+            match = pattern.search(line)
+            if match is None:
+                continue
+
+            event = decode(match)
+            if verbose: print(event)
+
+            if isinstance(event, Notification):
+                session.events.put(event)
+                return
+
+            if isinstance(event, Error) and 'Disconnected' in event.message:
+                session.lost.set()
+                session.events.put(Disconnected(event.message))
+
+            session.responses.put(event)
+            return
+
+    # --------------------------------------------------------------------------
+    #  Wait for a reply of one of the given event types. Errors end the wait
+    #  (returned as such), link loss raises ConnectionLost.
+    # --------------------------------------------------------------------------
+    def _wait_response(self, types, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+
+        while True:
+            event = self.responses.get(max(deadline - time.monotonic(), 0))
+
+            if event is None:
+                return None
+
+            if isinstance(event, Disconnected):
+                self.responses.put(event)
+                raise ConnectionLost()
+
+            if isinstance(event, types) or isinstance(event, Error):
+                return event
+
+    def _command(self, cmd):
+        if verbose: print(cmd)
+
+        # Replies nobody waited for (e.g. acks of unconfirmed writes) must not
+        # answer this command
+        self.responses.drain()
+        self.ble_conn.sendline(cmd)
+
+    def retarget(self, target_mac):
+        self.disconnect()
+
+        self.target_mac = target_mac
+        self._spawn()
+
+    # --------------------------------------------------------------------------
+    #  Wait for the prompt and connect.
+    # --------------------------------------------------------------------------
+    def connect(self):
+        if not self.session.prompt.wait(self.timeout):
+            return False
+
+        # Link loss of the previous connection doesn't concern this one
+        self.events.clear()
+        self.responses.clear()
+        self.session.lost.clear()
+
+        self._command('connect')
+
+        try:
+            event = self._wait_response(Connected)
+        except ConnectionLost:
+            return False
+
+        return isinstance(event, Connected)
+
+    # --------------------------------------------------------------------------
+    #  Connect again, in a new gatttool if the old one exited
+    # --------------------------------------------------------------------------
+    def reconnect(self):
+        if not self.ble_conn.isalive():
+            self._spawn()
+
+        return self.connect()
+
+    # --------------------------------------------------------------------------
+    #  Example format: "MTU was exchanged successfully: 247"
+    # --------------------------------------------------------------------------
+    def exchange_mtu(self, mtu):
+        self._command(f'mtu {mtu}')
+
+        event = self._wait_response(MtuExchanged)
+        if not isinstance(event, MtuExchanged):
+            return ATT_DEFAULT_MTU
+
+        return event.mtu
+
+    def disconnect(self):
+        self.ble_conn.sendline('exit')
+        self.ble_conn.close()
+
+    # --------------------------------------------------------------------------
+    #  Example format:
+    #  "handle: 0x000e, char properties: 0x28, char value handle: 0x000f, uuid: 8ec90001-..."
+    # --------------------------------------------------------------------------
+    def discover_characteristics(self):
+        self._command('characteristics')
+
+        chars = []
+        timeout = self.timeout
+
+        while True:
+            event = self._wait_response(Characteristic, timeout)
+            if not isinstance(event, Characteristic):
+                break
+
+            chars.append(event)
+            timeout = self.discovery_idle_timeout
+
+        return chars
+
+    # --------------------------------------------------------------------------
+    #  Example format: "Characteristic value/descriptor: 08 00 "
+    # --------------------------------------------------------------------------
+    def read(self, handle):
+        self._command(f'char-read-hnd 0x{handle:04x}')
+
+        event = self._wait_response(Value)
+        if not isinstance(event, Value):
+            return None
+
+        return event.value
+
+    # --------------------------------------------------------------------------
+    #  Example format: "handle: 0x0012 \t value: 33 2e 34 31 "
+    # --------------------------------------------------------------------------
+    def read_by_uuid(self, uuid):
+        self._command(f'char-read-uuid {uuid}')
+
+        event = self._wait_response(Value)
+        if not isinstance(event, Value):
+            return None
+
+        return event.value
+
+    def write_request(self, handle, data, wait=True):
+        self._command(f'char-write-req 0x{handle:04x} {memoryview(data).hex()}')
+
+        if not wait:
+            return True
+
+        return isinstance(self._wait_response(WriteAck), WriteAck)
+
+    def write_command(self, handle, data):
+        # Writes without response would otherwise go on until the next
+        # receipt is waited for
+        if self.session.lost.is_set():
+            raise ConnectionLost()
+
+        cmd = f'char-write-cmd 0x{handle:04x} {memoryview(data).hex()}'
+
+        if verbose: print(cmd)
+
+        self.ble_conn.sendline(cmd)
+
+    # --------------------------------------------------------------------------
+    #  Passive scan with hcitool. Example format: "CD:E3:4A:47:1C:E5 DfuTarg"
+    # --------------------------------------------------------------------------
+    def wait_for_advertisement(self, macs, timeout):
+        adapter = f"-i {self.adapter} " if self.adapter else ""
+        started = time.monotonic()
+
+        try:
+            scan = pexpect.spawn(f"hcitool {adapter}lescan --passive --duplicates")
+        except pexpect.ExceptionPexpect as e:
+            raise ScanUnavailable(f"Can't run hcitool: {e}")
+
+        try:
+            index = scan.expect([re.escape(mac.upper()) for mac in macs] + [pexpect.EOF], timeout)
+
+            if index == len(macs):
+                raise ScanUnavailable(f"hcitool lescan failed: {scan.before.decode(errors='replace').strip()}")
+
+            return Advertisement(macs[index].upper(), time.monotonic() - started)
+
+        except pexpect.TIMEOUT:
+            return None
+
+        finally:
+            # Interrupted, hcitool disables scanning on its way out
+            if scan.isalive():
+                scan.sendintr()
+                scan.expect([pexpect.EOF, pexpect.TIMEOUT], 1)
+            scan.close(force=True)
+
+    # --------------------------------------------------------------------------
+    #  Example format: "Notification handle = 0x0019 value: 10 01 01"
+    # --------------------------------------------------------------------------
+    def wait_for_notification(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = time.monotonic() + timeout
+
+        while True:
+            event = self.events.get(min(self.link_check_interval, max(deadline - time.monotonic(), 0)))
+            if event is not None:
+                break
+
+            # gatttool does not report link loss by itself, but the prompt
+            # loses its colour once disconnected. Poke it for a fresh one.
+            self.ble_conn.sendline('')
+
+            if time.monotonic() >= deadline:
+                event = self.events.get(self.link_check_timeout)
+
+                if event is None:
+                    return None
+                break
+
+        if isinstance(event, Disconnected):
+            self.events.put(event)
+            print('Connection lost!')
+            raise ConnectionLost()
+
+        return (event.handle, event.value)
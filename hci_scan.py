@@ -0,0 +1,191 @@
+import re
+import select
+import socket
+import struct
+import time
+
+from collections import namedtuple
+
+verbose = False
+
+# ------------------------------------------------------------------------------
+#  LE scanning on a raw HCI socket.
+#
+#  The scanner sets the controller's scan parameters and enables scanning
+#  with HCI commands, then reads LE Advertising Report events as they
+#  arrive. Needs CAP_NET_RAW (root), like the L2CAP socket transport.
+# ------------------------------------------------------------------------------
+AF_BLUETOOTH = getattr(socket, 'AF_BLUETOOTH', 31)
+BTPROTO_HCI  = getattr(socket, 'BTPROTO_HCI', 1)
+SOL_HCI      = getattr(socket, 'SOL_HCI', 0)
+HCI_FILTER   = getattr(socket, 'HCI_FILTER', 2)
+
+HCI_COMMAND_PKT          = 0x01
+HCI_EVENT_PKT            = 0x04
+
+EVT_CMD_COMPLETE         = 0x0E
+EVT_LE_META              = 0x3E
+LE_ADVERTISING_REPORT    = 0x02
+
+OGF_LE                   = 0x08
+LE_SET_SCAN_PARAMETERS   = (OGF_LE << 10) | 0x000B
+LE_SET_SCAN_ENABLE       = (OGF_LE << 10) | 0x000C
+
+SCAN_PASSIVE             = 0x00
+SCAN_ACTIVE              = 0x01
+
+# ------------------------------------------------------------------------------
+#  One advertisement. data holds the raw AD structures.
+# ------------------------------------------------------------------------------
+AdvertisingReport = namedtuple('AdvertisingReport', ['mac', 'address_type', 'event_type', 'rssi', 'data'])
+
+def adapter_index(adapter):
+    if adapter is None:
+        return 0
+
+    match = re.match(r'^hci(\d+)$', adapter)
+    if not match:
+        raise OSError(f"Scanning needs an adapter name like hci0, not {adapter}")
+
+    return int(match.group(1))
+
+class HciScanner(object):
+
+    # Scan interval and window in units of 0.625 ms: scan continuously
+    interval = 0x0010
+    window   = 0x0010
+
+    command_timeout = 2.0
+
+    def __init__(self, adapter=None, active=False):
+        self.adapter = adapter
+        self.active = active
+
+        self.sock = None
+
+    # --------------------------------------------------------------------------
+    #  Open the socket and enable scanning. Raises OSError if the adapter
+    #  can't be used.
+    # --------------------------------------------------------------------------
+    def start(self):
+        sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+
+        try:
+            sock.bind((adapter_index(self.adapter),))
+
+            # struct hci_filter: type mask, event mask, opcode
+            sock.setsockopt(SOL_HCI, HCI_FILTER, struct.pack('<IIIH', 1 << HCI_EVENT_PKT,
+                            1 << EVT_CMD_COMPLETE, 1 << (EVT_LE_META - 32), 0))
+        except OSError as e:
+            sock.close()
+            raise
+
+        self.sock = sock
+
+        try:
+            # Parameters can't be changed while a scan is running
+            self._command(LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+
+            status = self._command(LE_SET_SCAN_PARAMETERS, struct.pack('<BHHBB', SCAN_ACTIVE if self.active else SCAN_PASSIVE,
+                                                                       self.interval, self.window, 0, 0))
+            if status != 0:
+                raise OSError(f"LE Set Scan Parameters failed: 0x{status:02x}")
+
+            status = self._command(LE_SET_SCAN_ENABLE, struct.pack('<BB', 1, 0))
+            if status != 0:
+                raise OSError(f"LE Set Scan Enable failed: 0x{status:02x}")
+        except OSError as e:
+            self.stop()
+            raise
+
+        return self
+
+    def stop(self):
+        if self.sock is None:
+            return
+
+        try:
+            self._command(LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+        except OSError as e:
+            pass
+
+        self.sock.close()
+        self.sock = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --------------------------------------------------------------------------
+    #  Send a command and wait for its Command Complete. Returns the status,
+    #  None if it didn't complete in time.
+    # --------------------------------------------------------------------------
+    def _command(self, opcode, params):
+        self.sock.send(struct.pack('<BHB', HCI_COMMAND_PKT, opcode, len(params)) + params)
+
+        deadline = time.monotonic() + self.command_timeout
+
+        while True:
+            packet = self._read(max(deadline - time.monotonic(), 0))
+            if packet is None:
+                return None
+
+            # event, length, allowed commands, opcode, status
+            if packet[1] == EVT_CMD_COMPLETE and len(packet) >= 7 and struct.unpack_from('<H', packet, 4)[0] == opcode:
+                return packet[6]
+
+    def _read(self, timeout):
+        (readable, _, _) = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return None
+
+        return self.sock.recv(260)
+
+    # --------------------------------------------------------------------------
+    #  Advertising reports until timeout (forever if None)
+    # --------------------------------------------------------------------------
+    def reports(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+
+            packet = self._read(remaining)
+            if packet is None:
+                return
+
+            if packet[0] != HCI_EVENT_PKT or packet[1] != EVT_LE_META or len(packet) < 5 or packet[3] != LE_ADVERTISING_REPORT:
+                continue
+
+            yield from _parse_reports(packet)
+
+# ------------------------------------------------------------------------------
+#  Reports of one LE Advertising Report event: packet type, event, length,
+#  subevent, count, then per report event type, address type, address,
+#  data length, data and RSSI
+# ------------------------------------------------------------------------------
+def _parse_reports(packet):
+    position = 5
+
+    for i in range(0, packet[4]):
+        if position + 9 > len(packet):
+            return
+
+        (event_type, address_type) = (packet[position], packet[position + 1])
+        mac = ':'.join(f'{byte:02X}' for byte in reversed(packet[position + 2:position + 8]))
+        length = packet[position + 8]
+
+        data = bytes(packet[position + 9:position + 9 + length])
+        if position + 9 + length >= len(packet):
+            return
+
+        rssi = struct.unpack_from('<b', packet, position + 9 + length)[0]
+        position += 10 + length
+
+        if verbose: print(f"{mac} rssi {rssi} {data.hex()}")
+
+        yield AdvertisingReport(mac, address_type, event_type, rssi, data)
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+
+from bisect import bisect_left
+
+# ------------------------------------------------------------------------------
+#  Timing of one update, cheap enough to stay on in production.
+#
+#  Controllers wrap each phase (connect, discovery, DFU switch, init packet,
+#  every object's create / stream / checksum / execute, validate, activate)
+#  in phase(), which costs two time.monotonic() calls and a list append.
+#  Nothing is allocated per packet: a phase's byte count is updated in
+#  place and receipt round trips go into a fixed histogram.
+# ------------------------------------------------------------------------------
+
+# Upper bounds of the receipt round-trip histogram buckets, in ms
+RECEIPT_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+class Phase(object):
+    __slots__ = ('instrumentation', 'name', 'attrs', 'bytes', 'start', 'end', 'error')
+
+    def __init__(self, instrumentation, name, attrs, bytes=0):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.attrs = attrs
+        self.bytes = bytes
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.monotonic()
+
+        if exc_type is not None:
+            self.error = exc_type.__name__
+
+        self.instrumentation.phases.append(self)
+
+        tracer = self.instrumentation.tracer
+        if tracer is not None:
+            args = dict(self.attrs, bytes=self.bytes) if self.bytes else dict(self.attrs)
+            if self.error is not None:
+                args['error'] = self.error
+
+            tracer.complete(self.instrumentation.track, self.name, self.start, self.end, 'phase', **args)
+
+    def duration(self):
+        return self.end - self.start
+
+    def to_json(self, origin):
+        data = {
+            'name'     : self.name,
+            'start'    : round(self.start - origin, 6),
+            'duration' : round(self.end - self.start, 6),
+        }
+
+        if self.bytes:
+            data['bytes'] = self.bytes
+        if self.error is not None:
+            data['error'] = self.error
+
+        data.update(self.attrs)
+        return data
+
+# ------------------------------------------------------------------------------
+#  Receipt round trips (PRN batch sent to its receipt checked)
+# ------------------------------------------------------------------------------
+class Histogram(object):
+
+    def __init__(self, buckets_ms=RECEIPT_BUCKETS_MS):
+        self.bounds = [bound / 1000.0 for bound in buckets_ms]
+        self.counts = [0] * (len(self.bounds) + 1)
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+
+        self.count += 1
+        self.total += seconds
+
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def to_json(self):
+        labels = [f"<={int(bound * 1000)}ms" for bound in self.bounds] + [f">{int(self.bounds[-1] * 1000)}ms"]
+
+        return {
+            'count'     : self.count,
+            'mean_ms'   : round(self.total / self.count * 1000.0, 3) if self.count else None,
+            'min_ms'    : round(self.min * 1000.0, 3) if self.min is not None else None,
+            'max_ms'    : round(self.max * 1000.0, 3) if self.max is not None else None,
+            'histogram' : {label: count for (label, count) in zip(labels, self.counts) if count},
+        }
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.started_at = time.time()
+
+        self.phases = []
+        self.receipts = Histogram()
+        self.retransmits = 0
+
+        # Optional tracing.Tracer and track getting every phase as a span
+        self.tracer = None
+        self.track = None
+
+    # --------------------------------------------------------------------------
+    #  Context manager timing one phase. Extra keyword arguments (e.g. the
+    #  object offset) are kept with it; bytes can also be added while it runs.
+    # --------------------------------------------------------------------------
+    def phase(self, name, bytes=0, **attrs):
+        return Phase(self, name, attrs, bytes)
+
+    def receipt(self, seconds):
+        self.receipts.add(seconds)
+
+    def retransmit(self):
+        self.retransmits += 1
+
+    # --------------------------------------------------------------------------
+    #  Count, seconds and bytes per phase name, in the order first seen
+    # --------------------------------------------------------------------------
+    def totals(self):
+        totals = {}
+
+        for phase in self.phases:
+            total = totals.setdefault(phase.name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += phase.end - phase.start
+            total['bytes'] += phase.bytes
+
+        for total in totals.values():
+            total['seconds'] = round(total['seconds'], 6)
+
+        return totals
+
+    def to_json(self):
+        return {
+            'started'     : self.started_at,
+            'duration'    : round(time.monotonic() - self.started, 6),
+            'totals'      : self.totals(),
+            'receipts'    : self.receipts.to_json(),
+            'retransmits' : self.retransmits,
+            'phases'      : [phase.to_json(self.started) for phase in self.phases],
+        }
+
+# ------------------------------------------------------------------------------
+#  Where a report directory keeps the report of an update: <MAC>-<time>.json
+# ------------------------------------------------------------------------------
+def report_path(directory, report):
+    started = time.strftime('%Y%m%d-%H%M%S', time.localtime(report['started']))
+    return os.path.join(directory, f"{report['address'].replace(':', '')}-{started}.json")
+
+# ------------------------------------------------------------------------------
+#  Write a report (see NrfBleDfuController.transfer_report) atomically
+# ------------------------------------------------------------------------------
+def save_report(report, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,187 @@
+import binascii
+import hashlib
+import json
+import os
+
+from firmware_image import FirmwareImage
+
+# ------------------------------------------------------------------------------
+#  Streaming Intel HEX loader.
+#
+#  The file is read twice, a line at a time. The first pass validates every
+#  record and collects the address ranges (following extended segment and
+#  extended linear address records); the second copies the data records
+#  straight into a single buffer preallocated for the whole range and filled
+#  with gap_fill. Each line is decoded with one unhexlify call, so nothing
+#  is done per byte in Python.
+# ------------------------------------------------------------------------------
+DATA                        = 0x00
+END_OF_FILE                 = 0x01
+EXTENDED_SEGMENT_ADDRESS    = 0x02
+START_SEGMENT_ADDRESS       = 0x03
+EXTENDED_LINEAR_ADDRESS     = 0x04
+START_LINEAR_ADDRESS        = 0x05
+
+# Erased flash
+DEFAULT_GAP_FILL            = 0xFF
+
+# ------------------------------------------------------------------------------
+#  (address, data) of every data record
+# ------------------------------------------------------------------------------
+def _records(path):
+    base = 0
+
+    with open(path, 'rb') as f:
+        for (number, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            if line[:1] != b':':
+                raise Exception(f"{path}:{number}: not an Intel HEX record")
+
+            try:
+                record = binascii.unhexlify(line[1:])
+            except (binascii.Error, ValueError) as e:
+                raise Exception(f"{path}:{number}: invalid hex digits")
+
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise Exception(f"{path}:{number}: bad record length")
+
+            if sum(record) & 0xFF:
+                raise Exception(f"{path}:{number}: checksum mismatch")
+
+            rectype = record[3]
+
+            if rectype == DATA:
+                yield (base + ((record[1] << 8) | record[2]), record[4:-1])
+
+            elif rectype == END_OF_FILE:
+                return
+
+            elif rectype == EXTENDED_SEGMENT_ADDRESS:
+                base = ((record[4] << 8) | record[5]) << 4
+
+            elif rectype == EXTENDED_LINEAR_ADDRESS:
+                base = ((record[4] << 8) | record[5]) << 16
+
+            elif rectype not in (START_SEGMENT_ADDRESS, START_LINEAR_ADDRESS):
+                raise Exception(f"{path}:{number}: unknown record type {rectype}")
+
+# ------------------------------------------------------------------------------
+#  Merged [start, end) address ranges covered by data records
+# ------------------------------------------------------------------------------
+def address_ranges(path):
+    ranges = []
+
+    for (address, data) in _records(path):
+        end = address + len(data)
+
+        if ranges and ranges[-1][1] == address:
+            ranges[-1][1] = end
+        else:
+            ranges.append([address, end])
+
+    # Records don't have to be in address order
+    ranges.sort()
+
+    merged = []
+    for (start, end) in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return [tuple(r) for r in merged]
+
+# ------------------------------------------------------------------------------
+#  Load path into one buffer spanning the lowest to the highest address.
+#  Returns (data, start address, ranges).
+# ------------------------------------------------------------------------------
+def load(path, gap_fill=DEFAULT_GAP_FILL):
+    ranges = address_ranges(path)
+    if not ranges:
+        return (bytearray(), 0, ranges)
+
+    start = ranges[0][0]
+    data = bytearray([gap_fill]) * (ranges[-1][1] - start)
+
+    for (address, record) in _records(path):
+        offset = address - start
+        data[offset:offset + len(record)] = record
+
+    return (data, start, ranges)
+
+# ------------------------------------------------------------------------------
+#  Converted images on disk, keyed by the SHA-256 of the hex file and the gap
+#  fill. A cached image is mapped directly by FirmwareImage.
+# ------------------------------------------------------------------------------
+class HexCache(object):
+
+    @staticmethod
+    def default_path():
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(cache_home, 'ota-dfu', 'hex')
+
+    def __init__(self, path=None):
+        self.path = path or HexCache.default_path()
+
+    def _key(self, path, gap_fill):
+        file_hash = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+
+        return f"{file_hash.hexdigest()}-{gap_fill:02x}"
+
+    # --------------------------------------------------------------------------
+    #  Path of the converted binary and the address info of hex file path,
+    #  converting it if it isn't cached yet
+    # --------------------------------------------------------------------------
+    def get(self, path, gap_fill=DEFAULT_GAP_FILL):
+        key = self._key(path, gap_fill)
+
+        binfile = os.path.join(self.path, f"{key}.bin")
+        infofile = os.path.join(self.path, f"{key}.json")
+
+        try:
+            with open(infofile, 'r') as f:
+                info = json.load(f)
+
+            if os.path.getsize(binfile) == info['size']:
+                return (binfile, info)
+        except (OSError, ValueError, KeyError) as e:
+            pass
+
+        (data, start, ranges) = load(path, gap_fill)
+        info = {'start': start, 'size': len(data), 'ranges': ranges}
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # The info is written last, it marks the binary as complete
+        self._write(binfile, data)
+        self._write(infofile, json.dumps(info).encode())
+
+        return (binfile, info)
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+        os.replace(tmp_path, path)
+
+# ------------------------------------------------------------------------------
+#  FirmwareImage of hex file path, through cache when given.
+#  Returns (image, start address, ranges).
+# ------------------------------------------------------------------------------
+def load_image(path, cache=None, gap_fill=DEFAULT_GAP_FILL):
+    if cache is None:
+        (data, start, ranges) = load(path, gap_fill)
+        return (FirmwareImage(data), start, ranges)
+
+    (binfile, info) = cache.get(path, gap_fill)
+
+    return (FirmwareImage.from_file(binfile), info['start'], [tuple(r) for r in info['ranges']])
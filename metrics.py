@@ -0,0 +1,287 @@
+import os
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import RECEIPT_BUCKETS_MS
+from artifact_cache  import _FileLock
+
+verbose = False
+
+# ------------------------------------------------------------------------------
+#  Prometheus metrics of DFU updates.
+#
+#  Counters and histograms are kept as plain samples, so the text exposition
+#  format written out can be read back in: a one-shot dfu.py adds its update
+#  to the node-exporter textfile left by the previous run, and counters keep
+#  counting across processes. fleet.py and the daemon keep them in memory,
+#  the daemon also serving them over HTTP.
+# ------------------------------------------------------------------------------
+
+UPDATE_BUCKETS  = [5, 10, 20, 30, 60, 120, 300, 600, 1200]
+PHASE_BUCKETS   = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RECEIPT_BUCKETS = [bound / 1000.0 for bound in RECEIPT_BUCKETS_MS]
+
+# (name, type, help, histogram buckets), in the order written out
+FAMILIES = [
+    ('ota_dfu_updates_total', 'counter',
+     'Updates finished, by device kind, firmware the device ran before and outcome', None),
+    ('ota_dfu_update_duration_seconds', 'histogram',
+     'Wall time of whole updates', UPDATE_BUCKETS),
+    ('ota_dfu_bytes_sent_total', 'counter',
+     'Init packet and firmware bytes written to devices', None),
+    ('ota_dfu_objects_retransmitted_total', 'counter',
+     'Secure DFU objects sent again after a checksum mismatch', None),
+    ('ota_dfu_connect_failures_total', 'counter',
+     'Connection attempts that failed, including devices not advertising', None),
+    ('ota_dfu_reconnects_total', 'counter',
+     'Link drops recovered from during transfers', None),
+    ('ota_dfu_receipt_round_trip_seconds', 'histogram',
+     'Time from sending a PRN batch to checking its receipt', RECEIPT_BUCKETS),
+    ('ota_dfu_phase_duration_seconds', 'histogram',
+     'Duration of update phases (connect, discovery, create, stream, ...)', PHASE_BUCKETS),
+    ('ota_dfu_last_throughput_bytes_per_second', 'gauge',
+     'Firmware streaming throughput of the last update of each device', None),
+    ('ota_dfu_last_update_timestamp_seconds', 'gauge',
+     'When the last update of each device finished, by outcome', None),
+]
+
+FAMILY_BY_NAME = {family[0]: family for family in FAMILIES}
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+LABEL_PATTERN  = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _family_of(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        base = name[:-len(suffix)]
+        if name.endswith(suffix) and base in FAMILY_BY_NAME and FAMILY_BY_NAME[base][1] == 'histogram':
+            return base
+
+    return name
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        # (sample name, sorted (label, value) tuple) -> value
+        self.samples = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((key, str(value)) for (key, value) in labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.samples[self._key(name, labels)] = value
+
+    # --------------------------------------------------------------------------
+    #  Add one observation to a histogram
+    # --------------------------------------------------------------------------
+    def observe(self, name, value, **labels):
+        bounds = FAMILY_BY_NAME[name][3]
+        self._add_histogram(name, labels, [1 if value <= bound else 0 for bound in bounds] + [1], value)
+
+    # --------------------------------------------------------------------------
+    #  Add cumulative bucket counts (one per bound, then +Inf) and their sum
+    # --------------------------------------------------------------------------
+    def _add_histogram(self, name, labels, cumulative, total):
+        bounds = FAMILY_BY_NAME[name][3] + [float('inf')]
+
+        with self.lock:
+            for (bound, count) in zip(bounds, cumulative):
+                key = self._key(f"{name}_bucket", dict(labels, le=_format_value(bound)))
+                self.samples[key] = self.samples.get(key, 0) + count
+
+            for (suffix, amount) in (('_sum', total), ('_count', cumulative[-1])):
+                key = self._key(f"{name}{suffix}", labels)
+                self.samples[key] = self.samples.get(key, 0) + amount
+
+    # --------------------------------------------------------------------------
+    #  Account for one update. controller is the NrfBleDfuController that ran
+    #  it, error the exception that ended it (None when it succeeded) and
+    #  adapter the Bluetooth adapter it used.
+    # --------------------------------------------------------------------------
+    def record(self, controller, error=None, adapter=None):
+        timing = controller.instrumentation
+
+        kind = controller.kind or 'unknown'
+        adapter = adapter or 'default'
+        outcome = 'success' if error is None else 'failure'
+
+        self.inc('ota_dfu_updates_total', kind=kind, firmware=controller.firmware_version or 'unknown', outcome=outcome)
+        self.observe('ota_dfu_update_duration_seconds', time.monotonic() - timing.started, kind=kind, outcome=outcome)
+
+        self.inc('ota_dfu_bytes_sent_total', sum(phase.bytes for phase in timing.phases), kind=kind, adapter=adapter)
+        self.inc('ota_dfu_objects_retransmitted_total', timing.retransmits, kind=kind, adapter=adapter)
+        self.inc('ota_dfu_connect_failures_total', controller.connect_failures, kind=kind, adapter=adapter)
+        self.inc('ota_dfu_reconnects_total', controller.reconnects, kind=kind, adapter=adapter)
+
+        receipts = timing.receipts
+        if receipts.count:
+            cumulative = [sum(receipts.counts[:i + 1]) for i in range(len(receipts.counts))]
+            self._add_histogram('ota_dfu_receipt_round_trip_seconds', {'adapter': adapter}, cumulative, receipts.total)
+
+        stream_bytes = 0
+        stream_seconds = 0.0
+
+        for phase in timing.phases:
+            self.observe('ota_dfu_phase_duration_seconds', phase.duration(), phase=phase.name)
+
+            if phase.name == 'stream':
+                stream_bytes += phase.bytes
+                stream_seconds += phase.duration()
+
+        if stream_seconds > 0:
+            self.set('ota_dfu_last_throughput_bytes_per_second', round(stream_bytes / stream_seconds, 1),
+                     address=controller.address, adapter=adapter)
+
+        self.set('ota_dfu_last_update_timestamp_seconds', round(time.time(), 3), address=controller.address, outcome=outcome)
+
+    # --------------------------------------------------------------------------
+    #  Text exposition format
+    # --------------------------------------------------------------------------
+    def render(self):
+        with self.lock:
+            samples = list(self.samples.items())
+
+        by_family = {}
+        for ((name, labels), value) in samples:
+            by_family.setdefault(_family_of(name), []).append((name, labels, value))
+
+        lines = []
+
+        for (family, kind, help, buckets) in FAMILIES:
+            if family not in by_family:
+                continue
+
+            lines.append(f"# HELP {family} {help}")
+            lines.append(f"# TYPE {family} {kind}")
+
+            # Series together, buckets in increasing order, then _sum and _count
+            def order(sample):
+                (name, labels, value) = sample
+                series = tuple(label for label in labels if label[0] != 'le')
+                le = [float(value) for (key, value) in labels if key == 'le']
+                return (series, name != f"{family}_bucket", le, name)
+
+            for (name, labels, value) in sorted(by_family[family], key=order):
+                label_text = ','.join(f'{key}="{_escape(value)}"' for (key, value) in labels)
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}" if label_text else f"{name} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+    # --------------------------------------------------------------------------
+    #  Add the counts of a file written by write_textfile(), if it exists.
+    #  Gauges are replaced.
+    # --------------------------------------------------------------------------
+    def load_textfile(self, path):
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return
+
+        with self.lock:
+            for line in text.splitlines():
+                match = SAMPLE_PATTERN.match(line)
+                if line.startswith('#') or match is None or _family_of(match.group(1)) not in FAMILY_BY_NAME:
+                    continue
+
+                labels = {key: _unescape(value) for (key, value) in LABEL_PATTERN.findall(match.group(2) or '')}
+
+                try:
+                    value = float(match.group(3))
+                except ValueError:
+                    continue
+
+                key = self._key(match.group(1), labels)
+
+                if FAMILY_BY_NAME[_family_of(match.group(1))][1] == 'gauge':
+                    self.samples[key] = value
+                else:
+                    self.samples[key] = self.samples.get(key, 0) + value
+
+    # --------------------------------------------------------------------------
+    #  Write atomically, for node-exporter's textfile collector (the file
+    #  name must end in .prom)
+    # --------------------------------------------------------------------------
+    def write_textfile(self, path):
+        with self.write_lock:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+
+# ------------------------------------------------------------------------------
+#  Add one update to the textfile at path, for processes running a single
+#  update. Concurrent runs are serialized by a lock file next to it.
+# ------------------------------------------------------------------------------
+def record_to_textfile(path, controller, error=None, adapter=None):
+    with _FileLock(f"{path}.lock"):
+        metrics = Metrics()
+        metrics.load_textfile(path)
+        metrics.record(controller, error, adapter)
+        metrics.write_textfile(path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if verbose: BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# ------------------------------------------------------------------------------
+#  Serves GET /metrics from a background thread
+# ------------------------------------------------------------------------------
+class MetricsServer(object):
+
+    def __init__(self, metrics, port, host=''):
+        self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        if self.thread is not None:
+            self.thread.join()
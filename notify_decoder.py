@@ -0,0 +1,142 @@
+import struct
+
+# ------------------------------------------------------------------------------
+#  Decoding of DFU Control Point notifications.
+#
+#  Notifications are decoded straight from the raw value with precompiled
+#  struct formats, dispatching on opcode (and for secure responses on the
+#  procedure) through lookup tables. Each notification becomes one small
+#  __slots__ record.
+# ------------------------------------------------------------------------------
+
+# Opcodes, see Procedures in the secure and legacy controllers
+SECURE_RESPONSE             = 0x60
+SECURE_CALC_CHECKSUM        = 0x03
+SECURE_SELECT               = 0x06
+SECURE_SUCCESS              = 0x01
+
+LEGACY_RESPONSE             = 16
+LEGACY_PACKET_RECEIPT       = 17
+LEGACY_SUCCESS              = 1
+
+class Response(object):
+    __slots__ = ('procedure', 'result')
+
+    def __init__(self, procedure, result):
+        self.procedure = procedure
+        self.result = result
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)}' for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ()))
+        return f'{type(self).__name__}({fields})'
+
+class SelectResponse(Response):
+    __slots__ = ('max_size', 'offset', 'crc32')
+
+    def __init__(self, procedure, result, max_size, offset, crc32):
+        Response.__init__(self, procedure, result)
+        self.max_size = max_size
+        self.offset = offset
+        self.crc32 = crc32
+
+# Also the format of secure Packet Receipt Notifications
+class ChecksumResponse(Response):
+    __slots__ = ('offset', 'crc32')
+
+    def __init__(self, procedure, result, offset, crc32):
+        Response.__init__(self, procedure, result)
+        self.offset = offset
+        self.crc32 = crc32
+
+# Legacy Packet Receipt Notification: image bytes received so far
+class PacketReceipt(Response):
+    __slots__ = ('bytes_received',)
+
+    def __init__(self, procedure, result, bytes_received):
+        Response.__init__(self, procedure, result)
+        self.bytes_received = bytes_received
+
+_HEADER   = struct.Struct('<BBB')
+_SELECT   = struct.Struct('<III')
+_CHECKSUM = struct.Struct('<II')
+_RECEIPT  = struct.Struct('<I')
+
+# ------------------------------------------------------------------------------
+#  Secure DFU
+# ------------------------------------------------------------------------------
+def _secure_select(procedure, result, value):
+    return SelectResponse(procedure, result, *_SELECT.unpack_from(value, 3))
+
+def _secure_checksum(procedure, result, value):
+    return ChecksumResponse(procedure, result, *_CHECKSUM.unpack_from(value, 3))
+
+# Successful responses carrying a payload, by procedure
+_SECURE_PAYLOADS = {
+    SECURE_SELECT           : (_secure_select, 3 + _SELECT.size),
+    SECURE_CALC_CHECKSUM    : (_secure_checksum, 3 + _CHECKSUM.size),
+}
+
+def _secure_response(value):
+    (_, procedure, result) = _HEADER.unpack_from(value)
+
+    if result == SECURE_SUCCESS:
+        payload = _SECURE_PAYLOADS.get(procedure)
+        if payload is not None:
+            (decode, size) = payload
+            if len(value) < size:
+                return None
+
+            return decode(procedure, result, value)
+
+    return Response(procedure, result)
+
+_SECURE_OPCODES = {
+    SECURE_RESPONSE : _secure_response,
+}
+
+# ------------------------------------------------------------------------------
+#  Decode a secure DFU notification. Returns None for anything that isn't a
+#  well-formed response.
+# ------------------------------------------------------------------------------
+def decode_secure(value):
+    if len(value) < _HEADER.size:
+        return None
+
+    decode = _SECURE_OPCODES.get(value[0])
+    if decode is None:
+        return None
+
+    return decode(value)
+
+# ------------------------------------------------------------------------------
+#  Legacy DFU
+# ------------------------------------------------------------------------------
+def _legacy_response(value):
+    (_, procedure, result) = _HEADER.unpack_from(value)
+
+    return Response(procedure, result)
+
+def _legacy_receipt(value):
+    if len(value) < 1 + _RECEIPT.size:
+        return None
+
+    return PacketReceipt(LEGACY_PACKET_RECEIPT, LEGACY_SUCCESS, _RECEIPT.unpack_from(value, 1)[0])
+
+_LEGACY_OPCODES = {
+    LEGACY_RESPONSE         : _legacy_response,
+    LEGACY_PACKET_RECEIPT   : _legacy_receipt,
+}
+
+# ------------------------------------------------------------------------------
+#  Decode a legacy DFU notification. Returns None for anything that isn't a
+#  well-formed response or receipt.
+# ------------------------------------------------------------------------------
+def decode_legacy(value):
+    if len(value) < _HEADER.size:
+        return None
+
+    decode = _LEGACY_OPCODES.get(value[0])
+    if decode is None:
+        return None
+
+    return decode(value)
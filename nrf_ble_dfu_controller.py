@@ -1,16 +1,33 @@
+import asyncio
 import os
-import pexpect
-import re
+import time
 
-from abc   import ABCMeta, abstractmethod
-from array import array
-from util  import *
+from abc            import ABCMeta, abstractmethod
+from util           import *
+from transport      import create_transport, Advertisement, ConnectionLost, ScanUnavailable, ATT_DEFAULT_MTU, ATT_HEADER_SIZE
+from async_transport import AsyncTransport, DirectTransport
+from gatt_cache     import GattDatabase, UUID_FIRMWARE_REVISION
+from firmware_image import FirmwareImage
+from instrumentation import Instrumentation
+from tracing        import NO_TRACE
+
+import intel_hex
 
 verbose = False
 
 class NrfBleDfuController(object):
     __metaclass__ = ABCMeta
 
+    # Device family, as in metrics labels ('secure', 'legacy', 'ruuvitag')
+    kind                 = None
+
+    # Procedures class of the protocol, naming commands in traces
+    procedures           = None
+
+    # Optional tracing.Tracer, set by use_tracer()
+    tracer               = None
+    trace_track          = None
+
     # Class instance variables
     ctrlpt_handle        = 0
     ctrlpt_cccd_handle   = 0
@@ -19,13 +36,78 @@ class NrfBleDfuController(object):
     pkt_receipt_interval = 10
     pkt_payload_size     = 20
 
+    # 247 lets each write fill one Data Length Extension link-layer packet
+    # (251 bytes minus the 4 byte L2CAP header). Set to 23 to disable.
+    att_mtu              = 247
+
+    # Optional prn_controller.AdaptivePrn replacing the fixed interval
+    adaptive_prn         = None
+
+    # PRN batches that may be sent before the oldest receipt is waited for.
+    # 1 is stop-and-wait; each extra batch must fit in the bootloader's buffers.
+    max_pending_receipts = 2
+
+    # Optional gatt_cache.GattCache persisting discovery results on disk
+    gatt_cache           = None
+
+    # Optional resume_journal.ResumeJournal for resuming interrupted transfers
+    resume_journal       = None
+
+    # Optional transfer_plan.PlanCache sharing transfer plans between devices
+    plan_cache           = None
+
+    # Firmware (firmware_image.FirmwareImage) and init packet, loaded by
+    # input_setup() unless given to use_image()
+    image                = None
+    init_data            = None
+
+    # Package image type and the (softdevice, bootloader, application) sizes
+    # announced by the legacy protocol
+    image_type           = 'application'
+    image_sizes          = None
+
+    # Optional intel_hex.HexCache keeping converted .hex images by file hash,
+    # and the value filling gaps between hex address ranges
+    hex_cache            = None
+    hex_gap_fill         = intel_hex.DEFAULT_GAP_FILL
+
+    # Characteristics of the current connection, discovered once
+    gatt                 = None
+
+    # Optional fleet.ConnectGate spacing out connection attempts made
+    # through the same adapter
+    connect_gate         = None
+
+    # Optional scan.DeviceIndex kept up to date by a scan.LiveScanner on the
+    # same adapter. Connections are only attempted to devices it has seen
+    # advertising within presence_timeout seconds.
+    device_index         = None
+    presence_timeout     = 5
+
     timeout = 10
 
+    # Seconds a device reset into (or out of) DFU mode gets to drop the link,
+    # and to advertise again afterwards
+    link_loss_timeout    = 1.0
+    reboot_timeout       = 20
+
+    # Seconds the last reboot took to show up as an advertisement
+    reboot_time          = None
+
+    # When the link drops during a transfer, up to reconnect_attempts
+    # connections are tried, reconnect_delay seconds apart at first and
+    # doubling up to reconnect_max_delay. A session gives up after
+    # max_link_losses drops.
+    reconnect_attempts   = 5
+    reconnect_delay      = 0.25
+    reconnect_max_delay  = 4.0
+    max_link_losses      = 10
+
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
     @abstractmethod
-    def start(self):
+    async def start_async(self):
         pass
 
     # --------------------------------------------------------------------------
@@ -33,14 +115,14 @@ class NrfBleDfuController(object):
     #  Returns True if the peripheral is in DFU mode
     # --------------------------------------------------------------------------
     @abstractmethod
-    def check_DFU_mode(self):
+    async def check_DFU_mode_async(self):
         pass
 
     @abstractmethod
     # --------------------------------------------------------------------------
     #  Switch from application to bootloader (DFU)
     # --------------------------------------------------------------------------
-    def switch_to_dfu_mode(self):
+    async def switch_to_dfu_mode_async(self):
         pass
 
     # --------------------------------------------------------------------------
@@ -54,254 +136,564 @@ class NrfBleDfuController(object):
     #  Wait for a notification and parse the response
     # --------------------------------------------------------------------------
     @abstractmethod
-    def _wait_and_parse_notify(self):
+    async def _wait_and_parse_notify(self):
         pass
 
-    def __init__(self, target_mac, firmware_path, datfile_path):
+    def __init__(self, target_mac, firmware_path, datfile_path, transport=None):
         self.target_mac = target_mac
 
+        # The address given, target_mac follows the device into DFU mode
+        self.address = target_mac
+
         self.firmware_path = firmware_path
         self.datfile_path = datfile_path
 
-        self.ble_conn = pexpect.spawn(f"gatttool -b '{target_mac}' -t random --interactive")
-        self.ble_conn.delaybeforesend = 0
+        if transport is None or isinstance(transport, str):
+            transport = create_transport(transport, target_mac)
+
+        self.transport = transport
+        self.transport.timeout = self.timeout
+
+        # The coroutines below do all I/O through link. A synchronous
+        # Transport is called inline, for the synchronous methods.
+        self.link = transport if isinstance(transport, AsyncTransport) else DirectTransport(transport)
+
+        # Link drops recovered from during the transfer, and the seconds
+        # spent reconnecting
+        self.reconnects = 0
+        self.time_lost = 0.0
+
+        # Connection attempts that failed, and the firmware revision the
+        # device reported first (only read with a GATT cache)
+        self.connect_failures = 0
+        self.firmware_version = None
+
+        # Phase timings of this update (see transfer_report())
+        self.instrumentation = Instrumentation()
 
     # --------------------------------------------------------------------------
-    #  Start the firmware update process
+    #  Connect (switching to DFU mode if needed) and run the update.
+    #  Raises on failure.
     # --------------------------------------------------------------------------
-    def start(self):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+    async def update_async(self):
+        # With a running scan, look for the device first instead of waiting
+        # for connection timeouts
+        if self.device_index is not None and await self.locate_async() is None:
+            raise Exception("Device is not advertising")
+
+        # Connect to peer device. Assume application mode.
+        if await self.scan_and_connect_async():
+            if not await self.check_DFU_mode_async():
+                print("Need to switch to DFU mode")
+                with self.instrumentation.phase('dfu_switch'):
+                    switched = await self.switch_to_dfu_mode_async()
+                if not switched:
+                    raise Exception("Failed to switch to DFU mode")
+        else:
+            # The device might already be in DFU mode (MAC + 1)
+            await self.target_mac_increase_async(1)
+
+            # Try connection with new address
+            print("Couldn't connect, will try DFU MAC")
+            if not await self.scan_and_connect_async():
+                raise Exception("Can't connect to device")
+
+        await self.start_async()
+
+        # Disconnect from peer device if not done already and clean up.
+        await self.disconnect_async()
+
+    # --------------------------------------------------------------------------
+    #  Synchronous methods, each running its coroutine to completion on a
+    #  loop of its own. A controller on an AsyncTransport shares the loop
+    #  of its connection with other updates and is driven by the *_async
+    #  coroutines instead (see async_dfu.py).
+    # --------------------------------------------------------------------------
+    def update(self):
+        return self._run(self.update_async())
+
+    def start(self, *args):
+        return self._run(self.start_async(*args))
+
+    def scan_and_connect(self):
+        return self._run(self.scan_and_connect_async())
+
+    def locate(self):
+        return self._run(self.locate_async())
+
+    def reconnect(self):
+        return self._run(self.reconnect_async())
+
+    def disconnect(self):
+        return self._run(self.disconnect_async())
 
-        if verbose:
-            print(f'Control Point Handle: 0x{self.ctrlpt_handle:04x}, CCCD: 0x{self.ctrlpt_cccd_handle:04x}')
-            print(f'Packet handle: 0x{self.data_handle:04x}')
+    def check_DFU_mode(self):
+        return self._run(self.check_DFU_mode_async())
 
-        # Subscribe to notifications from Control Point characteristic
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+    def switch_to_dfu_mode(self):
+        return self._run(self.switch_to_dfu_mode_async())
 
-        # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
+    def target_mac_increase(self, inc):
+        return self._run(self.target_mac_increase_async(inc))
 
-        self._dfu_send_init()
+    def _run(self, coro):
+        if not isinstance(self.link, DirectTransport):
+            coro.close()
+            raise Exception(f"{type(self.link).__name__} needs an event loop, use the *_async methods")
 
-        self._dfu_send_image()
+        return asyncio.run(coro)
+
+    # --------------------------------------------------------------------------
+    #  Use an image already in memory (e.g. from a unpacker.DfuPackage)
+    #  instead of reading firmware_path and datfile_path
+    # --------------------------------------------------------------------------
+    def use_image(self, firmware, init_data, image_type='application', image_sizes=None):
+        self.image = firmware
+        self.image_size = firmware.size
+        self.init_data = bytes(init_data)
+        self.image_type = image_type
+        self.image_sizes = image_sizes
 
     # --------------------------------------------------------------------------
     # Initialize: 
-    #    Hex: read and convert hexfile into bin_array 
-    #    Bin: read binfile into bin_array
+    #    Hex: read and convert hexfile into the image buffer
+    #    Bin: map binfile as the image buffer
+    #    Dat: read the init packet
+    #  Images given to use_image() are taken as they are.
     # --------------------------------------------------------------------------
     def input_setup(self):
-        print(f"Sending file {os.path.split(self.firmware_path)[1]} to {self.target_mac}")
+        if self.image is None:
+            self._load_firmware()
+        else:
+            self.image_size = self.image.size
+            print(f"Sending {self.image_type} image to {self.target_mac}")
+            print(f"Binary imge size: {self.image_size}")
+
+        if self.init_data is None:
+            if self.datfile_path == None:
+                raise Exception("input invalid")
+
+            with open(self.datfile_path, 'rb') as f:
+                self.init_data = f.read()
 
+    def _load_firmware(self):
         if self.firmware_path == None:
             raise Exception("input invalid")
 
+        print(f"Sending file {os.path.split(self.firmware_path)[1]} to {self.target_mac}")
+
         name, extent = os.path.splitext(self.firmware_path)
 
         if extent == ".bin":
-            self.bin_array = array('B', open(self.firmware_path, 'rb').read())
+            self.image = FirmwareImage.from_file(self.firmware_path)
 
-            self.image_size = len(self.bin_array)
+            self.image_size = self.image.size
             print(f"Binary imge size: {self.image_size}")
-            print(f"Binary CRC32: {crc32_unsigned(bytes(self.bin_array))}")
+            print(f"Binary CRC32: {self.image.crc32}")
 
             return
 
         if extent == ".hex":
-            intelhex = IntelHex(self.firmware_path)
-            self.bin_array = intelhex.tobinarray()
-            self.image_size = len(self.bin_array)
+            (self.image, start, ranges) = intel_hex.load_image(self.firmware_path, self.hex_cache, self.hex_gap_fill)
+            self.image_size = self.image.size
+
+            print("Hex address ranges: " + ", ".join(f"0x{begin:08x}-0x{end:08x}" for (begin, end) in ranges))
             print(f"bin array size: {self.image_size}")
             return
 
         raise Exception("input invalid")
 
     # --------------------------------------------------------------------------
-    # Perform a scan and connect via gatttool.
+    # Perform a scan and connect.
     # Will return True if a connection was established, False otherwise
     # --------------------------------------------------------------------------
-    def scan_and_connect(self):
+    async def scan_and_connect_async(self):
         if verbose: print("scan_and_connect")
 
         print(f"Connecting to {self.target_mac}")
 
-        try:
-            self.ble_conn.expect('\[LE\]>.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
+        self.gatt = None
+
+        if self.device_index is not None and await self.link.blocking(self.device_index.wait_for, [self.target_mac], self.presence_timeout) is None:
+            print(f"{self.target_mac} is not advertising")
+            self.connect_failures += 1
             return False
 
-        self.ble_conn.sendline('connect')
+        if self.connect_gate is not None:
+            await self.link.blocking(self.connect_gate.wait)
 
-        try:
-            res = self.ble_conn.expect('Connection successful.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
-            return False
+        with self.instrumentation.phase('connect', address=self.target_mac):
+            if not await self.link.connect():
+                self.connect_failures += 1
+                return False
+
+            await self._negotiate_mtu()
 
         return True
 
     # --------------------------------------------------------------------------
-    # Perform a reconnection via gatttool.
+    #  Find the device in device_index, at the target address or (in DFU
+    #  mode) at the address increased by one, and retarget to where it is.
+    #  Returns the scan.SeenDevice, None if it isn't advertising.
+    # --------------------------------------------------------------------------
+    async def locate_async(self):
+        dfu_mac = uint_to_mac_string(mac_string_to_uint(self.target_mac) + 1)
+
+        seen = await self.link.blocking(self.device_index.wait_for, [self.target_mac, dfu_mac], self.presence_timeout)
+        if seen is None:
+            print(f"Neither {self.target_mac} nor {dfu_mac} is advertising")
+            return None
+
+        print(f"{seen.mac} advertising as {seen.mode}" + (f", RSSI {seen.rssi} dBm" if seen.rssi is not None else ""))
+
+        if seen.mac != self.target_mac:
+            await self.target_mac_increase_async(1)
+
+        return seen
+
+    # --------------------------------------------------------------------------
+    # Perform a reconnection.
     # Will return True if a connection was established, False otherwise
     # --------------------------------------------------------------------------
-    def reconnect(self):
+    async def reconnect_async(self):
         if verbose: print("reconnect")
 
         print(f"Reconnecting to {self.target_mac}")
 
-        self.ble_conn.sendline('')
+        self.gatt = None
 
-        try:
-            self.ble_conn.expect('\[LE\]>.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
-            return False
+        if self.connect_gate is not None:
+            await self.link.blocking(self.connect_gate.wait)
 
-        self.ble_conn.sendline('connect')
+        with self.instrumentation.phase('reconnect', address=self.target_mac):
+            if not await self.link.reconnect():
+                self.connect_failures += 1
+                return False
 
-        try:
-            self.ble_conn.expect('Connection successful.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
-            return False
+            await self._negotiate_mtu()
 
         return True
 
     # --------------------------------------------------------------------------
-    #  Disconnect from the peripheral and close the gatttool connection
+    #  Negotiate the ATT MTU and size data packets to fit a single write.
+    #  Falls back to the BLE 4.0 minimum of 20 bytes.
     # --------------------------------------------------------------------------
-    def disconnect(self):
-        self.ble_conn.sendline('exit')
-        self.ble_conn.close()
+    async def _negotiate_mtu(self):
+        mtu = ATT_DEFAULT_MTU
+        if self.att_mtu > ATT_DEFAULT_MTU:
+            mtu = max(await self.link.exchange_mtu(self.att_mtu), ATT_DEFAULT_MTU)
 
-    def target_mac_increase(self, inc):
+        self.pkt_payload_size = mtu - ATT_HEADER_SIZE
+
+        if verbose: print(f"ATT MTU: {mtu}, packet payload size: {self.pkt_payload_size}")
+
+    # --------------------------------------------------------------------------
+    #  Disconnect from the peripheral and close the transport
+    # --------------------------------------------------------------------------
+    async def disconnect_async(self):
+        await self.link.disconnect()
+
+    # --------------------------------------------------------------------------
+    #  After a reset command: wait for the device to drop the link and to
+    #  advertise at one of macs (the expected address first), then connect
+    #  to it. Transports that can't scan wait fallback_delay seconds and
+    #  connect to the first address instead.
+    #  Returns True if a connection was established.
+    # --------------------------------------------------------------------------
+    async def _reconnect_after_reboot(self, macs, fallback_delay):
+        started = time.monotonic()
+
+        with self._trace('link_loss_wait', 'reboot'):
+            await self._wait_for_link_loss()
+        link_wait = time.monotonic() - started
+
+        try:
+            with self._trace('advertisement_wait', 'reboot', macs=macs):
+                advertisement = await self._wait_for_advertisement(macs, started)
+        except ScanUnavailable as e:
+            print(f"{e}, waiting {fallback_delay} s instead")
+            with self._trace('sleep', 'reboot'):
+                await asyncio.sleep(fallback_delay)
+            (mac, self.reboot_time) = (macs[0], time.monotonic() - started)
+        else:
+            if advertisement is None:
+                print(f"{' or '.join(macs)} not advertising after {self.reboot_timeout} s")
+                return False
+
+            (mac, self.reboot_time) = (advertisement.mac, link_wait + advertisement.elapsed)
+
+        print(f"Device back at {mac} after {self.reboot_time:.2f} s")
+
+        # A fresh link, even to the same address
+        self.target_mac = mac
+        self.gatt = None
+        await self.link.retarget(mac)
+
+        return await self.scan_and_connect_async()
+
+    # --------------------------------------------------------------------------
+    #  An advertisement from one of macs. A running scan already feeds
+    #  device_index; the transport can't scan on the same adapter meanwhile.
+    # --------------------------------------------------------------------------
+    async def _wait_for_advertisement(self, macs, since):
+        if self.device_index is None:
+            return await self.link.wait_for_advertisement(macs, self.reboot_timeout)
+
+        started = time.monotonic()
+
+        # Only advertisements since the reset count
+        seen = await self.link.blocking(self.device_index.wait_for, macs, self.reboot_timeout, since)
+        if seen is None:
+            return None
+
+        return Advertisement(seen.mac, time.monotonic() - started)
+
+    # --------------------------------------------------------------------------
+    #  Reconnect after the link dropped in the middle of the transfer, with
+    #  exponential backoff between attempts. Raises ConnectionLost if the
+    #  device can't be reached again, or has dropped the link too often.
+    # --------------------------------------------------------------------------
+    async def _recover_link(self):
+        lost_at = time.monotonic()
+        self._trace_instant('link_lost', 'link', reconnects=self.reconnects)
+
+        if self.reconnects >= self.max_link_losses:
+            raise ConnectionLost(f"Connection lost {self.reconnects + 1} times, giving up")
+
+        delay = self.reconnect_delay
+
+        for attempt in range(1, self.reconnect_attempts + 1):
+            print(f"\nConnection lost, reconnecting in {delay:.2f} s (attempt {attempt} of {self.reconnect_attempts})")
+            with self._trace('backoff', 'link', attempt=attempt):
+                await asyncio.sleep(delay)
+
+            if await self.reconnect_async():
+                self.reconnects += 1
+                self.time_lost += time.monotonic() - lost_at
+
+                print(f"Reconnected after {time.monotonic() - lost_at:.2f} s")
+                return
+
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+        raise ConnectionLost(f"Connection lost, no reconnect in {self.reconnect_attempts} attempts")
+
+    # --------------------------------------------------------------------------
+    #  Reconnects and time lost to them, printed once a transfer is done
+    # --------------------------------------------------------------------------
+    def _print_reconnects(self):
+        if self.reconnects > 0:
+            print(f"Reconnected {self.reconnects} time(s), {self.time_lost:.2f} s lost")
+
+    # --------------------------------------------------------------------------
+    #  Structured report of the update: the phase timings plus what the
+    #  controller knows about the transfer. error is the exception that
+    #  ended it, if any.
+    # --------------------------------------------------------------------------
+    def transfer_report(self, error=None):
+        report = {
+            'address'          : self.address,
+            'dfu_address'      : self.target_mac,
+            'controller'       : type(self).__name__,
+            'kind'             : self.kind,
+            'firmware_version' : self.firmware_version,
+            'image_type'       : self.image_type,
+            'image_size'       : self.image.size if self.image is not None else None,
+            'mtu'              : self.pkt_payload_size + ATT_HEADER_SIZE,
+            'prn'              : self.pkt_receipt_interval,
+            'success'          : error is None,
+            'error'            : str(error) if error is not None else None,
+            'reboot_time'      : self.reboot_time,
+            'reconnects'       : self.reconnects,
+            'connect_failures' : self.connect_failures,
+            'time_lost'        : round(self.time_lost, 6),
+        }
+
+        report.update(self.instrumentation.to_json())
+        return report
+
+    # --------------------------------------------------------------------------
+    #  Record this session in tracer (a tracing.Tracer), on a track of its
+    #  own: commands, notifications, data bursts, waits and the phases
+    # --------------------------------------------------------------------------
+    def use_tracer(self, tracer):
+        self.tracer = tracer
+        self.trace_track = tracer.track(f"{self.address} ({self.kind})")
+
+        self.instrumentation.tracer = tracer
+        self.instrumentation.track = self.trace_track
+
+    def _trace(self, name, cat='dfu', **args):
+        if self.tracer is None:
+            return NO_TRACE
+
+        return self.tracer.span(self.trace_track, name, cat, **args)
+
+    def _trace_instant(self, name, cat='dfu', **args):
+        if self.tracer is not None:
+            self.tracer.instant(self.trace_track, name, cat, **args)
+
+    # --------------------------------------------------------------------------
+    #  Wait up to link_loss_timeout for the peer to drop the link, so an
+    #  advertisement seen afterwards comes from the rebooted device
+    # --------------------------------------------------------------------------
+    async def _wait_for_link_loss(self):
+        deadline = time.monotonic() + self.link_loss_timeout
+
+        try:
+            while time.monotonic() < deadline:
+                await self.link.wait_for_notification(max(deadline - time.monotonic(), 0))
+        except ConnectionLost:
+            return True
+
+        return False
+
+    async def target_mac_increase_async(self, inc):
         self.target_mac = uint_to_mac_string(mac_string_to_uint(self.target_mac) + inc)
 
-        # Re-start gatttool with the new address
-        self.disconnect()
-        self.ble_conn = pexpect.spawn(f"gatttool -b '{self.target_mac}' -t random --interactive")
-        self.ble_conn.delaybeforesend = 0
+        # Re-start the transport with the new address
+        self.gatt = None
+        await self.link.retarget(self.target_mac)
+
+    # --------------------------------------------------------------------------
+    #  Characteristics of the connected peripheral.
+    #  Discovered once per connection, or loaded from the persistent cache
+    #  when the peripheral reports a firmware version seen before.
+    # --------------------------------------------------------------------------
+    async def _gatt_database(self):
+        if self.gatt is not None:
+            return self.gatt
+
+        version = None
+        if self.gatt_cache is not None:
+            revision = await self.link.read_by_uuid(UUID_FIRMWARE_REVISION)
+            version = revision.decode(errors='replace') if revision else None
+
+            if self.firmware_version is None:
+                self.firmware_version = version
+
+            self.gatt = self.gatt_cache.load(self.target_mac, version)
+            if self.gatt is not None:
+                if verbose: print(f"GATT cache hit for {self.target_mac} ({version})")
+                return self.gatt
+
+        with self.instrumentation.phase('discovery', address=self.target_mac):
+            self.gatt = GattDatabase(await self.link.discover_characteristics())
+
+        if self.gatt_cache is not None and self.gatt.chars:
+            self.gatt_cache.store(self.target_mac, version, self.gatt)
+
+        return self.gatt
+
+    # --------------------------------------------------------------------------
+    #  Drop the discovered characteristics, in memory and on disk
+    # --------------------------------------------------------------------------
+    def _gatt_invalidate(self):
+        self.gatt = None
+
+        if self.gatt_cache is not None:
+            self.gatt_cache.invalidate(self.target_mac)
+
+    # --------------------------------------------------------------------------
+    #  Find a characteristic by UUID. Returns None if it is not present
+    # --------------------------------------------------------------------------
+    async def _find_characteristic(self, uuid):
+        return (await self._gatt_database()).find(uuid)
 
     # --------------------------------------------------------------------------
     #  Fetch handles for a given UUID.
     #  Will return a three-tuple: (char handle, value handle, CCCD handle)
     #  Will raise an exception if the UUID is not found
     # --------------------------------------------------------------------------
-    def _get_handles(self, uuid):
-        self.ble_conn.before = ""
-        self.ble_conn.sendline('characteristics')
+    async def _get_handles(self, uuid):
+        handles = (await self._gatt_database()).handles(uuid)
 
-        try:
-            self.ble_conn.expect([uuid], timeout=self.timeout)
-            handles = re.findall(b'.*handle: (0x....),.*char value handle: (0x....)', self.ble_conn.before)
-            (handle, value_handle) = handles[-1]
-        except pexpect.TIMEOUT as e:
+        if handles is None and self.gatt.from_cache:
+            # Cached table is out of date, discover again
+            self._gatt_invalidate()
+            handles = (await self._gatt_database()).handles(uuid)
+
+        if handles is None:
             raise Exception(f"UUID not found: {uuid}")
 
-        return (int(handle, 16), int(value_handle, 16), int(value_handle, 16)+1)
+        return handles
 
     # --------------------------------------------------------------------------
-    #  Wait for notification to arrive.
-    #  Example format: "Notification handle = 0x0019 value: 10 01 01"
-    # --------------------------------------------------------------------------
-    def _dfu_wait_for_notify(self):
-        while True:
-            if verbose: print("dfu_wait_for_notify")
-
-            if not self.ble_conn.isalive():
-                print("connection not alive")
-                return None
-
-            try:
-                index = self.ble_conn.expect('Notification handle = .*? \r\n', timeout=self.timeout)
-
-            except pexpect.TIMEOUT:
-                #
-                # The gatttool does not report link-lost directly.
-                # The only way found to detect it is monitoring the prompt '[CON]'
-                # and if it goes to '[   ]' this indicates the connection has
-                # been broken.
-                # In order to get a updated prompt string, issue an empty
-                # sendline('').  If it contains the '[   ]' string, then
-                # raise an exception. Otherwise, if not a link-lost condition,
-                # continue to wait.
-                #
-                self.ble_conn.sendline('')
-                if b'[   ]' in self.ble_conn.before:
-                    print('Connection lost!')
-                    raise Exception('Connection Lost')
-                return None
-
-            if index == 0:
-                after = self.ble_conn.after
-                hxstr = after.split()[3:]
-                handle = int(hxstr[0], 16)
-                return hxstr[2:]
-
-            else:
-                print(f"unexpeced index: {index}")
-                return None
+    #  Write with response. Returns True once the peer acknowledged it.
+    #  A handle from the cached table that gets an error (or no answer)
+    #  suggests the table belongs to other firmware at this address, so it
+    #  is dropped and the next lookup discovers again.
+    # --------------------------------------------------------------------------
+    async def _write_request(self, handle, data):
+        if await self.link.write_request(handle, data):
+            return True
+
+        if self.gatt is not None and self.gatt.from_cache:
+            print("Write to a cached handle failed, discarding GATT table")
+            self._gatt_invalidate()
+
+        return False
 
     # --------------------------------------------------------------------------
-    #  Send a procedure + any parameters required
+    #  Wait for notification to arrive.
+    #  Returns the raw notified value
     # --------------------------------------------------------------------------
-    def _dfu_send_command(self, procedure, params=[]):
-        if verbose: print('$1')
+    async def _dfu_wait_for_notify(self):
+        if verbose: print("dfu_wait_for_notify")
 
-        cmd = f'char-write-req 0x{self.ctrlpt_handle:04x} {procedure:02x}{bytes(params).hex()}'
+        with self._trace('wait_notify', 'notify'):
+            while True:
+                notify = await self.link.wait_for_notification(self.timeout)
+                if notify is None:
+                    return None
 
-        if verbose: print(cmd)
+                (handle, value) = notify
 
-        self.ble_conn.sendline(cmd)
+                if self.tracer is not None:
+                    self._trace_instant('notification', 'notify', handle=f'0x{handle:04x}', value=bytes(value).hex())
 
-        # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
-            print("State timeout")
+                if self.gatt is not None and handle == self.gatt.service_changed_handle:
+                    print("Service Changed, discarding GATT table")
+                    self._gatt_invalidate()
+                    continue
+
+                return value
 
     # --------------------------------------------------------------------------
-    #  Send an array of bytes
+    #  Send a procedure + any parameters required
     # --------------------------------------------------------------------------
-    def _dfu_send_data(self, data):
-        cmd = f'char-write-cmd 0x{self.data_handle:04x} {bytes(data).hex()}'
+    async def _dfu_send_command(self, procedure, params=[]):
+        if verbose: print(f'command 0x{procedure:02x} {bytes(params).hex()}')
+
+        name = self.procedures.string_map.get(procedure, f'0x{procedure:02x}') if self.procedures else f'0x{procedure:02x}'
 
-        if verbose: print(cmd)
+        with self._trace(name, 'command', params=bytes(params).hex()):
+            # Verify that command was successfully written
+            if not await self._write_request(self.ctrlpt_handle, bytes([procedure]) + bytes(params)):
+                print("State timeout")
 
-        self.ble_conn.sendline(cmd)
+    # --------------------------------------------------------------------------
+    #  Send a bytes-like segment (typically a memoryview into the image)
+    # --------------------------------------------------------------------------
+    async def _dfu_send_data(self, data):
+        await self.link.write_command(self.data_handle, data)
 
     # --------------------------------------------------------------------------
     #  Enable notifications from the Control Point Handle
     # --------------------------------------------------------------------------
-    def _enable_notifications(self, cccd_handle):
+    async def _enable_notifications(self, cccd_handle):
         if verbose: print('_enable_notifications')
 
-        cmd  = f'char-write-req 0x{cccd_handle:04x} 0100'
-
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
-
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
+        if not await self._write_request(cccd_handle, b'\x01\x00'):
             print("State timeout")
 
     # --------------------------------------------------------------------------
     #  Enable indications from the Control Point Handle
     # --------------------------------------------------------------------------
-    def _enable_indications(self, cccd_handle):
+    async def _enable_indications(self, cccd_handle):
         if verbose: print('_enable_indications')
 
-        cmd  = f'char-write-req 0x{cccd_handle:04x} 0200'
-
-        if verbose: print(cmd)
-
-        self.ble_conn.sendline(cmd)
-
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=self.timeout)
-        except pexpect.TIMEOUT as e:
+        if not await self._write_request(cccd_handle, b'\x02\x00'):
             print("State timeout")
@@ -0,0 +1,84 @@
+import time
+
+# ------------------------------------------------------------------------------
+#  Adaptive Packet Receipt Notification interval.
+#
+#  Starts conservative and doubles the interval after a run of clean receipts
+#  whose round trip stays close to the best one seen so far. Any CRC mismatch,
+#  missing receipt or INSUFFICIENT_RESOURCES result halves it again.
+#  The controller re-issues SET_PRN / PRN_REQUEST whenever the interval
+#  changes, so the new value applies from the next object (or receipt).
+# ------------------------------------------------------------------------------
+class AdaptivePrn(object):
+
+    def __init__(self, initial=4, minimum=1, maximum=32, grow_after=3, slow_factor=2.0):
+        # An interval of 0 disables receipts, leaving nothing to adapt to
+        if minimum < 1 or initial < minimum:
+            raise Exception(f"Adaptive PRN interval must start at {max(minimum, 1)} or more, not {initial}")
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self.grow_after = grow_after
+        self.slow_factor = slow_factor
+
+        self.interval = initial
+
+        self.best_rtt = None
+        self.clean_receipts = 0
+
+        self.receipts = 0
+        self.errors = 0
+
+        # (time, interval) each time the interval was applied
+        self.history = []
+
+    # --------------------------------------------------------------------------
+    #  A receipt arrived and matched the expected CRC. rtt is the time between
+    #  the last packet of the batch being written and the receipt arriving.
+    # --------------------------------------------------------------------------
+    def on_receipt(self, rtt):
+        self.receipts += 1
+
+        if self.best_rtt is None or rtt < self.best_rtt:
+            self.best_rtt = rtt
+
+        if rtt > self.best_rtt * self.slow_factor:
+            self.clean_receipts = 0
+            return
+
+        self.clean_receipts += 1
+
+        if self.clean_receipts >= self.grow_after:
+            self.interval = min(self.interval * 2, self.maximum)
+            self.clean_receipts = 0
+
+    # --------------------------------------------------------------------------
+    #  CRC mismatch, receipt timeout or INSUFFICIENT_RESOURCES
+    # --------------------------------------------------------------------------
+    def on_error(self):
+        self.errors += 1
+
+        self.interval = max(self.interval // 2, self.minimum)
+        self.clean_receipts = 0
+
+    # --------------------------------------------------------------------------
+    #  Record that the current interval was sent to the peer
+    # --------------------------------------------------------------------------
+    def applied(self):
+        self.history.append((time.time(), self.interval))
+
+    def report(self):
+        intervals = [interval for (_, interval) in self.history]
+
+        return {
+            'initial'   : self.initial,
+            'final'     : self.interval,
+            'min'       : min(intervals, default=self.interval),
+            'max'       : max(intervals, default=self.interval),
+            'intervals' : intervals,
+            'receipts'  : self.receipts,
+            'errors'    : self.errors,
+            'best_rtt'  : self.best_rtt,
+        }
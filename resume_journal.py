@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+#  Journal of verified progress of secure DFU transfers, kept across runs.
+#
+#  Entries are keyed by device MAC and image hash (init packet + firmware), and
+#  record the last data object boundary the device executed. A controller
+#  that reconnects after a crash checks the device's SELECT (offset, CRC)
+#  against it to decide what can be skipped. The init packet needs no entry:
+#  its own SELECT tells whether it is on the device, and executing it again
+#  is harmless.
+# ------------------------------------------------------------------------------
+class ResumeJournal(object):
+
+    # Serializes read-modify-write cycles of controllers running in parallel
+    _lock = threading.Lock()
+
+    @staticmethod
+    def default_path():
+        state_home = os.environ.get('XDG_STATE_HOME', os.path.expanduser('~/.local/state'))
+        return os.path.join(state_home, 'ota-dfu', 'resume.json')
+
+    def __init__(self, path=None):
+        self.path = path or ResumeJournal.default_path()
+
+    def _key(self, mac, image_hash):
+        return f"{mac.upper()}|{image_hash}"
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            return {}
+
+    def _save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    # --------------------------------------------------------------------------
+    #  Returns {'offset': int, 'crc': int} or None
+    # --------------------------------------------------------------------------
+    def lookup(self, mac, image_hash):
+        return self._load().get(self._key(mac, image_hash))
+
+    def _update(self, mac, image_hash, **values):
+        with ResumeJournal._lock:
+            self._update_locked(mac, image_hash, **values)
+
+    def _update_locked(self, mac, image_hash, **values):
+        entries = self._load()
+
+        # Only one transfer per device can be in progress
+        for key in [key for key in entries if key.split('|')[0] == mac.upper()]:
+            if key != self._key(mac, image_hash):
+                del entries[key]
+
+        entry = entries.setdefault(self._key(mac, image_hash), {'offset': 0, 'crc': 0})
+        entry.update(values)
+        entry['time'] = int(time.time())
+
+        self._save(entries)
+
+    # --------------------------------------------------------------------------
+    #  Record an executed data object boundary
+    # --------------------------------------------------------------------------
+    def record_object(self, mac, image_hash, offset, crc):
+        self._update(mac, image_hash, offset=offset, crc=crc)
+
+    def clear(self, mac, image_hash):
+        with ResumeJournal._lock:
+            entries = self._load()
+
+            if entries.pop(self._key(mac, image_hash), None) is not None:
+                self._save(entries)
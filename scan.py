@@ -1,101 +1,322 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 #------------------------------------------------------------------------------
 # Device scan
+#
+# A LiveScanner scans continuously in the background and keeps a DeviceIndex
+# of every advertising device: last RSSI, name, advertised service UUIDs,
+# last-seen time and what it is running (application, DFU bootloader or
+# RuuviTag firmware). Devices not heard from for the index's TTL are dropped.
 #------------------------------------------------------------------------------
 
-from subprocess import call
+import optparse
+import re
+import sys
+import threading
+import time
 
 import pexpect
-import signal
+
+from hci_scan import HciScanner
+
+verbose = False
+
+MODE_APPLICATION = 'application'
+MODE_BOOTLOADER  = 'bootloader'
+MODE_RUUVITAG    = 'ruuvitag'
+
+# Names the Nordic (DfuTarg) and RuuviTag bootloaders advertise with
+BOOTLOADER_NAMES = ['DfuTarg', 'RuuviBoot']
+
+RUUVI_COMPANY_ID = 0x0499
+
+BLUETOOTH_BASE_UUID = '-0000-1000-8000-00805f9b34fb'
 
 #------------------------------------------------------------------------------
-# Bluetooth LE scan for advertising peripheral devices
+# (name, service UUIDs, manufacturer company id) from advertising data
 #------------------------------------------------------------------------------
-class HciTool:
+AD_UUID16       = (0x02, 0x03)
+AD_UUID128      = (0x06, 0x07)
+AD_NAME         = (0x08, 0x09)
+AD_MANUFACTURER = 0xFF
 
-    def __init__( self, advert_name ):
-        self.advert_name = advert_name
-        return
+def parse_advertisement(data):
+    name = None
+    uuids = []
+    manufacturer = None
+
+    position = 0
+    while position < len(data):
+        length = data[position]
+        if length == 0 or position + 1 + length > len(data):
+            break
+
+        (ad_type, value) = (data[position + 1], data[position + 2:position + 1 + length])
+        position += 1 + length
+
+        if ad_type in AD_NAME:
+            name = value.decode(errors='replace')
+
+        elif ad_type in AD_UUID16:
+            uuids += [f"0000{value[i + 1]:02x}{value[i]:02x}{BLUETOOTH_BASE_UUID}" for i in range(0, len(value) - 1, 2)]
+
+        elif ad_type in AD_UUID128:
+            for i in range(0, len(value) - 15, 16):
+                raw = bytes(reversed(value[i:i + 16])).hex()
+                uuids.append(f"{raw[0:8]}-{raw[8:12]}-{raw[12:16]}-{raw[16:20]}-{raw[20:32]}")
+
+        elif ad_type == AD_MANUFACTURER and len(value) >= 2:
+            manufacturer = value[0] | (value[1] << 8)
+
+    return (name, uuids, manufacturer)
+
+def classify(name, uuids, manufacturer):
+    if name in BOOTLOADER_NAMES:
+        return MODE_BOOTLOADER
+
+    if manufacturer == RUUVI_COMPANY_ID:
+        return MODE_RUUVITAG
+
+    return MODE_APPLICATION
+
+#------------------------------------------------------------------------------
+# What is known about one advertising device
+#------------------------------------------------------------------------------
+class SeenDevice(object):
+    __slots__ = ('mac', 'rssi', 'name', 'uuids', 'manufacturer', 'mode', 'first_seen', 'last_seen')
+
+    def __init__(self, mac, now):
+        self.mac = mac
+        self.rssi = None
+        self.name = None
+        self.uuids = []
+        self.manufacturer = None
+        self.mode = MODE_APPLICATION
+        self.first_seen = now
+        self.last_seen = now
+
+    def __repr__(self):
+        return f"SeenDevice({self.mac}, {self.mode}, name={self.name!r}, rssi={self.rssi})"
+
+#------------------------------------------------------------------------------
+# Advertising devices by MAC. Thread safe; times are time.monotonic().
+#------------------------------------------------------------------------------
+class DeviceIndex(object):
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+
+        self.devices = {}
+        self.changed = threading.Condition()
+
+    def update(self, mac, rssi=None, data=b'', name=None):
+        (ad_name, uuids, manufacturer) = parse_advertisement(data)
+        now = time.monotonic()
+
+        with self.changed:
+            device = self.devices.get(mac)
+            if device is None:
+                device = self.devices[mac] = SeenDevice(mac, now)
+
+            device.last_seen = now
+
+            if rssi is not None:
+                device.rssi = rssi
+            if ad_name or name:
+                device.name = ad_name or name
+            if uuids:
+                device.uuids = uuids
+            if manufacturer is not None:
+                device.manufacturer = manufacturer
+
+            # Names are often only in some of the packets; keep what was seen
+            device.mode = classify(device.name, device.uuids, device.manufacturer)
+
+            self.changed.notify_all()
+
+        return device
+
+    def _evict(self, now):
+        for mac in [mac for (mac, device) in self.devices.items() if device.last_seen < now - self.ttl]:
+            del self.devices[mac]
+
+    # --------------------------------------------------------------------------
+    #  The device advertising at mac, None if it wasn't heard from recently
+    # --------------------------------------------------------------------------
+    def get(self, mac):
+        with self.changed:
+            self._evict(time.monotonic())
+            return self.devices.get(mac.upper())
+
+    def all(self):
+        with self.changed:
+            self._evict(time.monotonic())
+            return sorted(self.devices.values(), key=lambda device: device.mac)
+
+    # --------------------------------------------------------------------------
+    #  Wait until one of macs advertises (after since, if given). Returns the
+    #  one heard from last, None if none did within timeout.
+    # --------------------------------------------------------------------------
+    def wait_for(self, macs, timeout, since=None):
+        macs = [mac.upper() for mac in macs]
+        deadline = time.monotonic() + timeout
 
-    def scan( self ):
+        with self.changed:
+            while True:
+                now = time.monotonic()
+                self._evict(now)
+
+                seen = [self.devices[mac] for mac in macs if mac in self.devices and (since is None or self.devices[mac].last_seen > since)]
+                if seen:
+                    return max(seen, key=lambda device: device.last_seen)
+
+                if now >= deadline:
+                    return None
+
+                self.changed.wait(deadline - now)
+
+#------------------------------------------------------------------------------
+# Bluetooth LE scan with hcitool, used when the raw HCI socket can't be.
+# Only gives addresses and names.
+#------------------------------------------------------------------------------
+class HciTool(object):
+
+    LINE_PATTERN = re.compile(r'^([0-9A-F]{2}(?::[0-9A-F]{2}){5}) (.*)$')
+
+    def __init__(self, adapter=None):
+        self.adapter = adapter
+        self.hcitool = None
+
+    def start(self):
+        adapter = f"-i {self.adapter} " if self.adapter else ""
 
         try:
-            self.hcitool = pexpect.spawn('hcitool lescan')
-            #self.hcitool.logfile = sys.stdout
-            index = self.hcitool.expect(['LE Scan ...'], 1)
-        except pexpect.EOF:
-            self.hcitool.terminate(force=True)
-            return []
-        except Exception as err:
-            print(f"scan: exception: {sys.exc_info()[0]}")
-            self.hcitool.terminate(force=True)
-            return []
+            self.hcitool = pexpect.spawn(f"hcitool {adapter}lescan --passive --duplicates")
+            self.hcitool.expect(['LE Scan ...'], 2)
+        except pexpect.ExceptionPexpect as e:
+            self.stop()
+            raise OSError(f"hcitool lescan failed: {e}")
 
-        if index != 0:
-            print("scan: failed")
-            self.hcitool.terminate(force=True)
-            return []
+        return self
+
+    def stop(self):
+        if self.hcitool is None:
+            return
+
+        # Interrupted, hcitool disables scanning on its way out
+        if self.hcitool.isalive():
+            self.hcitool.sendintr()
+            self.hcitool.expect([pexpect.EOF, pexpect.TIMEOUT], 1)
+
+        self.hcitool.close(force=True)
+        self.hcitool = None
+
+    # --------------------------------------------------------------------------
+    #  (mac, name) of every line printed until timeout
+    # --------------------------------------------------------------------------
+    def reports(self, timeout):
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            self.hcitool.timeout = max(deadline - time.monotonic(), 0.01)
 
-        list = []
-        for dummy in range(0, 2):
             try:
-                list.append(self.hcitool.readline())
+                line = self.hcitool.readline()
             except pexpect.TIMEOUT:
-                break
+                return
 
-        if list == []:
-            return []
+            if not line:
+                raise OSError("hcitool lescan exited")
+
+            match = self.LINE_PATTERN.match(line.decode(errors='replace').strip())
+            if match:
+                name = match.group(2)
+                yield (match.group(1), None if name == '(unknown)' else name)
 
-        # Eliminate duplicate items in list
-        list = set(list)
+#------------------------------------------------------------------------------
+# Background scan feeding a DeviceIndex, on a raw HCI socket or, failing
+# that, through hcitool
+#------------------------------------------------------------------------------
+class LiveScanner(object):
+
+    # Seconds between checks of the stop flag
+    poll_interval = 0.5
+
+    def __init__(self, index=None, adapter=None):
+        self.index = index or DeviceIndex()
+        self.adapter = adapter
+
+        self.running = False
+        self.thread = None
+        self.backend = None
 
-        # Remove non self.advert_name units
-        if self.advert_name != None:
-            list = [item for item in list if self.advert_name in item]
+    def start(self):
+        try:
+            self.backend = HciScanner(self.adapter).start()
+        except OSError as e:
+            if verbose: print(f"Raw HCI scan unavailable ({e}), using hcitool")
+            self.backend = HciTool(self.adapter).start()
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        return self
 
-        # remove empty items from list
-        while '\r\n' in list:
-            list.remove('\r\n')
+    def stop(self):
+        self.running = False
 
-        # Strip newline from items in list
-        list = [item.strip() for item in list]
-        list = list[0:2]
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
-        # Close pexpect (release device for subsequent use)
-        self.hcitool.terminate(force=True)
+    def __enter__(self):
+        return self.start()
 
-        return list
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        try:
+            while self.running:
+                if isinstance(self.backend, HciScanner):
+                    for report in self.backend.reports(self.poll_interval):
+                        self.index.update(report.mac, report.rssi, report.data)
+                else:
+                    for (mac, name) in self.backend.reports(self.poll_interval):
+                        self.index.update(mac, name=name)
+        except OSError as e:
+            print(f"scan: {e}")
+        finally:
+            self.backend.stop()
 
 #------------------------------------------------------------------------------
-#
+# Devices advertising within duration seconds, as "MAC name" strings,
+# optionally only those with advert_name in their name
 #------------------------------------------------------------------------------
 class Scan:
 
-    def __init__( self, advert_name ):
+    def __init__( self, advert_name, adapter=None, duration=3.0 ):
         self.advert_name = advert_name
-        return    
+        self.adapter = adapter
+        self.duration = duration
 
     def scan(self):
-
-        scan_list = []
+        index = DeviceIndex()
 
         try:
-            hcitool = HciTool(self.advert_name)
-            scan_list = hcitool.scan()
+            with LiveScanner(index, self.adapter):
+                time.sleep(self.duration)
 
         except KeyboardInterrupt:
             # On Cntl-C
             pass
-        except pexpect.TIMEOUT:
-            print("scan: pexpect.TIMEOUT")
-            pass
-        except Exception as e:
-            print(f"scan: exception: {sys.exc_info()[0]}")
-            pass
-
+        except OSError as e:
+            print(f"scan: {e}")
+            return []
 
-        return scan_list
+        return [f"{device.mac} {device.name or '(unknown)'}" for device in index.all()
+                if self.advert_name is None or (device.name and self.advert_name in device.name)]
 
 #------------------------------------------------------------------------------
 #
@@ -105,9 +326,29 @@ if __name__ == '__main__':
     # Do not litter the world with broken .pyc files.
     sys.dont_write_bytecode = True
 
-    #scanner = Scan("DfuTarg")  # specific advertisement name
-    scanner = Scan(None)      # any advertising name
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-i', '--adapter', dest='adapter', default=None,
+                      help='Bluetooth adapter to scan with, e.g. hci1')
+    parser.add_option('-t', '--time', dest='duration', type='float', default=10.0,
+                      help='seconds to scan (default: %default)')
+    parser.add_option('-n', '--name', dest='name', default=None,
+                      help='only list devices with this in their name')
+
+    (options, args) = parser.parse_args()
+
+    index = DeviceIndex()
+
+    try:
+        with LiveScanner(index, options.adapter):
+            time.sleep(options.duration)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"scan: {e}")
+        sys.exit(1)
 
-    scanner.scan()
+    for device in index.all():
+        if options.name is None or (device.name and options.name in device.name):
+            print(f"{device.mac}  {device.mode:11}  {device.rssi if device.rssi is not None else '':>4}  {device.name or ''}")
 
     print("scan complete")
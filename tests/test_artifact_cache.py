@@ -0,0 +1,206 @@
+import functools
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from artifact_cache import ArtifactCache
+
+# ------------------------------------------------------------------------------
+#  DFU packages served from a temporary directory over HTTP on localhost,
+#  counting the requests made for each and the ones answered with the file
+# ------------------------------------------------------------------------------
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+        http.server.SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_response(self, code, message=None):
+        if code == 200:
+            self.server.downloads[self.path] = self.server.downloads.get(self.path, 0) + 1
+        http.server.SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_package(path, firmware, init):
+    manifest = {'manifest': {'application': {'bin_file': 'app.bin', 'dat_file': 'app.dat'}}}
+
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('app.bin', firmware)
+        z.writestr('app.dat', init)
+        z.writestr('manifest.json', json.dumps(manifest))
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serve_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+        self.firmware = {}
+        self.digests = {}
+
+        for (i, name) in enumerate(('a', 'b', 'c')):
+            self.firmware[name] = bytes((j * (i + 3)) & 0xFF for j in range(8192))
+            self.digests[name] = make_package(os.path.join(self.serve_dir, f"{name}.zip"), self.firmware[name], b'init ' + name.encode())
+
+        handler = functools.partial(CountingHandler, directory=self.serve_dir)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.requests = {}
+        self.server.downloads = {}
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        shutil.rmtree(self.serve_dir, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server.server_port}/{name}.zip"
+
+    def hits(self, name):
+        return self.server.downloads.get(f"/{name}.zip", 0)
+
+    def requests(self, name):
+        return self.server.requests.get(f"/{name}.zip", 0)
+
+    def entry_size(self, cache, sha256):
+        entry = os.path.join(cache.path, sha256)
+        return sum(os.path.getsize(os.path.join(root, f)) for (root, _, files) in os.walk(entry) for f in files)
+
+    def test_download(self):
+        cache = ArtifactCache(self.cache_dir)
+
+        sha256 = cache.fetch(self.url('a'))
+        self.assertEqual(sha256, self.digests['a'])
+        self.assertEqual(self.hits('a'), 1)
+
+        image = cache.load(sha256)
+        self.assertEqual(image.type, 'application')
+        self.assertEqual(bytes(image.firmware.view), self.firmware['a'])
+        self.assertEqual(image.init, b'init a')
+        image.firmware.close()
+
+    def test_sha256_mismatch_is_rejected(self):
+        cache = ArtifactCache(self.cache_dir)
+
+        with self.assertRaises(Exception) as raised:
+            cache.fetch(self.url('a'), sha256='00' * 32)
+
+        self.assertIn('expected', str(raised.exception))
+        self.assertIsNone(cache.resolve(self.digests['a']))
+        self.assertNotIn(self.url('a'), cache._urls())
+
+        # Nothing left behind from the download
+        self.assertEqual([name for name in os.listdir(self.cache_dir) if name.startswith('.download-')], [])
+
+        self.assertEqual(cache.fetch(self.url('a'), sha256=self.digests['a'].upper()), self.digests['a'])
+
+    def test_url_fetched_before_is_reused(self):
+        cache = ArtifactCache(self.cache_dir)
+
+        sha256 = cache.fetch(self.url('a'))
+        self.assertEqual(cache.fetch(self.url('a')), sha256)
+        self.assertEqual(cache.fetch(self.url('a'), sha256=sha256), sha256)
+
+        # Also by another process sharing the store
+        self.assertEqual(ArtifactCache(self.cache_dir).fetch(self.url('a')), sha256)
+        self.assertEqual(self.hits('a'), 1)
+
+        # Revalidated with the server, except when the hash is given
+        self.assertEqual(self.requests('a'), 3)
+
+    def test_changed_content_is_downloaded_again(self):
+        cache = ArtifactCache(self.cache_dir)
+        path = os.path.join(self.serve_dir, 'a.zip')
+
+        self.assertEqual(cache.fetch(self.url('a')), self.digests['a'])
+
+        # Re-published at the same URL
+        shutil.copyfile(os.path.join(self.serve_dir, 'b.zip'), path)
+        mtime = os.path.getmtime(path) + 60
+        os.utime(path, (mtime, mtime))
+
+        sha256 = cache.fetch(self.url('a'))
+        self.assertEqual(sha256, self.digests['b'])
+        self.assertEqual(self.hits('a'), 2)
+
+        image = cache.load(sha256)
+        self.assertEqual(bytes(image.firmware.view), self.firmware['b'])
+        image.firmware.close()
+
+        self.assertEqual(cache.fetch(self.url('a')), self.digests['b'])
+        self.assertEqual(self.hits('a'), 2)
+
+    def test_refresh(self):
+        cache = ArtifactCache(self.cache_dir)
+
+        sha256 = cache.fetch(self.url('a'))
+        self.assertEqual(cache.fetch(self.url('a'), refresh=True), sha256)
+        self.assertEqual(self.hits('a'), 2)
+
+    def test_url_without_validators_is_downloaded_again(self):
+        cache = ArtifactCache(self.cache_dir)
+        sha256 = cache.fetch(self.url('a'))
+
+        # As written before validators were kept
+        with open(os.path.join(self.cache_dir, 'urls.json'), 'w') as f:
+            json.dump({self.url('a'): sha256}, f)
+
+        self.assertEqual(cache.fetch(self.url('a')), sha256)
+        self.assertEqual(self.hits('a'), 2)
+        self.assertTrue(cache._urls()[self.url('a')]['last_modified'])
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ArtifactCache(self.cache_dir)
+
+        for (mtime, name) in enumerate(('a', 'b'), 1):
+            cache.fetch(self.url(name))
+            os.utime(os.path.join(self.cache_dir, self.digests[name]), (mtime, mtime))
+
+        # a used after b
+        cache.load(self.digests['a']).firmware.close()
+
+        # Room for two entries, not three
+        size = self.entry_size(cache, self.digests['a'])
+        cache.budget = size * 5 // 2
+
+        cache.fetch(self.url('c'))
+
+        self.assertIsNotNone(cache.resolve(self.digests['a']))
+        self.assertIsNone(cache.resolve(self.digests['b']))
+        self.assertIsNotNone(cache.resolve(self.digests['c']))
+        self.assertNotIn(self.url('b'), cache._urls())
+
+        # An evicted URL is downloaded again
+        self.assertEqual(cache.fetch(self.url('b')), self.digests['b'])
+        self.assertEqual(self.hits('b'), 2)
+
+    def test_entry_over_budget_is_kept(self):
+        cache = ArtifactCache(self.cache_dir, budget=1)
+
+        cache.fetch(self.url('a'))
+        cache.fetch(self.url('b'))
+
+        self.assertIsNone(cache.resolve(self.digests['a']))
+        self.assertIsNotNone(cache.resolve(self.digests['b']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import sys
+import threading
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_dfu      import update, controller
+from att_transport  import AsyncAttSocketTransport
+from transport      import ConnectionLost
+from dfu_simulator  import SimulatedRadio, SimulatedTransport, SecureDfuTarget, secure_device, legacy_device, ruuvitag_device
+from firmware_image import FirmwareImage
+from unpacker       import PackageImage
+
+from test_att_transport import FakePeripheral
+
+MACS = ['C0:00:00:00:00:41', 'C0:00:00:00:00:51', 'C0:00:00:00:00:61']
+
+DEVICE_ID = '01:02:03:04:05:06:07:08'
+
+FIRMWARE = bytes((i * 11) & 0xFF for i in range(12000))
+
+IMAGE = PackageImage('application', FirmwareImage(FIRMWARE), b'init packet', None)
+
+class AsyncDfuTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    #  Several secure DFU transfers over ATT sockets, all driven by one loop
+    # --------------------------------------------------------------------------
+    def test_concurrent_socket_updates(self):
+        targets = []
+        peers = []
+        transports = []
+
+        for mac in MACS:
+            (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+            targets.append(SecureDfuTarget(mac))
+            peers.append(FakePeripheral(targets[-1], theirs))
+            transports.append(AsyncAttSocketTransport(mac, sock=ours))
+
+        threads = threading.active_count()
+
+        async def update_all():
+            return await asyncio.gather(*(update(mac, IMAGE, transport, pkt_receipt_interval=4) for (mac, transport) in zip(MACS, transports)))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            controllers = asyncio.run(update_all())
+
+        # No thread was started for the transfers (the fake peripherals'
+        # end as they are disconnected)
+        self.assertLessEqual(threading.active_count(), threads)
+
+        for (target, ble_dfu) in zip(targets, controllers):
+            self.assertEqual(bytes(target.command), b'init packet')
+            self.assertEqual(bytes(target.data), FIRMWARE)
+            self.assertEqual(target.executed, len(FIRMWARE))
+            self.assertTrue(ble_dfu.transfer_report()['success'])
+
+        for peer in peers:
+            peer.close()
+
+    # --------------------------------------------------------------------------
+    #  The application to bootloader switch of each family, on synchronous
+    #  (simulated) transports sharing one loop
+    # --------------------------------------------------------------------------
+    def test_mode_switch_on_synchronous_transports(self):
+        (secure_radio, legacy_radio, ruuvi_radio) = (SimulatedRadio(), SimulatedRadio(), SimulatedRadio())
+
+        (_, secure) = secure_device(secure_radio, MACS[0], len(FIRMWARE))
+        (_, legacy) = legacy_device(legacy_radio, MACS[1], zlib.crc32(FIRMWARE))
+        (_, ruuvi) = ruuvitag_device(ruuvi_radio, MACS[2], DEVICE_ID, len(FIRMWARE))
+
+        async def update_all():
+            await asyncio.gather(
+                update(MACS[0], IMAGE, SimulatedTransport(MACS[0], secure_radio)),
+                update(MACS[1], IMAGE, SimulatedTransport(MACS[1], legacy_radio), legacy=True),
+                update(MACS[2], IMAGE, SimulatedTransport(MACS[2], ruuvi_radio), device_id=DEVICE_ID))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(update_all())
+
+        self.assertEqual(bytes(secure.data), FIRMWARE)
+        self.assertTrue(legacy.complete)
+        self.assertEqual(bytes(ruuvi.data), FIRMWARE)
+
+    def test_unknown_setting(self):
+        with self.assertRaises(Exception):
+            controller(MACS[0], SimulatedTransport(MACS[0], SimulatedRadio()), pkt_receipt_intervall=4)
+
+    def test_failed_update_disconnects(self):
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        theirs.close()
+
+        transport = AsyncAttSocketTransport(MACS[0], sock=ours)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(ConnectionLost):
+                asyncio.run(update(MACS[0], IMAGE, transport))
+
+        self.assertIsNone(transport.sock)
+
+    def test_synchronous_methods_need_a_synchronous_transport(self):
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        ble_dfu = controller(MACS[0], AsyncAttSocketTransport(MACS[0], sock=ours))
+
+        with self.assertRaises(Exception):
+            ble_dfu.scan_and_connect()
+
+        ours.close()
+        theirs.close()
+
+if __name__ == '__main__':
+    unittest.main()
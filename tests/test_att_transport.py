@@ -0,0 +1,194 @@
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from att_transport  import AttSocketTransport, Att, uuid_to_bytes
+from transport      import ConnectionLost
+from dfu_simulator  import SecureDfuTarget
+from firmware_image import FirmwareImage
+
+from ble_secure_dfu_controller import BleDfuControllerSecure
+
+MAC = 'C0:00:00:00:00:01'
+
+# ------------------------------------------------------------------------------
+#  ATT server on one end of a SOCK_SEQPACKET socketpair (which keeps PDU
+#  boundaries, like L2CAP), serving a simulated peripheral's GATT table
+# ------------------------------------------------------------------------------
+class FakePeripheral(object):
+
+    def __init__(self, peripheral, sock, mtu=247):
+        self.peripheral = peripheral
+        self.sock = sock
+        self.mtu = mtu
+
+        self.writes = []
+        self.commands = []
+
+        peripheral.connection = self
+
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    # Called by the simulated peripheral
+    def queue_notification(self, handle, value):
+        self.sock.send(struct.pack('<BH', Att.NOTIFY, handle) + value)
+
+    def link_lost(self):
+        self.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            pass
+
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                pdu = self.sock.recv(Att.MAX_PDU)
+            except OSError as e:
+                return
+
+            if not pdu:
+                return
+
+            self._handle(pdu)
+
+    def _error(self, opcode, handle, code):
+        self.sock.send(struct.pack('<BBHB', Att.ERROR_RSP, opcode, handle, code))
+
+    def _handle(self, pdu):
+        opcode = pdu[0]
+
+        if opcode == Att.MTU_REQ:
+            self.sock.send(struct.pack('<BH', Att.MTU_RSP, self.mtu))
+
+        elif opcode == Att.READ_BY_TYPE_REQ:
+            (start, end) = struct.unpack_from('<HH', pdu, 1)
+            uuid = pdu[5:]
+
+            if uuid == struct.pack('<H', Att.UUID_CHARACTERISTIC):
+                chars = [char for char in self.peripheral.chars if start <= char.handle <= end]
+                if not chars:
+                    self._error(opcode, start, Att.ERR_ATTR_NOT_FOUND)
+                    return
+
+                # One entry per response, as the entries' UUID sizes may differ
+                char = chars[0]
+                entry = struct.pack('<HBH', char.handle, char.properties, char.value_handle) + uuid_to_bytes(char.uuid)
+                self.sock.send(bytes([Att.READ_BY_TYPE_RSP, len(entry)]) + entry)
+                return
+
+            for char in self.peripheral.chars:
+                if uuid_to_bytes(char.uuid) == uuid:
+                    entry = struct.pack('<H', char.value_handle) + self.peripheral.on_read(char.value_handle)
+                    self.sock.send(bytes([Att.READ_BY_TYPE_RSP, len(entry)]) + entry)
+                    return
+
+            self._error(opcode, start, Att.ERR_ATTR_NOT_FOUND)
+
+        elif opcode == Att.WRITE_REQ:
+            (handle,) = struct.unpack_from('<H', pdu, 1)
+            self.writes.append((handle, pdu[3:]))
+
+            # Responded before the peripheral notifies, as a real stack does
+            self.sock.send(bytes([Att.WRITE_RSP]))
+            self.peripheral.on_write(handle, pdu[3:])
+
+        elif opcode == Att.WRITE_CMD:
+            (handle,) = struct.unpack_from('<H', pdu, 1)
+            self.commands.append((handle, pdu[3:]))
+            self.peripheral.on_write(handle, pdu[3:])
+
+        else:
+            self._error(opcode, 0x0000, Att.ERR_REQ_NOT_SUPP)
+
+class AttSocketTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        self.target = SecureDfuTarget(MAC)
+        self.peer = FakePeripheral(self.target, theirs)
+
+        self.transport = AttSocketTransport(MAC, sock=ours)
+        self.transport.timeout = 2
+        self.assertTrue(self.transport.connect())
+
+    def tearDown(self):
+        self.transport.disconnect()
+        self.peer.close()
+
+    def test_exchange_mtu(self):
+        self.assertEqual(self.transport.exchange_mtu(517), 247)
+        self.assertEqual(self.transport.exchange_mtu(100), 100)
+
+    def test_discover_characteristics(self):
+        self.assertEqual(self.transport.discover_characteristics(), self.target.chars)
+
+    def test_read_by_uuid(self):
+        self.assertEqual(self.transport.read_by_uuid(SecureDfuTarget.UUID_CONTROL_POINT), b'')
+        self.assertIsNone(self.transport.read_by_uuid('00002a26-0000-1000-8000-00805f9b34fb'))
+
+    def test_write_request_is_acknowledged(self):
+        cccd = self.target.control_point + 1
+
+        self.assertTrue(self.transport.write_request(cccd, b'\x01\x00'))
+        self.assertEqual(self.peer.writes, [(cccd, b'\x01\x00')])
+        self.assertEqual(self.target.cccds[cccd], 1)
+
+    def test_write_command_sends_binary_payload(self):
+        payload = bytes(range(20))
+        self.transport.write_command(self.target.packet, memoryview(payload))
+
+        # The next acknowledged request comes after the command
+        self.transport.write_request(self.target.control_point + 1, b'\x00\x00')
+        self.assertEqual(self.peer.commands, [(self.target.packet, payload)])
+
+    def test_notification(self):
+        self.transport.write_request(self.target.control_point + 1, b'\x01\x00')
+        self.transport.write_request(self.target.control_point, bytes([SecureDfuTarget.SET_PRN, 0, 0]))
+
+        self.assertEqual(self.transport.wait_for_notification(2),
+                         (self.target.control_point, bytes([SecureDfuTarget.RESPONSE, SecureDfuTarget.SET_PRN, SecureDfuTarget.SUCCESS])))
+
+    def test_no_notification_times_out(self):
+        self.assertIsNone(self.transport.wait_for_notification(0.05))
+
+    def test_link_loss(self):
+        self.peer.close()
+
+        with self.assertRaises(ConnectionLost):
+            self.transport.wait_for_notification(2)
+
+        with self.assertRaises(ConnectionLost):
+            self.transport.write_command(self.target.packet, b'\x00')
+
+    # --------------------------------------------------------------------------
+    #  A whole secure DFU transfer through the socket
+    # --------------------------------------------------------------------------
+    def test_secure_dfu(self):
+        firmware = bytes((i * 7) & 0xFF for i in range(10000))
+
+        controller = BleDfuControllerSecure(MAC, None, None, self.transport)
+        controller.use_image(FirmwareImage(firmware), b'init packet')
+        controller.pkt_receipt_interval = 4
+
+        self.assertTrue(controller.scan_and_connect())
+        self.assertTrue(controller.check_DFU_mode())
+        controller.start()
+
+        self.assertEqual(bytes(self.target.command), b'init packet')
+        self.assertEqual(bytes(self.target.data), firmware)
+        self.assertEqual(self.target.executed, len(firmware))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dfu_simulator  import SimulatedRadio, SimulatedTransport, Props, LegacyApplication, LegacyDfuTarget, secure_device
+from firmware_image import FirmwareImage
+from gatt_cache     import GattCache, GattDatabase
+from transport      import Characteristic
+
+from ble_secure_dfu_controller import BleDfuControllerSecure
+from ble_legacy_dfu_controller import BleDfuControllerLegacy
+
+MAC = 'C0:00:00:00:00:30'
+
+FIRMWARE = bytes((i * 5) & 0xFF for i in range(6000))
+
+class GattCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = GattCache(os.path.join(self.cache_dir, 'gatt.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def controller(self, cls, radio):
+        ble_dfu = cls(MAC, None, None, SimulatedTransport(MAC, radio))
+        ble_dfu.use_image(FirmwareImage(FIRMWARE), b'init packet')
+        ble_dfu.gatt_cache = self.cache
+
+        return ble_dfu
+
+    def test_no_version_is_not_cached(self):
+        database = GattDatabase([Characteristic(0x10, Props.WRITE, 0x11, LegacyDfuTarget.UUID_CONTROL_POINT)])
+
+        self.cache.store(MAC, None, database)
+        self.assertIsNone(self.cache.load(MAC, None))
+
+        self.cache.store(MAC, '1.0.0', database)
+        self.assertEqual(self.cache.load(MAC, '1.0.0').chars, database.chars)
+        self.assertIsNone(self.cache.load(MAC, None))
+
+    # --------------------------------------------------------------------------
+    #  A legacy application exposing the DFU service at other handles than
+    #  its bootloader, both at the same address and without a Firmware
+    #  Revision
+    # --------------------------------------------------------------------------
+    def test_legacy_application_and_bootloader(self):
+        radio = SimulatedRadio()
+
+        bootloader = LegacyDfuTarget(MAC, firmware_crc=zlib.crc32(FIRMWARE))
+        application = LegacyApplication(MAC, bootloader)
+        application.add_characteristic(LegacyDfuTarget.UUID_PACKET, Props.WRITE_NO_RSP)
+        bootloader.next_peripheral = application
+
+        # Shift the application's handles
+        application.chars = [Characteristic(handle + 0x10, props, value_handle + 0x10, uuid) for (handle, props, value_handle, uuid) in application.chars]
+        application.control_point += 0x10
+        application.values = {handle + 0x10: value for (handle, value) in application.values.items()}
+        application.cccds = {handle + 0x10: value for (handle, value) in application.cccds.items()}
+
+        radio.add(application)
+
+        ble_dfu = self.controller(BleDfuControllerLegacy, radio)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(ble_dfu.scan_and_connect())
+            self.assertFalse(ble_dfu.check_DFU_mode())
+            self.assertTrue(ble_dfu.switch_to_dfu_mode())
+            ble_dfu.start()
+            ble_dfu.disconnect()
+
+        self.assertTrue(bootloader.complete)
+        self.assertEqual(bytes(bootloader.firmware), FIRMWARE)
+        self.assertIsNone(self.cache.load(MAC, None))
+
+    def test_failed_write_invalidates_entry(self):
+        radio = SimulatedRadio()
+        (application, bootloader) = secure_device(radio, MAC, len(FIRMWARE))
+
+        # Left by other firmware reporting the same version
+        stale = [Characteristic(handle + 0x40, props, value_handle + 0x40, uuid) for (handle, props, value_handle, uuid) in application.chars]
+        self.cache.store(MAC, '1.0.0', GattDatabase(stale))
+
+        ble_dfu = self.controller(BleDfuControllerSecure, radio)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(ble_dfu.scan_and_connect())
+            self.assertFalse(ble_dfu.check_DFU_mode())
+            ble_dfu.switch_to_dfu_mode()
+            ble_dfu.disconnect()
+
+        self.assertIsNone(GattCache(self.cache.path).load(MAC, '1.0.0'))
+
+        # The next attempt discovers the real handles
+        ble_dfu = self.controller(BleDfuControllerSecure, radio)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(ble_dfu.scan_and_connect())
+            self.assertFalse(ble_dfu.check_DFU_mode())
+            self.assertTrue(ble_dfu.switch_to_dfu_mode())
+            ble_dfu.start()
+            ble_dfu.disconnect()
+
+        self.assertTrue(bootloader.complete)
+        self.assertEqual(GattCache(self.cache.path).load(MAC, '1.0.0').chars, application.chars)
+
+if __name__ == '__main__':
+    unittest.main()
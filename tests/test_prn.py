@@ -0,0 +1,73 @@
+import contextlib
+import io
+import os
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dfu_simulator  import SimulatedRadio, SimulatedTransport, LinkModel, secure_device, legacy_device
+from firmware_image import FirmwareImage
+from prn_controller import AdaptivePrn
+from transfer_plan  import TransferPlan
+
+from ble_secure_dfu_controller import BleDfuControllerSecure
+from ble_legacy_dfu_controller import BleDfuControllerLegacy
+
+MAC = 'C0:00:00:00:00:20'
+
+FIRMWARE = bytes((i * 13) & 0xFF for i in range(10000))
+
+# ------------------------------------------------------------------------------
+#  A PRN interval of 0 disables Packet Receipt Notifications
+# ------------------------------------------------------------------------------
+class PrnDisabledTest(unittest.TestCase):
+
+    def run_update(self, controller, target, loss=0):
+        radio = SimulatedRadio()
+        (_, bootloader) = target(radio, loss)
+
+        ble_dfu = controller(bootloader.mac, None, None, SimulatedTransport(bootloader.mac, radio))
+        ble_dfu.use_image(FirmwareImage(FIRMWARE), b'init packet')
+        ble_dfu.pkt_receipt_interval = 0
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(ble_dfu.scan_and_connect())
+            ble_dfu.start()
+            ble_dfu.disconnect()
+
+        self.assertTrue(bootloader.complete)
+        self.assertEqual(ble_dfu.instrumentation.receipts.count, 0)
+
+        return bootloader
+
+    def test_plan_has_no_receipts(self):
+        plan = TransferPlan.build(FirmwareImage(FIRMWARE), 4096, 20, 0)
+
+        self.assertEqual([len(obj.checkpoints) for obj in plan.objects], [1, 1, 1])
+        self.assertEqual(plan.final_crc, zlib.crc32(FIRMWARE))
+
+    def test_secure(self):
+        secure = lambda radio, loss: secure_device(radio, MAC, len(FIRMWARE), LinkModel(loss=loss, seed=1), in_dfu_mode=True)
+
+        self.assertEqual(bytes(self.run_update(BleDfuControllerSecure, secure).data), FIRMWARE)
+
+        # Lost packets are caught by the checksum at the end of each object
+        bootloader = self.run_update(BleDfuControllerSecure, secure, loss=0.01)
+        self.assertEqual(bytes(bootloader.data), FIRMWARE)
+        self.assertGreater(bootloader.objects_created, bootloader.objects_executed)
+
+    def test_legacy(self):
+        legacy = lambda radio, loss: legacy_device(radio, MAC, zlib.crc32(FIRMWARE), LinkModel(loss=loss), in_dfu_mode=True)
+
+        self.assertEqual(bytes(self.run_update(BleDfuControllerLegacy, legacy).firmware), FIRMWARE)
+
+    def test_adaptive_needs_receipts(self):
+        with self.assertRaises(Exception):
+            AdaptivePrn(initial=0)
+
+        self.assertEqual(AdaptivePrn(initial=1).interval, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+#  Timeline of DFU sessions as Chrome trace-event JSON, which opens in
+#  Perfetto (ui.perfetto.dev) and chrome://tracing.
+#
+#  Opt-in: a controller only traces once given a Tracer (use_tracer()).
+#  Each session gets its own track, so concurrent updates (fleet.py) show
+#  up side by side. Spans are complete ("X") events recorded when they end,
+#  notifications and link drops are instant ("i") events.
+# ------------------------------------------------------------------------------
+
+# Stands in for a span when nothing is traced
+NO_TRACE = contextlib.nullcontext()
+
+class Span(object):
+    __slots__ = ('tracer', 'track', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, track, name, cat, args):
+        self.tracer = tracer
+        self.track = track
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        self.tracer.complete(self.track, self.name, self.start, time.monotonic(), self.cat, **self.args)
+
+class Tracer(object):
+
+    def __init__(self):
+        self.origin = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.events = []
+        self.tracks = 0
+
+    def _us(self, t):
+        return round((t - self.origin) * 1e6, 3)
+
+    # --------------------------------------------------------------------------
+    #  A new track named name (e.g. the device address). Returns its id.
+    # --------------------------------------------------------------------------
+    def track(self, name):
+        with self.lock:
+            self.tracks += 1
+            track = self.tracks
+
+            self.events.append({'ph': 'M', 'name': 'process_name', 'pid': track, 'tid': 1, 'args': {'name': name}})
+            self.events.append({'ph': 'M', 'name': 'process_sort_index', 'pid': track, 'tid': 1, 'args': {'sort_index': track}})
+
+        return track
+
+    def span(self, track, name, cat='dfu', **args):
+        return Span(self, track, name, cat, args)
+
+    # --------------------------------------------------------------------------
+    #  A span from start to end (time.monotonic() values, end defaults to now)
+    # --------------------------------------------------------------------------
+    def complete(self, track, name, start, end=None, cat='dfu', **args):
+        if end is None:
+            end = time.monotonic()
+
+        event = {'ph': 'X', 'name': name, 'cat': cat, 'pid': track, 'tid': 1,
+                 'ts': self._us(start), 'dur': round((end - start) * 1e6, 3)}
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            self.events.append(event)
+
+    def instant(self, track, name, cat='dfu', **args):
+        event = {'ph': 'i', 's': 't', 'name': name, 'cat': cat, 'pid': track, 'tid': 1, 'ts': self._us(time.monotonic())}
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            self.events.append(event)
+
+    def to_json(self):
+        with self.lock:
+            events = list(self.events)
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,173 @@
+import binascii
+import json
+import os
+import threading
+
+from bisect      import bisect_right
+from collections import namedtuple
+
+# ------------------------------------------------------------------------------
+#  Precomputed layout of a secure DFU image transfer.
+#
+#  Built once per (image, max object size, payload size, PRN interval), after
+#  input_setup and the data object SELECT. Each object knows its range, the
+#  offset of every packet and the cumulative CRC32 expected at every Packet
+#  Receipt Notification and at its end, so the send loop only walks the plan.
+#  Plans are immutable and serialize to JSON, so the same plan can be reused
+#  for every device receiving the same image.
+# ------------------------------------------------------------------------------
+class ObjectPlan(namedtuple('ObjectPlan', ['begin', 'end', 'packets', 'checkpoints'])):
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.end - self.begin
+
+    @property
+    def crc(self):
+        return self.checkpoints[-1][1]
+
+    # --------------------------------------------------------------------------
+    #  (begin, end) of every packet from offset to the end of the object. An
+    #  offset between packet boundaries (data left by an earlier session with
+    #  a different payload size) gets a short first packet.
+    # --------------------------------------------------------------------------
+    def segments(self, offset):
+        index = bisect_right(self.packets, offset)
+
+        starts = (offset,) + self.packets[index:]
+        ends = self.packets[index:] + (self.end,)
+
+        return zip(starts, ends)
+
+class TransferPlan(namedtuple('TransferPlan', ['image_size', 'image_crc', 'max_size', 'payload_size', 'prn', 'objects'])):
+    __slots__ = ()
+
+    @staticmethod
+    def build(image, max_size, payload_size, prn):
+        objects = []
+        crc = 0
+
+        for begin in range(0, image.size, max_size):
+            end = min(begin + max_size, image.size)
+            packets = tuple(range(begin, end, payload_size))
+
+            # Receipts arrive after every prn packets of the object (none with
+            # a PRN of 0), the checksum response at its end
+            receipts = [packets[i] for i in range(prn, len(packets), prn)] if prn else []
+
+            checkpoints = []
+            position = begin
+
+            for offset in receipts + [end]:
+                crc = binascii.crc32(image.view[position:offset], crc) & 0xFFFFFFFF
+                checkpoints.append((offset, crc))
+                position = offset
+
+            objects.append(ObjectPlan(begin, end, packets, tuple(checkpoints)))
+
+        return TransferPlan(image.size, crc, max_size, payload_size, prn, tuple(objects))
+
+    @property
+    def final_crc(self):
+        return self.image_crc
+
+    # --------------------------------------------------------------------------
+    #  True if this plan was built for image with these parameters
+    # --------------------------------------------------------------------------
+    def matches(self, image, max_size, payload_size, prn):
+        return (self.image_size, self.max_size, self.payload_size, self.prn) == (image.size, max_size, payload_size, prn) and \
+               self.image_crc == image.crc32
+
+    # --------------------------------------------------------------------------
+    #  The object containing offset
+    # --------------------------------------------------------------------------
+    def object_at(self, offset):
+        return self.objects[min(offset // self.max_size, len(self.objects) - 1)]
+
+    # --------------------------------------------------------------------------
+    #  Every (offset, cumulative CRC) pair of the plan, e.g. to seed a
+    #  CrcTracker
+    # --------------------------------------------------------------------------
+    def checkpoints(self):
+        return [checkpoint for obj in self.objects for checkpoint in obj.checkpoints]
+
+    # --------------------------------------------------------------------------
+    #  Serialization. Packet offsets follow from the object ranges and the
+    #  payload size and are not stored.
+    # --------------------------------------------------------------------------
+    def to_dict(self):
+        return {
+            'image_size'   : self.image_size,
+            'image_crc'    : self.image_crc,
+            'max_size'     : self.max_size,
+            'payload_size' : self.payload_size,
+            'prn'          : self.prn,
+            'objects'      : [[obj.begin, obj.end, [list(c) for c in obj.checkpoints]] for obj in self.objects],
+        }
+
+    @staticmethod
+    def from_dict(data):
+        objects = tuple(ObjectPlan(begin, end, tuple(range(begin, end, data['payload_size'])), tuple(tuple(c) for c in checkpoints))
+                        for (begin, end, checkpoints) in data['objects'])
+
+        return TransferPlan(data['image_size'], data['image_crc'], data['max_size'], data['payload_size'], data['prn'], objects)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return TransferPlan.from_dict(json.load(f))
+
+# ------------------------------------------------------------------------------
+#  Plans shared between transfers, optionally persisted in a directory.
+#
+#  A plan is built once per image and parameters; every other device of a
+#  rollout gets the same instance.
+# ------------------------------------------------------------------------------
+class PlanCache(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.plans = {}
+
+    def _file(self, key):
+        (crc, size, max_size, payload_size, prn) = key
+
+        return os.path.join(self.path, f"{crc:08x}-{size}-{max_size}-{payload_size}-{prn}.json")
+
+    def get(self, image, max_size, payload_size, prn):
+        key = (image.crc32, image.size, max_size, payload_size, prn)
+
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is not None:
+                return plan
+
+            if self.path is not None:
+                try:
+                    plan = TransferPlan.load(self._file(key))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    plan = None
+
+                if plan is not None and not plan.matches(image, max_size, payload_size, prn):
+                    plan = None
+
+            if plan is None:
+                plan = TransferPlan.build(image, max_size, payload_size, prn)
+
+                if self.path is not None:
+                    os.makedirs(self.path, exist_ok=True)
+                    plan.save(self._file(key))
+
+            self.plans[key] = plan
+
+            return plan
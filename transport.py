@@ -0,0 +1,145 @@
+from abc         import ABCMeta, abstractmethod
+from collections import namedtuple
+
+ATT_DEFAULT_MTU = 23
+ATT_HEADER_SIZE = 3
+
+# ------------------------------------------------------------------------------
+#  A GATT characteristic as found during discovery.
+#  handle is the declaration handle, value_handle the value attribute.
+# ------------------------------------------------------------------------------
+Characteristic = namedtuple('Characteristic', ['handle', 'properties', 'value_handle', 'uuid'])
+
+# ------------------------------------------------------------------------------
+#  An advertisement awaited by wait_for_advertisement(): the address it came
+#  from and the seconds waited for it
+# ------------------------------------------------------------------------------
+Advertisement = namedtuple('Advertisement', ['mac', 'elapsed'])
+
+class ConnectionLost(Exception):
+    def __init__(self, message='Connection Lost'):
+        super().__init__(message)
+
+class ScanUnavailable(Exception):
+    pass
+
+# ------------------------------------------------------------------------------
+#  Link to a single BLE peripheral.
+#
+#  Controllers only talk to the peripheral through this interface, so the
+#  way ATT requests reach the radio (gatttool, a raw L2CAP socket, ...) can be
+#  swapped without touching the DFU procedures.
+# ------------------------------------------------------------------------------
+class Transport(object):
+    __metaclass__ = ABCMeta
+
+    timeout = 10
+
+    def __init__(self, target_mac, adapter=None):
+        self.target_mac = target_mac
+        self.adapter = adapter
+
+    # --------------------------------------------------------------------------
+    #  Drop the current link and point the transport at a new address
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def retarget(self, target_mac):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Connect to the peripheral. Returns True if a connection was established
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def connect(self):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Connect again after the link went down. Returns True on success
+    # --------------------------------------------------------------------------
+    def reconnect(self):
+        return self.connect()
+
+    # --------------------------------------------------------------------------
+    #  Exchange the ATT MTU. Returns the negotiated MTU, which stays at the
+    #  default of 23 if the transport or the peer can't do better.
+    # --------------------------------------------------------------------------
+    def exchange_mtu(self, mtu):
+        return ATT_DEFAULT_MTU
+
+    # --------------------------------------------------------------------------
+    #  Disconnect from the peripheral and release the transport
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def disconnect(self):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Discover all characteristics. Returns a list of Characteristic
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def discover_characteristics(self):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Read an attribute value. Returns bytes, or None on failure
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def read(self, handle):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Read the first attribute of the given type without discovery.
+    #  Returns bytes, or None if not present or not supported.
+    # --------------------------------------------------------------------------
+    def read_by_uuid(self, uuid):
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Write with response. Returns True once the peer acknowledged the write,
+    #  or immediately when wait is False.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_request(self, handle, data, wait=True):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Write without response. Raises ConnectionLost once the link is known
+    #  to be down, rather than writing into it until the next receipt.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_command(self, handle, data):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Wait for a notification or indication.
+    #  Returns (handle, value bytes), or None if nothing arrived in time.
+    #  Raises ConnectionLost as soon as the link goes down, not only after
+    #  timeout.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def wait_for_notification(self, timeout=None):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Scan passively until one of macs advertises.
+    #  Returns an Advertisement, or None if none did within timeout.
+    #  Raises ScanUnavailable if the transport can't scan.
+    # --------------------------------------------------------------------------
+    def wait_for_advertisement(self, macs, timeout):
+        raise ScanUnavailable(f"{type(self).__name__} can't scan")
+
+# ------------------------------------------------------------------------------
+#  Create a transport by name
+# ------------------------------------------------------------------------------
+def create_transport(name, target_mac, adapter=None):
+    if name is None or name == 'gatttool':
+        from gatttool_transport import GatttoolTransport
+        return GatttoolTransport(target_mac, adapter)
+
+    if name == 'socket':
+        from att_transport import AttSocketTransport
+        return AttSocketTransport(target_mac, adapter)
+
+    raise ValueError(f"Unknown transport: {name}")
+
+TRANSPORT_NAMES = ['gatttool', 'socket']
@@ -1,54 +1,114 @@
-#!/usr/bin/env python
-
-import os.path
-import zipfile
-import tempfile
-import random
-import string
-import shutil
-import re
-
-from os.path  import basename
-
-class Unpacker(object):
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def entropy(self, length):
-       return ''.join(random.choice(string.ascii_lowercase) for i in range (length))
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def unpack_zipfile(self, file):
-
-        if not os.path.isfile(file):
-            raise Exception("Error: file, not found!")
-
-        # Create unique working direction into which the zip file is expanded
-        self.unzip_dir = f"{tempfile.gettempdir()}/{os.path.splitext(basename(file))[0]}_{self.entropy(6)}"
-
-        datfilename = ""
-        binfilename = ""
-
-        with zipfile.ZipFile(file, 'r') as zip:
-            files = [item.filename for item in zip.infolist()]
-            datfilename = [m.group(0) for f in files for m in [re.search(r'.*\.dat', f)] if m].pop()
-            binfilename = [m.group(0) for f in files for m in [re.search(r'.*\.bin', f)] if m].pop()
-
-            zip.extractall(r'{0}'.format(self.unzip_dir))
-
-        datfile = f"{self.unzip_dir}/{datfilename}"
-        binfile = f"{self.unzip_dir}/{binfilename}"
-
-        # print(f"DAT file: {datfile}")
-        # print(f"BIN file: {binfile}")
-
-        return binfile, datfile
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def delete(self):
-       # delete self.unzip_dir and its contents
-       shutil.rmtree(self.unzip_dir)
+#!/usr/bin/env python
+
+import json
+import os.path
+import zipfile
+
+from collections import namedtuple
+
+from firmware_image import FirmwareImage
+
+# ------------------------------------------------------------------------------
+#  Image of a DFU package: firmware, init packet and the softdevice,
+#  bootloader and application sizes (for the legacy start packet)
+# ------------------------------------------------------------------------------
+PackageImage = namedtuple('PackageImage', ['type', 'firmware', 'init', 'sizes'])
+
+# ------------------------------------------------------------------------------
+#  Nordic DFU package (.zip) read without extracting it.
+#
+#  manifest.json names the bin and dat member of each image; the members are
+#  read straight into memory, no temporary files are involved. Packages
+#  without a manifest fall back to their only .bin and .dat members as an
+#  application.
+# ------------------------------------------------------------------------------
+class DfuPackage(object):
+
+    # In the order nrfutil applies them
+    IMAGE_TYPES = ['softdevice_bootloader', 'softdevice', 'bootloader', 'application']
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception(f"DFU package {path} not found")
+
+        self.path = path
+
+        with zipfile.ZipFile(path, 'r') as zip:
+            names = zip.namelist()
+
+            if 'manifest.json' in names:
+                self.manifest = json.loads(zip.read('manifest.json').decode())['manifest']
+            else:
+                self.manifest = {'application': {
+                    'bin_file': self._only_member(names, '.bin'),
+                    'dat_file': self._only_member(names, '.dat'),
+                }}
+
+        self.image_types = [t for t in DfuPackage.IMAGE_TYPES if t in self.manifest]
+        if not self.image_types:
+            raise Exception(f"No supported image in {path}")
+
+    def _only_member(self, names, extent):
+        members = [name for name in names if name.endswith(extent)]
+        if len(members) != 1:
+            raise Exception(f"Expected one {extent} file in {self.path}, found {len(members)}")
+
+        return members[0]
+
+    # --------------------------------------------------------------------------
+    #  The image to flash when none is asked for: the application if the
+    #  package has one, otherwise the first one nrfutil would apply
+    # --------------------------------------------------------------------------
+    def default_type(self):
+        if 'application' in self.image_types:
+            return 'application'
+
+        return self.image_types[0]
+
+    def load(self, image_type=None):
+        if image_type is None:
+            image_type = self.default_type()
+
+        entry = self.manifest.get(image_type)
+        if entry is None:
+            raise Exception(f"No {image_type} image in {self.path}, it has: {', '.join(self.image_types)}")
+
+        with zipfile.ZipFile(self.path, 'r') as zip:
+            firmware = self._read(zip, entry['bin_file'])
+            init = bytes(self._read(zip, entry['dat_file']))
+
+        size = len(firmware)
+
+        if image_type == 'softdevice_bootloader':
+            # Secure packages keep the sizes in the metadata, legacy
+            # packages on the entry itself
+            metadata = entry.get('info_read_only_metadata', {})
+            sizes = (metadata.get('sd_size', entry.get('sd_size')), metadata.get('bl_size', entry.get('bl_size')), 0)
+        elif image_type == 'softdevice':
+            sizes = (size, 0, 0)
+        elif image_type == 'bootloader':
+            sizes = (0, size, 0)
+        else:
+            sizes = (0, 0, size)
+
+        return PackageImage(image_type, FirmwareImage(firmware), init, sizes)
+
+    # --------------------------------------------------------------------------
+    #  Decompress a member into a buffer allocated once for its full size
+    # --------------------------------------------------------------------------
+    def _read(self, zip, name):
+        info = zip.getinfo(name)
+        data = bytearray(info.file_size)
+
+        with zip.open(info) as member:
+            view = memoryview(data)
+            offset = 0
+
+            while offset < info.file_size:
+                count = member.readinto(view[offset:])
+                if not count:
+                    raise Exception(f"{name} in {self.path} is truncated")
+
+                offset += count
+
+        return data
@@ -32,17 +32,23 @@ URL="$1"
 MAC="$(cat /usr/share/mender/identity/mac)"
 ID="$(cat /usr/share/mender/identity/ruuvi-id)"
 
-# Get current timestamp in milliseconds
-DATE=$(date +%s%3N)
-
-# Set output filename with millisecond timestamp
-FIRMWARE_FILE="ruuvitag_firmware_${DATE}.zip"
-
-wget "$URL" -O "$FIRMWARE_FILE"
-
-python3 /usr/ota-dfu-python/dfu.py --address="$MAC" --zip="$FIRMWARE_FILE" --ruuvitag="$ID"
-return_code=$?
-
-rm -f "$FIRMWARE_FILE"
+SOCKET=/run/ota-dfu.sock
+ARTIFACTS=/var/lib/ota-dfu-python/artifacts
+
+# Hand the update to the resident DFU daemon when it is running, so the
+# download, unpacked image and GATT handles are reused between updates
+if [ -S "$SOCKET" ]; then
+  python3 /usr/ota-dfu-python/dfu_client.py --socket="$SOCKET" --address="$MAC" --url="$URL" --ruuvitag="$ID"
+  return_code=$?
+
+  # 3: the daemon could not be reached, update directly. Any other code,
+  # including 4 (connection lost after submitting), means the daemon has
+  # or may still have the job; updating directly would flash it twice.
+  if [ $return_code -ne 3 ]; then
+    exit $return_code
+  fi
+fi
 
-exit $return_code
\ No newline at end of file
+# Downloaded and unpacked once per URL; later runs reuse the cached artifact
+# as long as the server reports it unchanged
+python3 /usr/ota-dfu-python/dfu.py --address="$MAC" --url="$URL" --artifact-cache="$ARTIFACTS" --ruuvitag="$ID"